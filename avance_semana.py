@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Avance semanal: producción vs. órdenes por combo
+- ordenes_semana.json: metas en cajas por semana ISO y combo
+    {"2026-W42": {"FND|8oz|RTCA": {"cajas": 20000}, "FNA|8oz|RTCA": 8000}}
+- progreso_semana.json: contadores materializados que cada lote cerrado actualiza
+    {"2026-W42": {"FND|8oz|RTCA": {"cajas": 1122.0, "canastas": 12, "lotes": 1,
+                                   "primero": "...", "ultimo": "...",
+                                   "por_hora": {"2026-10-18T06": 1122.0, ...}}}}
+  por_hora guarda solo las últimas MAX_HORAS horas con producción (para el ritmo reciente)
+- Consultar el avance lee los contadores de la semana: O(combos), sin recorrer la bitácora
+- Proyección: cajas restantes / ritmo de las últimas `ventana_horas` -> fin estimado
+"""
+
+import time
+import threading
+from datetime import datetime, timedelta
+
+from persistencia import Contador
+
+MAX_HORAS = 48
+FORMATO_HORA = "%Y-%m-%dT%H"
+
+
+def semana_iso_id(dt):
+    y, w, _ = dt.isocalendar()
+    return f"{y}-W{w:02d}"
+
+
+def fin_semana_iso(semana):
+    # Lunes 00:00 de la semana siguiente
+    return datetime.strptime(semana + "-1", "%G-W%V-%u") + timedelta(days=7)
+
+
+def _meta_cajas(valor):
+    if isinstance(valor, dict):
+        valor = valor.get("cajas")
+    return float(valor) if isinstance(valor, (int, float)) and not isinstance(valor, bool) else None
+
+
+class AvanceSemanal:
+    """Contadores por (semana, combo) sobre un DocumentoCache de progreso_semana.
+
+    `progreso`: DocumentoCache del progreso (escritura diferida, `claves` = semanas tocadas).
+    `cargar_ordenes()`: lee ordenes_semana; se relee a lo sumo cada `recarga_ordenes` segundos
+    para que una planificación editada a mano se vea sin reiniciar.
+    """
+
+    def __init__(self, progreso, cargar_ordenes, ventana_horas=8, recarga_ordenes=60.0):
+        self.progreso = progreso
+        self._cargar_ordenes = cargar_ordenes
+        self.ventana_horas = ventana_horas
+        self.recarga_ordenes = recarga_ordenes
+        self._ordenes = None
+        self._ordenes_vencen = 0.0
+        self._lock = threading.Lock()
+        self.lotes = Contador()
+
+    # --- escritura ---
+    def registrar(self, ts, combo, cajas, canastas):
+        """Suma un lote cerrado a su semana. Copia solo la semana y el combo tocados."""
+        semana = semana_iso_id(ts)
+        ts_txt = ts.strftime("%Y-%m-%dT%H:%M:%S")
+        hora = ts.strftime(FORMATO_HORA)
+
+        def _aplicar(doc):
+            sem = dict(doc.get(semana, {}))
+            c = dict(sem.get(combo) or {"cajas": 0.0, "canastas": 0, "lotes": 0, "primero": ts_txt, "por_hora": {}})
+            c["cajas"] = c["cajas"] + float(cajas)
+            c["canastas"] = c["canastas"] + int(canastas)
+            c["lotes"] = c["lotes"] + 1
+            c["primero"] = min(c.get("primero") or ts_txt, ts_txt)
+            c["ultimo"] = max(c.get("ultimo") or ts_txt, ts_txt)
+            por_hora = dict(c.get("por_hora") or {})
+            por_hora[hora] = por_hora.get(hora, 0.0) + float(cajas)
+            if len(por_hora) > MAX_HORAS:
+                for h in sorted(por_hora)[:-MAX_HORAS]:
+                    del por_hora[h]
+            c["por_hora"] = por_hora
+            sem[combo] = c
+            doc[semana] = sem
+            return doc
+
+        self.lotes.inc()
+        return self.progreso.actualizar(_aplicar, claves={semana})
+
+    # --- lectura ---
+    def ordenes(self):
+        ahora = time.monotonic()
+        if self._ordenes is None or ahora >= self._ordenes_vencen:
+            with self._lock:
+                if self._ordenes is None or ahora >= self._ordenes_vencen:
+                    try:
+                        self._ordenes = self._cargar_ordenes() or {}
+                    except Exception as e:
+                        print("❗ Error leyendo órdenes de la semana:", e)
+                        self._ordenes = self._ordenes or {}
+                    self._ordenes_vencen = ahora + self.recarga_ordenes
+        return self._ordenes
+
+    def ritmo(self, contador, ahora):
+        """Cajas por hora en la ventana reciente (desde el primer lote si la semana es más corta)."""
+        # Horas completas: la ventana y el primer lote se cuentan desde el inicio de su hora
+        desde = (ahora - timedelta(hours=self.ventana_horas)).replace(minute=0, second=0, microsecond=0)
+        primero = datetime.strptime(contador["primero"], "%Y-%m-%dT%H:%M:%S")
+        inicio = max(desde, primero.replace(minute=0, second=0))
+        corte = desde.strftime(FORMATO_HORA)
+        cajas = sum(v for h, v in contador.get("por_hora", {}).items() if h >= corte)
+        horas = max((ahora - inicio).total_seconds() / 3600.0, 0.25)
+        return cajas / horas
+
+    def avance(self, semana=None, ahora=None):
+        """Filas por combo (con meta o con producción) ordenadas por % de avance."""
+        ahora = ahora or datetime.now()
+        semana = semana or semana_iso_id(ahora)
+        fin = fin_semana_iso(semana)
+        metas = self.ordenes().get(semana, {}) or {}
+        producido = self.progreso.leer().get(semana, {}) or {}
+        filas = []
+        for combo in set(metas) | set(producido):
+            meta = _meta_cajas(metas.get(combo))
+            c = producido.get(combo)
+            cajas = c["cajas"] if c else 0.0
+            ritmo = self.ritmo(c, ahora) if c else 0.0
+            fila = {"combo": combo, "meta": meta, "cajas": cajas, "canastas": c["canastas"] if c else 0,
+                    "lotes": c["lotes"] if c else 0, "ritmo_cajas_h": ritmo,
+                    "pct": None, "restante": None, "fin_estimado": None, "a_tiempo": None}
+            if meta:
+                restante = max(0.0, meta - cajas)
+                fila["pct"] = min(100.0, 100.0 * cajas / meta)
+                fila["restante"] = restante
+                if restante == 0:
+                    fila["fin_estimado"], fila["a_tiempo"] = None, True
+                elif ritmo > 0:
+                    fila["fin_estimado"] = ahora + timedelta(hours=restante / ritmo)
+                    fila["a_tiempo"] = fila["fin_estimado"] <= fin
+                else:
+                    fila["a_tiempo"] = False
+            filas.append(fila)
+        filas.sort(key=lambda f: (f["pct"] is None, f["pct"] or 0.0, f["combo"]))
+        return {"semana": semana, "cierre": fin, "filas": filas}
+
+    def estadisticas(self):
+        return dict(self.progreso.estadisticas(), lotes_registrados=self.lotes.valor())
+
+
+def barra(pct, ancho=10):
+    llenos = int(round((pct or 0.0) / 100.0 * ancho))
+    return "▓" * llenos + "░" * (ancho - llenos)
+
+
+DIAS = ["lun", "mar", "mié", "jue", "vie", "sáb", "dom"]
+
+
+def texto_avance(avance, esc=str):
+    """Vista para Telegram (Markdown). `esc` escapa texto dinámico."""
+    fmt = lambda v: f"{v:,.0f}".replace(",", " ")
+    domingo = avance["cierre"] - timedelta(days=1)
+    lineas = [f"📈 *Avance semanal {esc(avance['semana'])}*",
+              f"Cierre: {DIAS[domingo.weekday()]} {domingo.strftime('%d/%m')} 23:59"]
+    filas = avance["filas"]
+    if not filas:
+        lineas.append("\nSin órdenes ni producción registrada esta semana.")
+        return "\n".join(lineas)
+    if not any(f["meta"] for f in filas):
+        lineas.append("\n⚠️ No hay órdenes cargadas para esta semana.")
+    for f in filas:
+        nombre = esc(f["combo"].replace("|", " "))
+        if f["meta"]:
+            lineas.append(f"\n*{nombre}*\n{barra(f['pct'])} {f['pct']:.1f}%  ({fmt(f['cajas'])}/{fmt(f['meta'])} cajas)")
+            if f["restante"] == 0:
+                lineas.append("✅ Orden completa")
+            elif f["fin_estimado"]:
+                fin = f["fin_estimado"]
+                marca = "✅" if f["a_tiempo"] else "⚠️ después del cierre"
+                lineas.append(f"⏱ {fmt(f['ritmo_cajas_h'])} cajas/h → fin estimado "
+                              f"{DIAS[fin.weekday()]} {fin.strftime('%d/%m %H:%M')} {marca}")
+            else:
+                lineas.append("⏸ Sin producción reciente: no se puede estimar")
+        else:
+            lineas.append(f"\n*{nombre}* (sin orden)\n📦 {fmt(f['cajas'])} cajas en {f['lotes']} lotes")
+    return "\n".join(lineas)
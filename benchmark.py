@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de punta a punta con sesiones sintéticas de operadores
+- N chats concurrentes; cada uno repite una sesión completa: carga de M1 (producto, medida,
+  mercado) y M2 (producto con un solo combo), y tránsito de dos lotes
+  (transito -> t_ll_* -> canastas -> pin_* -> ver_clave -> otro_si -> ver_parcial -> ... -> otro_no)
+- Modos: "webhook" (POST /webhook de webhookBot.app) y "polling" (revisar_mensajes de
+  botTelegramActual leyendo getUpdates); ambos contra telegram_falso, sin red
+- Cada operador espera a que su update termine de procesarse antes del siguiente paso
+  (latencia de paso = envío del update -> fin de procesar_update)
+- Reporta por modo: throughput, p50/p95/p99 por paso, llamadas salientes por interacción,
+  RSS pico; resultados en JSON para comparar entre versiones
+
+Cada modo corre en su propio proceso (los bots se configuran al importarse) dentro de un
+directorio temporal con una copia de catalogo_skus.json. ALMACEN_BACKEND, ESTADOS_BACKEND,
+WEBHOOK_MODO, etc. se heredan del entorno; los límites de tasa de envío se desactivan salvo
+que estén definidos (si no, el drenaje al final mide el límite de Telegram y no el bot).
+
+Uso:
+  python benchmark.py [--chats 20] [--sesiones 3] [--modos webhook,polling] [--latencia-ms 20]
+                      [--jitter-ms 10] [--error 0] [--429 0] [--salida benchmark.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import itertools
+import threading
+import subprocess
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+
+# (etiqueta del paso, tipo, valor): "c" = callback_data, "m" = texto
+SESION = [
+    ("carga_menu",  "c", "carga_menu"),
+    ("carga_nuevo", "c", "carga_nuevo"),
+    ("c_n_ll_*",    "c", "c_n_ll_M1"),
+    ("c_n_p_*",     "c", "c_n_p_FND"),
+    ("c_n_m_*",     "c", "c_n_m_8oz"),
+    ("c_n_me_*",    "c", "c_n_me_RTCA"),
+    ("carga_nuevo", "c", "carga_nuevo"),
+    ("c_n_ll_*",    "c", "c_n_ll_M2"),
+    ("c_n_p_*",     "c", "c_n_p_FNA"),   # un solo combo: se completa solo
+    ("transito",    "c", "transito"),
+    ("t_ll_*",      "c", "t_ll_M1"),
+    ("canastas",    "m", "12"),
+    ("pin_*",       "c", "pin_pequeño"),
+    ("ver_clave",   "c", "ver_clave"),
+    ("otro_si",     "c", "otro_si"),
+    ("ver_parcial", "c", "ver_parcial"),
+    ("t_ll_*",      "c", "t_ll_M2"),
+    ("canastas",    "m", "8"),
+    ("pin_*",       "c", "pin_pequeño"),
+    ("otro_no",     "c", "otro_no"),
+]
+
+
+def percentil(orden, p):
+    if not orden:
+        return 0.0
+    return orden[min(len(orden) - 1, int(p / 100.0 * len(orden)))]
+
+
+def resumen_latencias(muestras_seg):
+    orden = sorted(muestras_seg)
+    ms = lambda v: round(v * 1000.0, 3)
+    return {
+        "n": len(orden),
+        "prom_ms": ms(sum(orden) / len(orden)) if orden else 0.0,
+        "p50_ms": ms(percentil(orden, 50)),
+        "p95_ms": ms(percentil(orden, 95)),
+        "p99_ms": ms(percentil(orden, 99)),
+        "max_ms": ms(orden[-1]) if orden else 0.0,
+    }
+
+
+def rss_pico_mb():
+    if resource is None:
+        return None
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes en macOS, KB en Linux
+        kb /= 1024.0
+    return round(kb / 1024.0, 1)
+
+
+class Terminados:
+    """Fin de procesar_update por update_id, para que cada operador espere su paso."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._hechos = {}
+
+    def marcar(self, update_id):
+        with self._cond:
+            self._hechos[update_id] = time.perf_counter()
+            self._cond.notify_all()
+
+    def esperar(self, update_id, timeout):
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while update_id not in self._hechos:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return None
+                self._cond.wait(restante)
+            return self._hechos.pop(update_id)
+
+
+def _instrumentar(bot, terminados):
+    # procesar_update se busca por nombre global al despachar: basta con reemplazarlo en el módulo
+    original = bot.procesar_update
+
+    def procesar_update(update, *args, **kwargs):
+        try:
+            return original(update, *args, **kwargs)
+        finally:
+            terminados.marcar(update.get("update_id"))
+
+    bot.procesar_update = procesar_update
+
+
+def _esperar_envios(bot, timeout=60.0):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        if bot.TELEGRAM.programador.estadisticas()["en_cola"] == 0:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def correr_modo(modo, args):
+    """Corre un modo en este proceso y devuelve su resultado (dict)."""
+    from telegram_falso import ServidorTelegramFalso
+
+    trabajo = tempfile.mkdtemp(prefix=f"bench_{modo}_")
+    shutil.copy(os.path.join(AQUI, "catalogo_skus.json"), trabajo)
+    os.chdir(trabajo)
+    srv = ServidorTelegramFalso(latencia_ms=args.latencia_ms, jitter_ms=args.jitter_ms,
+                                tasa_error=args.error, tasa_429=args.tasa_429,
+                                semilla=args.semilla, max_llamadas=0).iniciar()
+    os.environ["TELEGRAM_API_BASE"] = srv.url
+    for k, v in (("TELEGRAM_TASA_GLOBAL", "100000"), ("TELEGRAM_TASA_CHAT", "100000"),
+                 ("TELEGRAM_RAFAGA_CHAT", "100000")):
+        os.environ.setdefault(k, v)
+
+    terminados = Terminados()
+    en_respuesta = [0]  # llamadas que viajaron en el cuerpo de la respuesta del webhook
+    if modo == "webhook":
+        import webhookBot as bot
+        _instrumentar(bot, terminados)
+        ids = itertools.count(1)
+        ids_lock = threading.Lock()
+        local = threading.local()
+
+        def enviar(update):
+            with ids_lock:
+                update = dict(update, update_id=next(ids))
+            cliente = getattr(local, "cliente", None)
+            if cliente is None:
+                cliente = local.cliente = bot.app.test_client()
+            r = cliente.post("/webhook", json=update)
+            if r.status_code != 200:
+                raise RuntimeError(f"webhook respondió {r.status_code}")
+            if "method" in (r.get_json(silent=True) or {}):
+                with ids_lock:
+                    en_respuesta[0] += 1
+            return update["update_id"]
+    else:
+        import botTelegramActual as bot
+        _instrumentar(bot, terminados)
+        threading.Thread(target=bot.revisar_mensajes, name="bench-polling", daemon=True).start()
+        enviar = srv.encolar_update
+
+    latencias = {}   # etiqueta -> [seg]
+    lat_lock = threading.Lock()
+    fallidos = []
+
+    def operador(chat_id):
+        propias = []
+        for _ in range(args.sesiones):
+            for etiqueta, tipo, valor in SESION:
+                update = srv.update_callback(chat_id, valor) if tipo == "c" else srv.update_mensaje(chat_id, valor)
+                t0 = time.perf_counter()
+                try:
+                    update_id = enviar(update)
+                except Exception as e:
+                    fallidos.append((chat_id, etiqueta, str(e)))
+                    continue
+                fin = terminados.esperar(update_id, args.timeout_paso)
+                if fin is None:
+                    fallidos.append((chat_id, etiqueta, "timeout"))
+                    continue
+                propias.append((etiqueta, fin - t0))
+                if args.pausa_ms:
+                    time.sleep(args.pausa_ms / 1000.0)
+        with lat_lock:
+            for etiqueta, seg in propias:
+                latencias.setdefault(etiqueta, []).append(seg)
+
+    hilos = [threading.Thread(target=operador, args=(100000 + i,), name=f"operador-{i}")
+             for i in range(args.chats)]
+    t0 = time.perf_counter()
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    duracion = time.perf_counter() - t0
+    drenado = _esperar_envios(bot)
+
+    interacciones = sum(len(v) for v in latencias.values())
+    salientes = srv.estadisticas()["llamadas"]
+    salientes.pop("getUpdates", None)
+    srv.detener()
+    return {
+        "modo": modo,
+        "chats": args.chats,
+        "sesiones_por_chat": args.sesiones,
+        "interacciones": interacciones,
+        "fallidas": len(fallidos),
+        "ejemplos_fallas": fallidos[:5],
+        "duracion_seg": round(duracion, 3),
+        "throughput_updates_seg": round(interacciones / duracion, 1) if duracion else 0.0,
+        "latencia_total": resumen_latencias([s for v in latencias.values() for s in v]),
+        "latencia_por_paso": {k: resumen_latencias(v) for k, v in sorted(latencias.items())},
+        "salientes": salientes,
+        "salientes_por_interaccion": round(sum(salientes.values()) / interacciones, 3) if interacciones else 0.0,
+        "en_respuesta_webhook": en_respuesta[0],
+        "envios_drenados": drenado,
+        "fallas_inyectadas": srv.estadisticas()["fallas"],
+        "rss_pico_mb": rss_pico_mb(),
+    }
+
+
+def _argumentos(argv=None):
+    ap = argparse.ArgumentParser(prog="benchmark.py", description="Benchmark de punta a punta de los bots")
+    ap.add_argument("--chats", type=int, default=20, help="operadores concurrentes")
+    ap.add_argument("--sesiones", type=int, default=3, help="sesiones completas por operador")
+    ap.add_argument("--modos", default="webhook,polling")
+    ap.add_argument("--latencia-ms", type=float, default=20.0, help="latencia de la Bot API falsa")
+    ap.add_argument("--jitter-ms", type=float, default=10.0)
+    ap.add_argument("--error", type=float, default=0.0, help="fracción de respuestas 500")
+    ap.add_argument("--429", dest="tasa_429", type=float, default=0.0, help="fracción de respuestas 429")
+    ap.add_argument("--semilla", type=int, default=1)
+    ap.add_argument("--pausa-ms", type=float, default=0.0, help="tiempo de 'pensar' entre pasos")
+    ap.add_argument("--timeout-paso", type=float, default=30.0)
+    ap.add_argument("--salida", default="benchmark.json")
+    ap.add_argument("--interno", help=argparse.SUPPRESS)  # modo a correr en este proceso
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = _argumentos(argv)
+    if args.interno:
+        resultado = correr_modo(args.interno, args)
+        sys.stdout.flush()
+        print("\n" + json.dumps(resultado, ensure_ascii=False))
+        return 0
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    resultados = []
+    for modo in [m.strip() for m in args.modos.split(",") if m.strip()]:
+        if modo not in ("webhook", "polling"):
+            print(f"⚠️ Modo desconocido: {modo}")
+            continue
+        print(f"▶️ {modo}: {args.chats} chats x {args.sesiones} sesiones...")
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, "--interno", modo],
+                              cwd=AQUI, capture_output=True, text=True,
+                              env=dict(os.environ, PYTHONPATH=AQUI + os.pathsep + os.environ.get("PYTHONPATH", "")))
+        try:
+            resultado = json.loads(proc.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print(f"❗ {modo} falló (código {proc.returncode}):\n{proc.stderr[-2000:]}")
+            continue
+        resultados.append(resultado)
+        lt = resultado["latencia_total"]
+        print(f"   {resultado['throughput_updates_seg']} updates/s | p50 {lt['p50_ms']} ms | p95 {lt['p95_ms']} ms | "
+              f"p99 {lt['p99_ms']} ms | {resultado['salientes_por_interaccion']} salientes/interacción | "
+              f"RSS pico {resultado['rss_pico_mb']} MB | fallidas {resultado['fallidas']}")
+
+    salida = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "parametros": {k: v for k, v in vars(args).items() if k != "interno"},
+        "entorno": {k: v for k, v in os.environ.items()
+                    if k.startswith(("ALMACEN_", "ESTADOS_", "WEBHOOK_", "TELEGRAM_", "CARRILES_"))},
+        "resultados": resultados,
+    }
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(salida, f, ensure_ascii=False, indent=2)
+    print(f"✅ Resultados en {args.salida}")
+    return 0 if resultados else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bitácora de lotes de tránsito (append-only)
+- Cada lote cerrado se agrega como una línea JSON con marca de tiempo
+- Escrituras agrupadas por un hilo en segundo plano, con fsync por lote
+- Segmentos rotativos (lotes-000001.jsonl, ...) por tamaño y por día
+- Índice por segmento (rango de tiempo + chats) para que las consultas de
+  turno/semana solo abran los segmentos que pueden contener resultados
+- Varios procesos: las escrituras toman un bloqueo de archivo y antes leen lo que
+  otros agregaron al final de los segmentos; `sincronizar()` hace lo mismo para
+  consultar, y cada registro ajeno se pasa a los `observadores` (p. ej. el ritmo)
+
+Registro:
+  {"ts": "2026-10-18T06:40:12", "chat_id": "123", "llenadora": "M1",
+   "producto": "FND", "medida": "8oz", "mercado": "RTCA", "combo": "FND|8oz|RTCA",
+   "canastas": 12, "pin": "pequeño", "cajas": 1122.0, "sku": "194916"}
+"""
+
+import os
+import json
+import atexit
+import threading
+from datetime import datetime
+
+from persistencia import BloqueoArchivo, Contador, escribir_json_atomico
+
+FORMATO_TS = "%Y-%m-%dT%H:%M:%S"
+
+def ts_texto(dt):
+    # Los ts se guardan como texto ISO local: se comparan bien como strings
+    return dt if isinstance(dt, str) else dt.strftime(FORMATO_TS)
+
+
+class BitacoraLotes:
+    def __init__(self, directorio, max_bytes_segmento=4 * 1024 * 1024, intervalo_fsync=1.0, max_lote=256):
+        self.directorio = directorio
+        self.max_bytes_segmento = max_bytes_segmento
+        self.intervalo_fsync = intervalo_fsync
+        self.max_lote = max_lote
+        self._ruta_indice = os.path.join(directorio, "indice.json")
+        self._bloqueo = BloqueoArchivo(os.path.join(directorio, "bitacora.lock"))
+        if os.path.isdir(directorio):
+            with self._bloqueo:
+                self._indice = self._cargar_indice()
+        else:
+            self._indice = self._cargar_indice()
+        self._cond = threading.Condition()
+        self._lock_escritura = threading.Lock()
+        self._pendientes = []
+        self._detenido = False
+        self.observadores = []   # fn(registro) por cada registro que escribió otro proceso
+        self.registrados = Contador()
+        self.escritos = Contador()
+        self.fsyncs = Contador()
+        self.errores = Contador()
+        self.ajenos = Contador()
+        self._hilo = threading.Thread(target=self._bucle, name="bitacora-lotes", daemon=True)
+        self._hilo.start()
+        atexit.register(self.detener)
+
+    # --- índice ---
+    def _cargar_indice(self):
+        try:
+            with open(self._ruta_indice, "r", encoding="utf-8") as f:
+                indice = json.load(f)
+        except (OSError, ValueError):
+            indice = {"segmentos": []}
+        # Si el índice quedó atrás (corte a mitad de escritura), se reconstruyen solo esos segmentos
+        conocidos = {seg["archivo"] for seg in indice["segmentos"]}
+        # El directorio se crea con la primera escritura: puede no existir todavía
+        archivos = sorted(os.listdir(self.directorio)) if os.path.isdir(self.directorio) else []
+        for archivo in archivos:
+            if archivo.startswith("lotes-") and archivo.endswith(".jsonl") and archivo not in conocidos:
+                indice["segmentos"].append({"archivo": archivo, "dia": None, "bytes": -1})
+        for seg in indice["segmentos"]:
+            ruta = os.path.join(self.directorio, seg["archivo"])
+            if os.path.exists(ruta) and os.path.getsize(ruta) != seg.get("bytes"):
+                self._reindexar(seg)
+        return indice
+
+    def _reindexar(self, seg):
+        seg.update({"ts_min": None, "ts_max": None, "chats": [], "registros": 0})
+        chats = set()
+        ruta = os.path.join(self.directorio, seg["archivo"])
+        with open(ruta, "r", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    r = json.loads(linea)
+                except ValueError:
+                    continue  # línea truncada por un corte
+                self._acumular(seg, r, chats)
+        seg["chats"] = sorted(chats)
+        seg["bytes"] = os.path.getsize(ruta)
+        if seg["ts_min"]:
+            seg["dia"] = seg["ts_min"][:10]
+
+    @staticmethod
+    def _acumular(seg, r, chats):
+        ts = r["ts"]
+        if seg["ts_min"] is None or ts < seg["ts_min"]:
+            seg["ts_min"] = ts
+        if seg["ts_max"] is None or ts > seg["ts_max"]:
+            seg["ts_max"] = ts
+        chats.add(str(r.get("chat_id")))
+        seg["registros"] += 1
+
+    def _leer_ajenos(self):
+        """Con el bloqueo tomado: registros que otros procesos agregaron desde la última vez.
+
+        Otro proceso solo escribe en el último segmento (el mismo que elegiría este tras
+        sincronizar) o en segmentos nuevos, así que solo esos se revisan.
+        """
+        segs = self._indice["segmentos"]
+        conocidos = {seg["archivo"] for seg in segs}
+        nuevos = sorted(a for a in os.listdir(self.directorio)
+                        if a.startswith("lotes-") and a.endswith(".jsonl") and a not in conocidos)
+        for archivo in nuevos:
+            segs.append({"archivo": archivo, "dia": None, "ts_min": None, "ts_max": None,
+                         "chats": [], "registros": 0, "bytes": 0})
+        ajenos = []
+        for seg in segs[-(len(nuevos) + 1):]:
+            ruta = os.path.join(self.directorio, seg["archivo"])
+            try:
+                tam = os.path.getsize(ruta)
+            except OSError:
+                continue
+            if tam <= seg["bytes"]:
+                continue
+            with open(ruta, "rb") as f:
+                f.seek(seg["bytes"])
+                datos = f.read(tam - seg["bytes"])
+            fin = datos.rfind(b"\n") + 1
+            chats = set(seg["chats"])
+            for linea in datos[:fin].splitlines():
+                try:
+                    r = json.loads(linea)
+                except ValueError:
+                    continue
+                self._acumular(seg, r, chats)
+                ajenos.append(r)
+            seg["chats"] = sorted(chats)
+            seg["bytes"] += fin
+            if fin < len(datos):
+                # Con el bloqueo tomado nadie está escribiendo: es una línea cortada por una caída.
+                # Se cierra para que lo que se agregue después empiece en una línea propia.
+                self._agregar_a_archivo(ruta, b"\n", tam)
+                seg["bytes"] = tam + 1
+            if seg.get("dia") is None and seg["ts_min"]:
+                seg["dia"] = seg["ts_min"][:10]
+        return ajenos
+
+    def _avisar(self, ajenos):
+        for r in ajenos:
+            self.ajenos.inc()
+            for fn in self.observadores:
+                try:
+                    fn(r)
+                except Exception as e:
+                    print("❗ Error en observador de la bitácora:", e)
+
+    def sincronizar(self):
+        """Incorpora lo que otros procesos escribieron; devuelve cuántos registros eran nuevos."""
+        if not os.path.isdir(self.directorio):
+            return 0
+        with self._lock_escritura:
+            with self._bloqueo:
+                ajenos = self._leer_ajenos()
+            self._avisar(ajenos)
+        return len(ajenos)
+
+    def _segmento_actual(self, dia):
+        segs = self._indice["segmentos"]
+        if segs:
+            seg = segs[-1]
+            if seg["bytes"] < self.max_bytes_segmento and seg.get("dia") == dia:
+                return seg
+        seg = {"archivo": f"lotes-{len(segs) + 1:06d}.jsonl", "dia": dia, "ts_min": None,
+               "ts_max": None, "chats": [], "registros": 0, "bytes": 0}
+        segs.append(seg)
+        return seg
+
+    # --- escritura ---
+    def registrar(self, registro):
+        registro = dict(registro)
+        registro["ts"] = ts_texto(registro.get("ts") or datetime.now())
+        registro["chat_id"] = str(registro.get("chat_id"))
+        with self._cond:
+            self._pendientes.append(registro)
+            self.registrados.inc()
+            if len(self._pendientes) >= self.max_lote:
+                self._cond.notify()
+        return registro
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                if not self._pendientes and not self._detenido:
+                    self._cond.wait(self.intervalo_fsync)
+                if self._detenido and not self._pendientes:
+                    return
+            self.vaciar()
+
+    def vaciar(self):
+        # Escribe todo lo pendiente agrupado por segmento y hace un fsync por segmento
+        with self._lock_escritura:
+            with self._cond:
+                lote, self._pendientes = self._pendientes, []
+            if not lote:
+                return True
+            escritos, error = self._escribir(lote)
+            for _ in range(escritos):
+                self.escritos.inc()
+            if error is None:
+                return True
+            print("❗ Error escribiendo bitácora:", error)
+            self.errores.inc()
+            if escritos < len(lote):
+                # Solo vuelve a la cola lo que no llegó a disco: lo ya escrito no se duplica
+                with self._cond:
+                    self._pendientes[:0] = lote[escritos:]
+            return False
+
+    def _escribir(self, lote):
+        """Devuelve (registros ya en disco con fsync, error o None).
+
+        Cada segmento recibe su parte en una sola escritura; si falla, el archivo se
+        trunca a su tamaño anterior (sin líneas sueltas) y se corta ahí. Todo con el
+        bloqueo de archivo tomado y después de incorporar lo que agregaron otros procesos.
+        """
+        i, ajenos = 0, []
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            with self._bloqueo:
+                return self._escribir_bloqueado(lote, ajenos)
+        except Exception as e:
+            return i, e
+        finally:
+            self._avisar(ajenos)
+
+    def _escribir_bloqueado(self, lote, ajenos):
+        ajenos.extend(self._leer_ajenos())
+        i = 0
+        try:
+            while i < len(lote):
+                seg = self._segmento_actual(lote[i]["ts"][:10])
+                bloque, tam, j = [], seg["bytes"], i
+                while j < len(lote) and tam < self.max_bytes_segmento and lote[j]["ts"][:10] == seg["dia"]:
+                    linea = (json.dumps(lote[j], ensure_ascii=False) + "\n").encode("utf-8")
+                    bloque.append(linea)
+                    tam += len(linea)
+                    j += 1
+                self._agregar_a_archivo(os.path.join(self.directorio, seg["archivo"]), b"".join(bloque), seg["bytes"])
+                self.fsyncs.inc()
+                chats = set(seg["chats"])
+                for r in lote[i:j]:
+                    self._acumular(seg, r, chats)
+                seg["chats"] = sorted(chats)
+                seg["bytes"] = tam
+                i = j
+        except Exception as e:
+            return i, e
+        try:
+            escribir_json_atomico(self._ruta_indice, self._indice, indent=None)
+        except Exception as e:
+            # Los lotes ya están en disco: al abrir se reindexan los segmentos cuyo tamaño no coincide
+            return i, e
+        return i, None
+
+    @staticmethod
+    def _agregar_a_archivo(ruta, datos, tam_previo):
+        fd = os.open(ruta, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            try:
+                vista = memoryview(datos)
+                while vista:
+                    vista = vista[os.write(fd, vista):]
+                os.fsync(fd)
+            except OSError:
+                try:
+                    os.ftruncate(fd, tam_previo)
+                except OSError:
+                    pass
+                raise
+        finally:
+            os.close(fd)
+
+    def detener(self):
+        with self._cond:
+            self._detenido = True
+            self._cond.notify()
+        self._hilo.join(timeout=self.intervalo_fsync + 5)
+        return self.vaciar()
+
+    # --- consultas ---
+    def segmentos_para(self, desde=None, hasta=None, chat_id=None):
+        desde = ts_texto(desde) if desde else None
+        hasta = ts_texto(hasta) if hasta else None
+        chat = str(chat_id) if chat_id is not None else None
+        for seg in list(self._indice["segmentos"]):
+            if not seg["registros"]:
+                continue
+            if desde and seg["ts_max"] < desde:
+                continue
+            if hasta and seg["ts_min"] >= hasta:
+                continue
+            if chat and chat not in seg["chats"]:
+                continue
+            yield seg
+
+    def consultar(self, desde=None, hasta=None, chat_id=None):
+        """Lotes con desde <= ts < hasta (y del chat, si se indica), en orden de escritura."""
+        d = ts_texto(desde) if desde else None
+        h = ts_texto(hasta) if hasta else None
+        chat = str(chat_id) if chat_id is not None else None
+
+        def coincide(r):
+            return ((d is None or r["ts"] >= d) and (h is None or r["ts"] < h)
+                    and (chat is None or r["chat_id"] == chat))
+
+        self.sincronizar()
+        # Foto consistente: segmentos con su tamaño escrito + pendientes en memoria.
+        # Luego se lee sin lock hasta ese tamaño, así no se ven líneas a medio escribir.
+        with self._lock_escritura:
+            segs = [(seg["archivo"], seg["bytes"]) for seg in self.segmentos_para(desde, hasta, chat_id)]
+            with self._cond:
+                pendientes = list(self._pendientes)
+
+        for archivo, limite in segs:
+            leidos = 0
+            with open(os.path.join(self.directorio, archivo), "rb") as f:
+                for linea in f:
+                    leidos += len(linea)
+                    if leidos > limite:
+                        break
+                    try:
+                        r = json.loads(linea)
+                    except ValueError:
+                        continue
+                    if coincide(r):
+                        yield r
+        for r in pendientes:
+            if coincide(r):
+                yield r
+
+    def estadisticas(self):
+        return {
+            "registrados": self.registrados.valor(),
+            "escritos": self.escritos.valor(),
+            "fsyncs": self.fsyncs.valor(),
+            "errores": self.errores.valor(),
+            "pendientes": len(self._pendientes),
+            "segmentos": len(self._indice["segmentos"]),
+            "ajenos": self.ajenos.valor(),
+        }
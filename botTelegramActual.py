@@ -16,19 +16,38 @@ Requisitos:
 """
 
 import os
+import sys
+import signal
+import atexit
 import time
-import json
 import threading
 from datetime import datetime, timedelta
-import requests
+
+from persistencia import BloqueoArchivo, DocumentoCache, EscrituraDiferida, crear_almacen
+from catalogo import CatalogoRecargable, CacheTeclados, serializar_teclado
+from claves_envase import GeneradorClaves, LETRA_LLENADORA, LLENADORAS
+from historial_config import HistorialConfig, interpretar_fecha
+from bitacora import BitacoraLotes, ts_texto
+from avance_semana import AvanceSemanal, texto_avance
+from totales import nuevos_totales, acumular_lote, texto_parcial, texto_resumen
+from entrada_rapida import parece_entrada_rapida, interpretar_lotes
+from ritmo import RitmoLlenadoras, texto_ritmo
+from telegram_api import ClienteTelegram, ProgramadorEnvios, MensajesActivos, INTERACTIVO, MASIVO
+from despacho import DespachadorPorChat, OffsetConfirmado
+from estados import EstadosConversacion, crear_almacen_estados
+from rutas import Enrutador
 
 # =========================
 # Configuración
 # =========================
-TOKEN_TELEGRAM = os.getenv(BOT_TOKEN)
-API_URL = f"https://api.telegram.org/bot{TOKEN_TELEGRAM}"
+TOKEN_TELEGRAM = os.getenv("BOT_TOKEN", "REEMPLAZA_AQUI_EL_TOKEN_EN_DESARROLLO")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")  # p. ej. telegram_falso.py en pruebas
+API_URL = f"{TELEGRAM_API_BASE.rstrip('/')}/bot{TOKEN_TELEGRAM}"
 POLL_TIMEOUT = 25
-last_update_id = None
+POLL_LIMITE = int(os.getenv("POLL_LIMITE", "100"))                    # updates por getUpdates (1-100)
+POLL_OFFSET_PATH = os.getenv("POLL_OFFSET_PATH", "offset_updates.json")  # offset confirmado y updates en vuelo
+UPDATES_PERMITIDOS = ["message", "callback_query"]                    # lo único que maneja el bot
+ESTADISTICAS_LOG_SEG = float(os.getenv("ESTADISTICAS_LOG_SEG", "300"))  # sin /metrics: se imprimen (0 = nunca)
 
 # Persistencia
 CATALOGO_SKUS_PATH    = "catalogo_skus.json"   # catálogo institucional (producto|medida|mercado) -> {sku, vida_util_meses,...}
@@ -36,10 +55,66 @@ CONFIG_TURNO_PATH     = "config_turno.json"    # por chat_id: asignación por ll
 ORDENES_SEMANA_PATH   = "ordenes_semana.json"  # metas por semana (opcional, estructura lista)
 PROGRESO_SEMANA_PATH  = "progreso_semana.json" # producido acumulado por semana (opcional, estructura lista)
 
+# Escritura diferida de config_turno.json (segundos)
+CONFIG_TURNO_DEBOUNCE_SEG  = float(os.getenv("CONFIG_TURNO_DEBOUNCE_SEG", "0.5"))
+CONFIG_TURNO_MAX_STALE_SEG = float(os.getenv("CONFIG_TURNO_MAX_STALE_SEG", "5"))
+
+# Backend de almacenamiento: "json" (por defecto) o "sqlite"
+ALMACEN_BACKEND = os.getenv("ALMACEN_BACKEND", "json")
+SQLITE_PATH     = os.getenv("SQLITE_PATH", "bot.sqlite3")
+
+# Cada cuánto (segundos) se revisa si catalogo_skus.json cambió en disco para recargarlo
+CATALOGO_RECARGA_SEG = float(os.getenv("CATALOGO_RECARGA_SEG", "2"))
+
+# Bitácora append-only de lotes cerrados (segmentos .jsonl + índice)
+BITACORA_DIR = os.getenv("BITACORA_DIR", "bitacora_lotes")
+HISTORIAL_CONFIG_PATH = os.getenv("HISTORIAL_CONFIG_PATH", "historial_config.jsonl")
+
+# Avance semanal: horas recientes para el ritmo de producción y relectura de ordenes_semana.json
+AVANCE_VENTANA_HORAS = float(os.getenv("AVANCE_VENTANA_HORAS", "8"))
+ORDENES_RECARGA_SEG  = float(os.getenv("ORDENES_RECARGA_SEG", "60"))
+
+# Ritmo por llenadora: la ventana "turno" (además de última hora y día)
+TURNO_HORAS = float(os.getenv("TURNO_HORAS", "8"))
+
+# Cliente HTTP de la Bot API: pool keep-alive y timeouts (segundos)
+TELEGRAM_POOL_SIZE        = int(os.getenv("TELEGRAM_POOL_SIZE", "10"))
+TELEGRAM_TIMEOUT_CONEXION = float(os.getenv("TELEGRAM_TIMEOUT_CONEXION", "3.05"))
+TELEGRAM_TIMEOUT_LECTURA  = float(os.getenv("TELEGRAM_TIMEOUT_LECTURA", "10"))
+
+# Límites de envío (Telegram: ~30 msg/s global, ~1 msg/s por chat con ráfagas cortas)
+TELEGRAM_TASA_GLOBAL = float(os.getenv("TELEGRAM_TASA_GLOBAL", "30"))
+TELEGRAM_TASA_CHAT   = float(os.getenv("TELEGRAM_TASA_CHAT", "1"))
+TELEGRAM_RAFAGA_CHAT = int(os.getenv("TELEGRAM_RAFAGA_CHAT", "3"))
+TELEGRAM_EMISORES    = int(os.getenv("TELEGRAM_EMISORES", "4"))
+
+# Carriles de procesamiento por chat (orden estricto por chat, paralelo entre chats)
+CARRILES_CHAT = int(os.getenv("CARRILES_CHAT", str(max(4, (os.cpu_count() or 1) * 2))))
+
+# Estado conversacional: "memoria" (LRU + TTL), "sqlite" o "socket" (Redis o `python estados.py servidor`)
+ESTADOS_BACKEND      = os.getenv("ESTADOS_BACKEND", "memoria")
+ESTADOS_TTL_SEG      = float(os.getenv("ESTADOS_TTL_SEG", "43200"))
+ESTADOS_MAX_BYTES    = int(os.getenv("ESTADOS_MAX_BYTES", str(16 * 1024 * 1024)))
+ESTADOS_MAX_ENTRADAS = int(os.getenv("ESTADOS_MAX_ENTRADAS", "10000"))
+ESTADOS_SQLITE_PATH  = os.getenv("ESTADOS_SQLITE_PATH", "estados.sqlite3")
+ESTADOS_SOCKET       = os.getenv("ESTADOS_SOCKET", "unix:/tmp/estados.sock")
+
+# Varios procesos sobre los mismos archivos (p. ej. workers de gunicorn): config_turno y
+# progreso_semana se escriben al momento bajo un bloqueo de archivo y cada proceso recarga
+# (como mucho cada MULTIPROCESO_REVISION_SEG) lo que cambiaron los demás.
+# Por defecto activo si el estado conversacional es compartido (sqlite o socket).
+MULTIPROCESO = os.getenv("MULTIPROCESO", "0" if ESTADOS_BACKEND == "memoria" else "1") == "1"
+MULTIPROCESO_REVISION_SEG = float(os.getenv("MULTIPROCESO_REVISION_SEG", "1"))
+
 _json_lock = threading.Lock()
 
-# Estados en memoria
-estados_usuarios = {}  # por chat_id: estado conversacional
+# Estados por chat_id (ver estados.EstadosConversacion); procesar_update confirma al terminar cada update
+estados_usuarios = EstadosConversacion(crear_almacen_estados(
+    ESTADOS_BACKEND, ESTADOS_TTL_SEG, ESTADOS_MAX_BYTES, ESTADOS_MAX_ENTRADAS,
+    ESTADOS_SQLITE_PATH, ESTADOS_SOCKET,
+))
+if MULTIPROCESO and ESTADOS_BACKEND == "memoria":
+    print("⚠️ MULTIPROCESO=1 con ESTADOS_BACKEND=memoria: el estado de cada chat no se comparte entre procesos.")
 
 # =========================
 # Conversión de cajas / canasta
@@ -91,22 +166,24 @@ def pin_es_valido(medida, pin):
 # =========================
 # Utilidades JSON y tiempo
 # =========================
+# ALMACEN_BACKEND=json (por defecto, un archivo por documento) o sqlite (SQLITE_PATH).
+# Con sqlite, la primera vez se importan los JSON existentes.
+ALMACEN = crear_almacen(
+    ALMACEN_BACKEND, _json_lock, SQLITE_PATH,
+    CATALOGO_SKUS_PATH, CONFIG_TURNO_PATH,
+    [CATALOGO_SKUS_PATH, CONFIG_TURNO_PATH, ORDENES_SEMANA_PATH, PROGRESO_SEMANA_PATH],
+)
+
 def _load_json(path, default):
     try:
-        with _json_lock:
-            if not os.path.exists(path):
-                return default
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+        return ALMACEN.cargar(path, default)
     except Exception:
         return default
 
-def _save_json(path, data):
+def _save_json(path, data, indent=2, claves=None):
+    # claves: claves de primer nivel que cambiaron (SQLite solo reescribe esas filas)
     try:
-        with _json_lock:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
+        return ALMACEN.guardar(path, data, claves=claves, indent=indent)
     except Exception:
         return False
 
@@ -114,46 +191,94 @@ def tz_now_gt():
     # Ajusta si el host no está en Guatemala; aquí usamos hora local del sistema
     return datetime.now()
 
-def semana_iso_id(dt=None):
-    dt = dt or tz_now_gt()
-    y, w, _ = dt.isocalendar()
-    return f"{y}-W{w:02d}"
-
-def dia_juliano(dt):
-    return dt.timetuple().tm_yday
-
-MESES_ES = ["ENE","FEB","MAR","ABR","MAY","JUN","JUL","AGO","SEP","OCT","NOV","DIC"]
-MESES_EN = ["JAN","FEB","MAR","APR","MAY","JUN","JUL","AUG","SEP","OCT","NOV","DEC"]
-
-def mes_es(idx):  # 1..12
-    return MESES_ES[idx-1]
-
-def mes_en(idx):  # 1..12
-    return MESES_EN[idx-1]
-
-def sumar_meses(dt, meses):
-    y = dt.year + (dt.month - 1 + meses) // 12
-    m = (dt.month - 1 + meses) % 12 + 1
-    # día 15 fijo
-    return datetime(y, m, 15, dt.hour, dt.minute)
-
-def calcular_vencimiento(fecha_prod, vida_util_meses):
-    return sumar_meses(fecha_prod, vida_util_meses)
-
 # =========================
 # Catálogo y configuración
 # =========================
+# Documentos en memoria: se leen de disco una vez y las escrituras pasan por la caché.
+# Lo que devuelven get_catalogo()/get_config_turno() es una instantánea compartida: no mutar.
+def _cargar_catalogo():
+    # Sin el try de _load_json: un JSON roto (archivo a medio editar) debe rechazar la
+    # recarga en lugar de publicar un catálogo vacío
+    return ALMACEN.cargar(CATALOGO_SKUS_PATH, {})
+
+# Catálogo indexado (ver catalogo.CatalogoRecargable): consultas en memoria y recarga
+# validada si el archivo cambia. Con SQLite no hay archivo que vigilar.
+CATALOGO = CatalogoRecargable(
+    _cargar_catalogo,
+    lambda data: _save_json(CATALOGO_SKUS_PATH, data),
+    ruta_vigilada=CATALOGO_SKUS_PATH if ALMACEN_BACKEND == "json" else None,
+    intervalo=CATALOGO_RECARGA_SEG,
+    firma=(lambda: ALMACEN.firma(CATALOGO_SKUS_PATH)) if ALMACEN_BACKEND == "sqlite" else None,
+)
+# config_turno no se escribe dentro del request: se marca sucio y un hilo lo vuelca
+# (agrupando ráfagas) a lo sumo CONFIG_TURNO_MAX_STALE_SEG después del primer cambio.
+# Con MULTIPROCESO se escribe al momento (ver _documento).
+_flush_config_turno = EscrituraDiferida(
+    "config_turno",
+    lambda data, claves=None: _save_json(CONFIG_TURNO_PATH, data, indent=None, claves=claves),
+    retardo=CONFIG_TURNO_DEBOUNCE_SEG,
+    max_retardo=CONFIG_TURNO_MAX_STALE_SEG,
+)
+def _documento(nombre, path, flush):
+    # Un proceso: escritura diferida. MULTIPROCESO: escritura al momento bajo bloqueo de
+    # archivo y recarga cuando cambia la firma (mtime del JSON o versión en SQLite)
+    if not MULTIPROCESO:
+        return DocumentoCache(nombre, lambda: _load_json(path, {}), flush.marcar)
+    return DocumentoCache(
+        nombre,
+        lambda: _load_json(path, {}),
+        lambda data, claves=None: _save_json(path, data, indent=None, claves=claves),
+        firma=lambda: ALMACEN.firma(path),
+        intervalo=MULTIPROCESO_REVISION_SEG,
+        bloqueo=BloqueoArchivo(f"{path}.lock"),
+    )
+
+_cache_config_turno = _documento("config_turno", CONFIG_TURNO_PATH, _flush_config_turno)
+
 def get_catalogo():
-    return _load_json(CATALOGO_SKUS_PATH, {})
+    return CATALOGO.indice().datos
 
 def set_catalogo(data):
-    return _save_json(CATALOGO_SKUS_PATH, data)
+    return CATALOGO.escribir(data)
 
 def get_config_turno():
-    return _load_json(CONFIG_TURNO_PATH, {})
+    return _cache_config_turno.leer()
 
 def set_config_turno(data):
-    return _save_json(CONFIG_TURNO_PATH, data)
+    return _cache_config_turno.escribir(data)
+
+def set_config_llenadora(chat_id, llenadora, combo):
+    # Actualiza una sola llenadora de un chat sin pisar cambios concurrentes de otros chats
+    def _aplicar(cfg):
+        por_chat = dict(cfg.get(str(chat_id), {}))
+        por_chat[llenadora] = combo
+        cfg[str(chat_id)] = por_chat
+        return cfg
+    return _cache_config_turno.actualizar(_aplicar, claves={str(chat_id)})
+
+# Cada asignación guardada queda en el historial (append-only) con su sku y vida útil:
+# permite regenerar la clave que se imprimía a cualquier hora pasada
+HISTORIAL = HistorialConfig(HISTORIAL_CONFIG_PATH)
+
+def _sembrar_historial():
+    # Asignaciones previas al historial: vigentes desde el arranque (no se sabe desde cuándo)
+    idx, ahora = CATALOGO.indice(), tz_now_gt()
+    for chat, por_ll in get_config_turno().items():
+        for ll, combo in (por_ll or {}).items():
+            if combo and not HISTORIAL.tiene(chat, ll):
+                # Con varios procesos arrancando a la vez, solo uno la registra
+                cat = idx.combo(combo.get("producto", ""), combo.get("medida", ""), combo.get("mercado", ""))
+                HISTORIAL.registrar_si_falta(chat, ll, combo, cat, ts=ahora, origen="config_existente")
+
+try:
+    _sembrar_historial()
+except Exception as e:
+    print("❗ Error sembrando el historial de config:", e)
+
+def estadisticas_cache():
+    return [CATALOGO.estadisticas(), _cache_config_turno.estadisticas(), _flush_config_turno.estadisticas(),
+            dict(CLAVES.estadisticas(), documento="claves_envase"), AVANCE.estadisticas(),
+            HISTORIAL.estadisticas()]
 
 def combo_key(producto, medida, mercado):
     return f"{producto}|{medida}|{mercado}"
@@ -161,36 +286,16 @@ def combo_key(producto, medida, mercado):
 # =========================
 # Clave de envase
 # =========================
-LETRA_LLENADORA = {"M1":"B", "M2":"C", "M3":"D"}  # Chub pendiente
 
-def generar_clave_envase(llenadora, mercado, sku, vida_util_meses, fecha_ref=None, letra_chub=None):
-    ahora = fecha_ref or tz_now_gt()
-    yy = ahora.year % 100
-    hhmm = ahora.strftime("%H:%M")
-    ddd = dia_juliano(ahora)
-
-    # línea 1 (incluye hora)
-    if llenadora == "Chub":
-        letra = letra_chub if letra_chub else "—"  # pendiente
-    else:
-        letra = LETRA_LLENADORA.get(llenadora, "—")
-    linea1 = f"{letra} {hhmm} {yy:02d} L {ddd}"
-
-    # vencimiento
-    venc = calcular_vencimiento(ahora, vida_util_meses)
-    yy_v = venc.year % 100
-    if mercado == "FDA":
-        mes_txt = mes_en(venc.month)
-        pref = "BEST BY"
-    else:
-        mes_txt = mes_es(venc.month)
-        pref = "EXP"
-    linea2 = f"{pref} 15 {mes_txt} {yy_v:02d}"
+# Claves memorizadas por minuto, con calendario de juliano/vencimientos precalculado por
+# año para las vidas útiles del catálogo (ver claves_envase.GeneradorClaves)
+CLAVES = GeneradorClaves(
+    LETRA_LLENADORA,
+    vidas=lambda: {v["vida_util_meses"] for v in get_catalogo().values() if isinstance(v.get("vida_util_meses"), int)},
+)
 
-    # SKU final
-    linea3 = f"6173 {sku}"
-
-    return f"{linea1}\n{linea2}\n{linea3}"
+def generar_clave_envase(llenadora, mercado, sku, vida_util_meses, fecha_ref=None, letra_chub=None):
+    return CLAVES.clave(llenadora, mercado, sku, vida_util_meses, fecha_ref or tz_now_gt(), letra_chub)
 
 # =========================
 # Markdown y helpers UI
@@ -198,16 +303,43 @@ def generar_clave_envase(llenadora, mercado, sku, vida_util_meses, fecha_ref=Non
 def md_escape(texto: str) -> str:
     return str(texto).replace('_', r'\_').replace('*', r'\*').replace('[', r'\[').replace('`', r'\`')
 
-def send_msg(chat_id, text, reply_markup=None, parse_mode="Markdown"):
+TELEGRAM = ClienteTelegram(
+    API_URL,
+    pool=TELEGRAM_POOL_SIZE,
+    timeout_conexion=TELEGRAM_TIMEOUT_CONEXION,
+    timeout_lectura=TELEGRAM_TIMEOUT_LECTURA,
+)
+# sendMessage pasa por la cola con límites de tasa; los resúmenes van con prioridad MASIVO
+TELEGRAM.programador = ProgramadorEnvios(
+    TELEGRAM.llamar,
+    tasa_global=TELEGRAM_TASA_GLOBAL,
+    tasa_chat=TELEGRAM_TASA_CHAT,
+    rafaga_chat=TELEGRAM_RAFAGA_CHAT,
+    hilos=TELEGRAM_EMISORES,
+)
+
+def send_msg(chat_id, text, reply_markup=None, parse_mode="Markdown", prioridad=INTERACTIVO):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup:
         payload["reply_markup"] = reply_markup
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    requests.post(f"{API_URL}/sendMessage", json=payload)
+    return TELEGRAM.enviar("sendMessage", payload, chat_id=chat_id, prioridad=prioridad, diferible=True)
+
+# Pasos de los flujos: editan el mensaje activo del chat en lugar de enviar uno nuevo
+# (ver telegram_api.MensajesActivos). Resúmenes y claves siguen saliendo con send_msg.
+PANTALLA = MensajesActivos(TELEGRAM)
+
+def mostrar(chat_id, text, reply_markup=None, parse_mode="Markdown"):
+    payload = {"chat_id": chat_id, "text": text}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    return PANTALLA.mostrar(chat_id, payload)
 
 def answer_callback(callback_query_id):
-    requests.post(f"{API_URL}/answerCallbackQuery", json={"callback_query_id": callback_query_id})
+    return TELEGRAM.enviar("answerCallbackQuery", {"callback_query_id": callback_query_id}, diferible=True)
 
 def teclado_inline(filas):
     return {"inline_keyboard": filas}
@@ -239,8 +371,10 @@ def mostrar_menu(chat_id):
     filas = [
         [{"text": "📦 Carga de datos",    "callback_data": "carga_menu"}],
         [{"text": "🚚 Reportar tránsito", "callback_data": "transito"}],
+        [{"text": "📈 Avance semanal",    "callback_data": "avance_semana"},
+         {"text": "⏱ Ritmo",              "callback_data": "ritmo"}],
     ]
-    send_msg(chat_id, f"{banner}\n\n🛠️ Selecciona una herramienta:", teclado_inline(filas))
+    mostrar(chat_id, f"{banner}\n\n🛠️ Selecciona una herramienta:", teclado_inline(filas))
 
 # =========================
 # Carga de datos (Cargar y Ver)
@@ -252,50 +386,60 @@ def mostrar_menu_carga(chat_id):
         # Futuro: Modificar / Eliminar
         [{"text": "⬅️ Volver", "callback_data": "volver_menu"}]
     ]
-    send_msg(chat_id, "📦 Carga de datos — elige una opción:", teclado_inline(filas))
+    mostrar(chat_id, "📦 Carga de datos — elige una opción:", teclado_inline(filas))
+
+# Teclados del flujo de carga: salen del catálogo (solo combos existentes) y se serializan
+# una vez por versión del catálogo
+TECLADOS = CacheTeclados(CATALOGO)
+ORDEN_PRODUCTOS = ["FND","FRD","FRS","FNA","FNP","FRP","FNE","FRE","FNDT"]
+ORDEN_MEDIDAS   = ["4oz","8oz","14oz","16oz","28oz","35oz","40oz","80oz","4lbs"]
+ETIQUETA_MERCADO = {"RTCA": "RTCA 🇬🇹", "FDA": "FDA 🇺🇸"}
+
+def _ordenar(valores, orden):
+    return sorted(valores, key=lambda v: (orden.index(v) if v in orden else len(orden), v))
+
+def _teclado_llenadoras(prefijo, extra=()):
+    return serializar_teclado([
+        [{"text": "M1", "callback_data": f"{prefijo}M1"},
+         {"text": "M2", "callback_data": f"{prefijo}M2"}],
+        [{"text": "M3", "callback_data": f"{prefijo}M3"},
+         {"text": "Chub", "callback_data": f"{prefijo}Chub"}],
+        *extra,
+    ])
+
+TECLADO_LLENADORAS_CARGA    = _teclado_llenadoras("c_n_ll_")
+TECLADO_LLENADORAS_TRANSITO = _teclado_llenadoras("t_ll_")
+# Tras cerrar un lote (otro_si): mismas llenadoras + parcial del turno
+TECLADO_LLENADORAS_TRANSITO_PARCIAL = _teclado_llenadoras(
+    "t_ll_", [[{"text": "📊 Ver parcial", "callback_data": "ver_parcial"}]])
 
 def iniciar_carga(chat_id):
     # Paso 1: Llenadora
-    filas = [
-        [{"text": "M1", "callback_data": "c_n_ll_M1"},
-         {"text": "M2", "callback_data": "c_n_ll_M2"}],
-        [{"text": "M3", "callback_data": "c_n_ll_M3"},
-         {"text": "Chub", "callback_data": "c_n_ll_Chub"}],
-    ]
     estados_usuarios[chat_id] = {"paso":"carga_ll", "tmp":{}}
-    send_msg(chat_id, "Selecciona la *llenadora* para este registro:", teclado_inline(filas), parse_mode="Markdown")
+    mostrar(chat_id, "Selecciona la *llenadora* para este registro:", TECLADO_LLENADORAS_CARGA, parse_mode="Markdown")
 
 def teclado_productos():
-    # Ajusta a tu lista real
-    base = [
-        {"text": "FND", "callback_data": "c_n_p_FND"},
-        {"text": "FRD", "callback_data": "c_n_p_FRD"},
-        {"text": "FRS", "callback_data": "c_n_p_FRS"},
-        {"text": "FNA", "callback_data": "c_n_p_FNA"},
-        {"text": "FNP", "callback_data": "c_n_p_FNP"},
-        {"text": "FRP", "callback_data": "c_n_p_FRP"},
-        {"text": "FNE", "callback_data": "c_n_p_FNE"},
-        {"text": "FRE", "callback_data": "c_n_p_FRE"},
-    ]
-    filas = [base[i:i+2] for i in range(0, len(base), 2)]
-    return teclado_inline(filas)
-
-def teclado_medidas():
-    medidas = ["4oz","8oz","14oz","16oz","28oz","35oz","40oz","80oz","4lbs"]
-    filas = [[{"text": m, "callback_data": f"c_n_m_{m}"} for m in medidas[i:i+3]] for i in range(0, len(medidas), 3)]
-    return teclado_inline(filas)
-
-def teclado_mercados():
-    filas = [[
-        {"text":"RTCA 🇬🇹", "callback_data":"c_n_me_RTCA"},
-        {"text":"FDA 🇺🇸",  "callback_data":"c_n_me_FDA"},
-    ]]
-    return teclado_inline(filas)
+    def construir(idx):
+        base = [{"text": p, "callback_data": f"c_n_p_{p}"} for p in _ordenar(idx.productos(), ORDEN_PRODUCTOS)]
+        return [base[i:i+2] for i in range(0, len(base), 2)]
+    return TECLADOS.obtener(("productos",), construir)
+
+def teclado_medidas(producto):
+    def construir(idx):
+        medidas = _ordenar(idx.medidas(producto), ORDEN_MEDIDAS)
+        return [[{"text": m, "callback_data": f"c_n_m_{m}"} for m in medidas[i:i+3]] for i in range(0, len(medidas), 3)]
+    return TECLADOS.obtener(("medidas", producto), construir)
+
+def teclado_mercados(producto, medida):
+    def construir(idx):
+        mercados = _ordenar(idx.mercados(producto, medida), list(ETIQUETA_MERCADO))
+        return [[{"text": ETIQUETA_MERCADO.get(me, me), "callback_data": f"c_n_me_{me}"} for me in mercados]]
+    return TECLADOS.obtener(("mercados", producto, medida), construir)
 
 def carga_ver(chat_id):
     cfg = get_config_turno()
     estado_ll = cfg.get(str(chat_id), {})
-    catalogo = get_catalogo()
+    catalogo = CATALOGO.indice()
 
     llenadoras = ["M1","M2","M3","Chub"]
     lineas = ["👁 *Registros cargados (por llenadora):*"]
@@ -306,8 +450,7 @@ def carga_ver(chat_id):
         if combo:
             hay_algo = True
             p, m, me = combo["producto"], combo["medida"], combo["mercado"]
-            k = combo_key(p,m,me)
-            cat = catalogo.get(k, {})
+            cat = catalogo.combo(p, m, me) or {}
             sku = cat.get("sku")
             vida = cat.get("vida_util_meses")
             if sku and vida:
@@ -331,23 +474,18 @@ def carga_ver(chat_id):
     if not hay_algo:
         filas = [[{"text":"➕ Cargar ahora","callback_data":"carga_nuevo"}],
                  [{"text":"⬅️ Volver","callback_data":"carga_menu"}]]
-        send_msg(chat_id, "👁 No hay registros cargados.\nUsa *Cargar* para crear el primero.", teclado_inline(filas), parse_mode="Markdown")
+        mostrar(chat_id, "👁 No hay registros cargados.\nUsa *Cargar* para crear el primero.", teclado_inline(filas), parse_mode="Markdown")
     else:
         send_msg(chat_id, "\n".join(lineas), parse_mode="Markdown")
 
 # =========================
 # Reportar tránsito
 # =========================
-def mostrar_llenadoras_transito(chat_id):
-    filas = [
-        [{"text": "M1", "callback_data": "t_ll_M1"},
-         {"text": "M2", "callback_data": "t_ll_M2"}],
-        [{"text": "M3", "callback_data": "t_ll_M3"},
-         {"text": "Chub", "callback_data": "t_ll_Chub"}],
-    ]
-    send_msg(chat_id, "Selecciona llenadora:", teclado_inline(filas))
+def mostrar_llenadoras_transito(chat_id, con_parcial=False):
+    teclado = TECLADO_LLENADORAS_TRANSITO_PARCIAL if con_parcial else TECLADO_LLENADORAS_TRANSITO
+    mostrar(chat_id, "Selecciona llenadora:\n\n💡 O escribe todos los lotes en un mensaje:\n`M1 12 p, M2 8 g, M3 20, Chub 5`", teclado)
 
-def mostrar_teclado_pin(chat_id, cantidad, medida):
+def mostrar_teclado_pin(chat_id, cantidad, medida, aviso=""):
     sugerido = pin_sugerido_para_medida(medida)
     b_peq = "🔩 Pin Pequeño"
     b_gra = "🔩 Pin Grande"
@@ -359,11 +497,11 @@ def mostrar_teclado_pin(chat_id, cantidad, medida):
         {"text": b_peq, "callback_data": "pin_pequeño"},
         {"text": b_gra, "callback_data": "pin_grande"},
     ]]
-    texto = f"✅ Canastas: {cantidad}\n📏 Medida: {medida}\n\n"
+    texto = aviso + f"✅ Canastas: {cantidad}\n📏 Medida: {medida}\n\n"
     if sugerido:
         texto += f"💡 Sugerido: *{sugerido}* (puedes cambiarlo)\n\n"
     texto += "🔧 Selecciona el tamaño del pin:"
-    send_msg(chat_id, texto, teclado_inline(filas), parse_mode="Markdown")
+    mostrar(chat_id, texto, teclado_inline(filas), parse_mode="Markdown")
 
 def mostrar_teclado_otro_lote_con_clave(chat_id, estado, prefijo_texto=""):
     txt = prefijo_texto.strip()
@@ -371,9 +509,8 @@ def mostrar_teclado_otro_lote_con_clave(chat_id, estado, prefijo_texto=""):
     cfg = get_config_turno().get(str(chat_id), {})
     ll = estado.get("llenadora")
     combo = cfg.get(ll, {})
-    catalogo = get_catalogo()
-    k = combo_key(combo.get("producto",""), combo.get("medida",""), combo.get("mercado",""))
-    cat = catalogo.get(k, {})
+    catalogo = CATALOGO.indice()
+    cat = catalogo.combo(combo.get("producto",""), combo.get("medida",""), combo.get("mercado","")) or {}
     sku, vida = cat.get("sku"), cat.get("vida_util_meses")
 
     if sku and vida and all(k in estado for k in ("pin",)) and combo.get("mercado"):
@@ -382,292 +519,488 @@ def mostrar_teclado_otro_lote_con_clave(chat_id, estado, prefijo_texto=""):
             txt += "\n\n"
         txt += f"🔑 Clave sugerida: *\n{md_escape(clave)}\n*"
 
-    filas = [[
-        {"text": "🔑 Ver clave del envase", "callback_data": "ver_clave"},
-    ],[
+    fila_extra = [{"text": "🔑 Ver clave del envase", "callback_data": "ver_clave"}]
+    if estado.get("totales", {}).get("lotes"):
+        fila_extra.append({"text": "📊 Ver parcial", "callback_data": "ver_parcial"})
+    filas = [fila_extra, [
         {"text": "✅ Sí", "callback_data": "otro_si"},
         {"text": "❌ No", "callback_data": "otro_no"},
     ]]
-    send_msg(chat_id, (txt + "\n\n➕ ¿Deseas agregar otro lote?").strip(), teclado_inline(filas), parse_mode=None)
-
-def construir_resumen_elegante(reportes, chat_id):
-    por_llenadora = {}
-    total_cajas = 0.0
-    total_canastas = 0
-    lineas = ["✅ *Resumen del turno:*"]
-    for idx, r in enumerate(reportes, 1):
-        llenadora = r["llenadora"]
-        canastas  = int(r["canastas"])
-        pin       = r["pin"]
-
-        # combo desde config_turno
+    mostrar(chat_id, (txt + "\n\n➕ ¿Deseas agregar otro lote?").strip(), teclado_inline(filas), parse_mode=None)
+
+# Cada lote cerrado queda en la bitácora (sobrevive reinicios, permite agregar por turno/semana)
+BITACORA = BitacoraLotes(BITACORA_DIR)
+
+# Progreso por semana y combo: cada lote suma a sus contadores (escritura diferida, solo la
+# semana tocada); el avance se lee de ahí, nunca recorriendo la bitácora
+_flush_progreso_semana = EscrituraDiferida(
+    "progreso_semana",
+    lambda data, claves=None: _save_json(PROGRESO_SEMANA_PATH, data, indent=None, claves=claves),
+    retardo=CONFIG_TURNO_DEBOUNCE_SEG,
+    max_retardo=CONFIG_TURNO_MAX_STALE_SEG,
+)
+AVANCE = AvanceSemanal(
+    _documento("progreso_semana", PROGRESO_SEMANA_PATH, _flush_progreso_semana),
+    lambda: _load_json(ORDENES_SEMANA_PATH, {}),
+    ventana_horas=AVANCE_VENTANA_HORAS,
+    recarga_ordenes=ORDENES_RECARGA_SEG,
+)
+
+# Canastas/h y cajas/h por chat y llenadora en ventanas deslizantes (memoria fija por serie);
+# al arrancar se rellenan con los lotes de las últimas 24 h de la bitácora
+RITMO = RitmoLlenadoras(TURNO_HORAS)
+try:
+    RITMO.cargar(BITACORA.consultar(desde=tz_now_gt() - timedelta(hours=24)))
+except Exception as e:
+    print("❗ Error recargando el ritmo desde la bitácora:", e)
+# Lotes que cierran otros procesos: entran al ritmo cuando esta bitácora los lee
+BITACORA.observadores.append(lambda r: RITMO.cargar([r]))
+
+def registrar_lote(chat_id, lote):
+    # `lote` viene de totales.acumular_lote: combo y cajas ya resueltos
+    producto, medida, mercado = lote["producto"], lote["medida"], lote["mercado"]
+    ts = tz_now_gt()
+    lote["ts"] = ts_texto(ts)
+    AVANCE.registrar(ts, combo_key(producto, medida, mercado), lote["cajas"], lote["canastas"])
+    RITMO.registrar(ts, chat_id, lote["llenadora"], lote["canastas"], lote["cajas"])
+    return BITACORA.registrar({
+        "ts": ts,
+        "chat_id": chat_id,
+        "llenadora": lote["llenadora"],
+        "producto": producto,
+        "medida": medida,
+        "mercado": mercado,
+        "combo": combo_key(producto, medida, mercado),
+        "canastas": lote["canastas"],
+        "pin": lote["pin"],
+        "cajas": lote["cajas"],
+        "sku": (CATALOGO.indice().combo(producto, medida, mercado) or {}).get("sku"),
+    })
+
+def construir_resumen_elegante(totales):
+    # Se arma con los acumulados de la sesión (ver totales.py): sin releer config ni recalcular
+    return texto_resumen(totales, md_escape)
+
+PASOS_TRANSITO = ("t_ll", "t_cantidad", "t_pin", "t_otro")
+
+USO_CLAVE = "Uso: `/clave M1 2026-10-13 03:40` (también `13/10 03:40`)"
+
+def clave_historica(chat_id, texto):
+    # Asignación vigente a esa hora según el historial (bisect) + la misma generación de clave
+    partes = texto.split(maxsplit=2)
+    ll = next((x for x in LLENADORAS if len(partes) > 1 and x.lower() == partes[1].lower()), None)
+    cuando = interpretar_fecha(partes[2], tz_now_gt()) if len(partes) > 2 else None
+    if not ll or not cuando:
+        send_msg(chat_id, f"⚠️ {USO_CLAVE}", parse_mode="Markdown")
+        return
+    r = HISTORIAL.vigente(chat_id, ll, cuando)
+    if not (r and r.get("sku") and r.get("vida_util_meses")):
+        send_msg(chat_id, f"⚠️ {md_escape(ll)} no tenía una asignación registrada el {cuando:%d/%m/%Y %H:%M}.", parse_mode="Markdown")
+        return
+    clave = generar_clave_envase(ll, r["mercado"], r["sku"], r["vida_util_meses"], fecha_ref=cuando)
+    desde = r["ts"].replace("T", " ")[:16]
+    send_msg(chat_id, f"🔑 Clave de {md_escape(ll)} el {cuando:%d/%m/%Y %H:%M}:\n```\n{clave}\n```\n"
+                      f"{md_escape(r['producto'])} {md_escape(r['medida'])} {md_escape(r['mercado'])} (asignado {desde})",
+             parse_mode="Markdown")
+
+def registrar_entrada_rapida(chat_id, estado, texto):
+    # Todos los lotes de un mensaje se validan antes de registrar el primero (ver entrada_rapida.py)
+    cfg = get_config_turno().get(str(chat_id), {})
+    lotes, errores = interpretar_lotes(texto, cfg, lambda medida: PIN_PERMITIDO_POR_MEDIDA.get(medida, set()))
+    if errores:
+        detalle = "\n".join(f"• {md_escape(e)}" for e in errores)
+        send_msg(chat_id, f"⚠️ No se registró ningún lote:\n{detalle}\n\nFormato: `M1 12 p, M2 8 g, M3 20, Chub 5`", parse_mode="Markdown")
+        return
+    # Se suman a los lotes ya cerrados en la sesión de tránsito en curso, si la hay
+    totales = (estado or {}).get("totales") or nuevos_totales()
+    for l in lotes:
+        por_canasta = CAJAS_POR_CANASTA.get(l["combo"].get("medida",""), {}).get(l["pin"], 0)
+        registrar_lote(chat_id, acumular_lote(totales, l["llenadora"], l["combo"], l["canastas"], l["pin"], por_canasta))
+    estados_usuarios.pop(chat_id, None)
+    send_msg(chat_id, construir_resumen_elegante(totales), parse_mode="Markdown", prioridad=MASIVO)
+
+# =========================
+# Handlers de updates
+# =========================
+def handle_message(message):
+    chat_id = message["chat"]["id"]
+    # El operador escribió: la respuesta va debajo de su mensaje, no editando uno anterior
+    PANTALLA.olvidar(chat_id)
+    texto = (message.get("text") or "").strip()
+    estado = estados_usuarios.get(chat_id)
+
+    if texto in ("/start", "/menu"):
+        mostrar_menu(chat_id)
+        return
+
+    # /clave M1 2026-10-13 03:40 -> la clave que se imprimía a esa hora
+    if texto.split(maxsplit=1)[:1] == ["/clave"]:
+        clave_historica(chat_id, texto)
+        return
+
+    # Entrada rápida: "M1 12 p, M2 8 g, M3 20, Chub 5" registra todos los lotes y devuelve el resumen.
+    # Solo sin flujo abierto o dentro de tránsito: un flujo de carga a medias no se pisa
+    if parece_entrada_rapida(texto) and (not estado or estado.get("paso") in PASOS_TRANSITO):
+        registrar_entrada_rapida(chat_id, estado, texto)
+        return
+
+    # Paso cantidad (tránsito)
+    if estado and estado.get("paso") == "t_cantidad":
+        try:
+            cantidad = int(texto)
+            if cantidad <= 0:
+                raise ValueError
+            estado["canastas"] = cantidad
+            ll = estado.get("llenadora")
+
+            if ll == "Chub":
+                estado["pin"] = "único"
+                # Validación
+                # Recuperar medida desde config
+                cfg = get_config_turno().get(str(chat_id), {})
+                medida = cfg.get(ll, {}).get("medida","")
+                if not pin_es_valido(medida, estado["pin"]):
+                    send_msg(chat_id, f"⚠️ Configuración inconsistente: {medida} no admite pin {estado['pin']}. Corrige la medida en Carga de datos.", parse_mode="Markdown")
+                    estados_usuarios.pop(chat_id, None)
+                    return
+                estado["paso"] = "t_otro"
+                mostrar_teclado_otro_lote_con_clave(
+                    chat_id, estado,
+                    f"✅ Canastas: {cantidad}\nPin asignado automáticamente: único 🔩"
+                )
+            elif ll == "M3":
+                estado["pin"] = "grande"
+                cfg = get_config_turno().get(str(chat_id), {})
+                medida = cfg.get(ll, {}).get("medida","")
+                if not pin_es_valido(medida, estado["pin"]):
+                    send_msg(chat_id, f"⚠️ Configuración inconsistente: {medida} no admite pin {estado['pin']}. Corrige la medida en Carga de datos.", parse_mode="Markdown")
+                    estados_usuarios.pop(chat_id, None)
+                    return
+                estado["paso"] = "t_otro"
+                mostrar_teclado_otro_lote_con_clave(
+                    chat_id, estado,
+                    f"✅ Canastas: {cantidad}\nPin asignado automáticamente: grande 🔩"
+                )
+            else:
+                # M1/M2 pedir pin
+                estado["paso"] = "t_pin"
+                cfg = get_config_turno().get(str(chat_id), {})
+                medida = cfg.get(ll, {}).get("medida","—")
+                mostrar_teclado_pin(chat_id, cantidad, medida)
+
+        except ValueError:
+            send_msg(chat_id, "❗ Ingresa un número válido de canastas (entero positivo).", parse_mode=None)
+
+
+# Callbacks de botones: cada ruta recibe (chat_id, estado, **args) ya parseados
+ROUTER = Enrutador("callbacks")
+
+# Menú principal
+@ROUTER.ruta("transito")
+def cb_transito(chat_id, estado):
+    estados_usuarios[chat_id] = {"paso": "t_ll"}
+    mostrar_llenadoras_transito(chat_id)
+
+@ROUTER.ruta("carga_menu")
+def cb_carga_menu(chat_id, estado):
+    mostrar_menu_carga(chat_id)
+
+@ROUTER.ruta("volver_menu")
+def cb_volver_menu(chat_id, estado):
+    mostrar_menu(chat_id)
+
+# Carga de datos: iniciar
+@ROUTER.ruta("carga_nuevo")
+def cb_carga_nuevo(chat_id, estado):
+    iniciar_carga(chat_id)
+
+# Carga de datos: Ver
+@ROUTER.ruta("carga_ver")
+def cb_carga_ver(chat_id, estado):
+    carga_ver(chat_id)
+
+# Carga NUEVO: elegir llenadora
+@ROUTER.ruta("c_n_ll_{ll}")
+def cb_carga_llenadora(chat_id, estado, ll):
+    estados_usuarios[chat_id] = {"paso":"carga_producto", "tmp":{"llenadora": ll}}
+    mostrar(chat_id, f"✅ Llenadora: {ll}\n\nElige *producto*:", teclado_productos(), parse_mode="Markdown")
+
+# Carga NUEVO: producto (medidas y mercados salen del catálogo)
+@ROUTER.ruta("c_n_p_{p}")
+def cb_carga_producto(chat_id, estado, p):
+    if estado and estado.get("paso") == "carga_producto":
+        estado["tmp"]["producto"] = p
+        avanzar_carga(chat_id, estado, f"✅ Producto: {p}")
+
+# Carga NUEVO: medida
+@ROUTER.ruta("c_n_m_{m}")
+def cb_carga_medida(chat_id, estado, m):
+    if estado and estado.get("paso") == "carga_medida":
+        estado["tmp"]["medida"] = m
+        avanzar_carga(chat_id, estado, f"✅ Medida: {m}")
+
+# Carga NUEVO: mercado
+@ROUTER.ruta("c_n_me_{me}")
+def cb_carga_mercado(chat_id, estado, me):
+    if estado and estado.get("paso") == "carga_mercado":
+        estado["tmp"]["mercado"] = me
+        guardar_carga(chat_id, estado)
+
+def avanzar_carga(chat_id, estado, texto):
+    # Pide el siguiente dato que falte; si el catálogo deja una sola opción, se elige sola
+    idx = CATALOGO.indice()
+    tmp = estado["tmp"]
+    for campo, opciones, paso, teclado in (
+        ("medida", lambda: idx.medidas(tmp["producto"]), "carga_medida",
+         lambda: teclado_medidas(tmp["producto"])),
+        ("mercado", lambda: idx.mercados(tmp["producto"], tmp["medida"]), "carga_mercado",
+         lambda: teclado_mercados(tmp["producto"], tmp["medida"])),
+    ):
+        if campo in tmp:
+            continue
+        valores = opciones()
+        if not valores:
+            send_msg(chat_id, f"⚠️ {' '.join(tmp.get(c, '') for c in ('producto', 'medida')).strip()} ya no está en el catálogo. Vuelve a *Cargar*.", parse_mode="Markdown")
+            estados_usuarios.pop(chat_id, None)
+            return
+        if len(valores) == 1:
+            tmp[campo] = valores[0]
+            texto += f"\n✅ {campo.capitalize()}: {valores[0]} (única opción en catálogo)"
+            continue
+        estado["paso"] = paso
+        mostrar(chat_id, f"{texto}\n\nElige *{campo}*:", teclado(), parse_mode="Markdown")
+        return
+    guardar_carga(chat_id, estado, texto)
+
+def guardar_carga(chat_id, estado, texto=""):
+    # Carga NUEVO: mercado -> guardar asignación si existe en catálogo
+    tmp = estado["tmp"]
+    p, m, me = tmp["producto"], tmp["medida"], tmp["mercado"]
+    k = combo_key(p,m,me)
+    catalogo = CATALOGO.indice()
+    cat = catalogo.combo(p, m, me)
+    if not cat or "sku" not in cat or "vida_util_meses" not in cat:
+        # No existe en catálogo -> pedir completar (MVP: mensaje)
+        send_msg(chat_id, f"⚠️ Este combo no existe en catálogo o está incompleto:\n{k}\nAgrega en {CATALOGO_SKUS_PATH} el *sku* y *vida_util_meses* y vuelve a intentar.", parse_mode="Markdown")
+        estados_usuarios.pop(chat_id, None)
+    else:
+        # Guardar en config_turno por chat y llenadora
+        ts = tz_now_gt()
+        set_config_llenadora(chat_id, tmp["llenadora"], {"producto": p, "medida": m, "mercado": me})
+        HISTORIAL.registrar(chat_id, tmp["llenadora"], {"producto": p, "medida": m, "mercado": me}, cat, ts=ts)
+
+        # Vista previa de clave
+        clave = generar_clave_envase(tmp["llenadora"], me, cat["sku"], cat["vida_util_meses"], fecha_ref=ts)
+        previo = f"{texto}\n\n" if texto else ""
+        PANTALLA.cerrar(chat_id)
+        send_msg(chat_id, f"{previo}✅ Configuración guardada para *{tmp['llenadora']}* → {p} {m} {me}\n\n🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode="Markdown")
+        estados_usuarios.pop(chat_id, None)
+        # refrescar menú con banner
+        mostrar_menu(chat_id)
+
+# Tránsito: elegir llenadora
+@ROUTER.ruta("t_ll_{ll}")
+def cb_transito_llenadora(chat_id, estado, ll):
+    # Verificar si hay config para esa llenadora
+    cfg = get_config_turno().get(str(chat_id), {})
+    combo = cfg.get(ll)
+    if not combo:
+        filas = [[{"text":"➕ Crear registro ahora","callback_data":"carga_nuevo"}],
+                 [{"text":"⬅️ Volver","callback_data":"volver_menu"}]]
+        mostrar(chat_id, f"⚠️ No hay registro para {ll}.\nUsa *Cargar* para asignar un producto/medida/mercado.", teclado_inline(filas), parse_mode="Markdown")
+    else:
+        # Pasar a pedir canastas
+        estados_usuarios[chat_id] = {"paso":"t_cantidad", "llenadora": ll,
+                                  "totales": (estado or {}).get("totales") or nuevos_totales()}
+        mostrar(chat_id, f"✅ {ll}: {combo['producto']} {combo['medida']} {combo['mercado']}\n\n🔢 ¿Cuántas canastas se reportaron?", parse_mode="Markdown")
+
+# Tránsito: selección de pin manual (M1/M2)
+@ROUTER.ruta("pin_{pin}")
+def cb_pin(chat_id, estado, pin):
+    if estado and estado.get("paso") == "t_pin":
+        ll = estado.get("llenadora")
         cfg = get_config_turno().get(str(chat_id), {})
-        combo = cfg.get(llenadora, {})
-        producto = combo.get("producto","—")
-        medida   = combo.get("medida","—")
-        mercado  = combo.get("mercado","—")
-
-        por_pin = CAJAS_POR_CANASTA.get(medida, {}).get(pin, 0)
-        cajas = canastas * por_pin
-
-        d = por_llenadora.setdefault(llenadora, {"cajas": 0.0, "canastas": 0})
-        d["cajas"] += cajas
-        d["canastas"] += canastas
-        total_cajas += cajas
-        total_canastas += canastas
-
-        lineas.append(
-            f"\n📦 *Lote {idx}*\n"
-            f"🔹 Llenadora: {md_escape(llenadora)}\n"
-            f"📏 Medida: {md_escape(medida)}\n"
-            f"🍲 Producto: {md_escape(producto)}\n"
-            f"🌎 Mercado: {md_escape(mercado)}\n"
-            f"🧺 Canastas: {canastas} | 🔩 Pin: {md_escape(pin)}\n"
-            f"📦 Cajas: *{int(cajas) if cajas.is_integer() else f'{cajas:.1f}'}* (≈ {int(por_pin) if isinstance(por_pin,(int,float)) and float(por_pin).is_integer() else por_pin} x canasta)"
-        )
-
-    lineas.append("\n— — —")
-    lineas.append("*Totales por llenadora*:")
-    for ll, d in por_llenadora.items():
-        cajas_fmt = int(d["cajas"]) if d["cajas"].is_integer() else f"{d['cajas']:.1f}"
-        lineas.append(f"• {md_escape(ll)} → 🧺 {d['canastas']} | 📦 {cajas_fmt}")
-
-    total_fmt = int(total_cajas) if total_cajas.is_integer() else f"{total_cajas:.1f}"
-    lineas.append("\n*Totales generales:*")
-    lineas.append(f"🧺 Canastas: *{total_canastas}*")
-    lineas.append(f"📦 Cajas: *{total_fmt}*")
+        medida = cfg.get(ll, {}).get("medida","—")
+        if not pin_es_valido(medida, pin):
+            mostrar_teclado_pin(chat_id, estado.get("canastas"), medida, aviso=f"⚠️ El pin *{pin}* no es válido para {medida}.\n\n")
+            return
+        estado["pin"] = pin
+        estado["paso"] = "t_otro"
+        mostrar_teclado_otro_lote_con_clave(chat_id, estado, f"✅ Pin: {pin}")
+
+# Tránsito: ver clave del envase (según config asignada)
+@ROUTER.ruta("ver_clave")
+def cb_ver_clave(chat_id, estado):
+    cfg = get_config_turno().get(str(chat_id), {})
+    ll = (estado or {}).get("llenadora")
+    combo = cfg.get(ll, {})
+    catalogo = CATALOGO.indice()
+    cat = catalogo.combo(combo.get("producto",""), combo.get("medida",""), combo.get("mercado","")) or {}
+    sku, vida = cat.get("sku"), cat.get("vida_util_meses")
+    if ll and combo and sku and vida:
+        clave = generar_clave_envase(ll, combo["mercado"], sku, vida)
+        send_msg(chat_id, f"🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode=None)
+    else:
+        send_msg(chat_id, "⚠️ Falta información en catálogo o configuración para generar la clave.")
+
+# Tránsito: otro lote / finalizar
+@ROUTER.ruta("otro_{opcion}")
+def cb_otro_lote(chat_id, estado, opcion):
+    if estado and estado.get("paso") in ("t_otro","t_pin","t_cantidad"):
+        # Necesitamos: llenadora, canastas, pin y combo desde config
+        ll = estado.get("llenadora")
+        cfg_all = get_config_turno()
+        cfg = cfg_all.get(str(chat_id), {})
+        combo = cfg.get(ll, {})
+        if not (ll and "canastas" in estado and "pin" in estado and combo):
+            send_msg(chat_id, "⚠️ Faltan datos para cerrar el lote.", parse_mode=None)
+            estados_usuarios.pop(chat_id, None)
+            return
+
+        # Acumular en reportes del estado
+        if "totales" not in estado:
+            estado["totales"] = nuevos_totales()
+        por_canasta = CAJAS_POR_CANASTA.get(combo.get("medida",""), {}).get(estado["pin"], 0)
+        lote = acumular_lote(estado["totales"], ll, combo, estado["canastas"], estado["pin"], por_canasta)
+        registrar_lote(chat_id, lote)
+
+        if opcion == "si":
+            # Nuevo lote
+            estados_usuarios[chat_id] = {"paso":"t_ll", "totales": estado["totales"]}  # los lotes previos siguen en la sesión
+            mostrar_llenadoras_transito(chat_id, con_parcial=True)
+        else:
+            # Resumen final
+            texto = construir_resumen_elegante(estado["totales"])
+            PANTALLA.cerrar(chat_id)
+            send_msg(chat_id, texto, parse_mode="Markdown", prioridad=MASIVO)
+            estados_usuarios.pop(chat_id, None)
+
+# Menú principal: producción de la semana vs. órdenes
+@ROUTER.ruta("avance_semana")
+def cb_avance_semana(chat_id, estado):
+    filas = [[{"text": "🔄 Actualizar", "callback_data": "avance_semana"}],
+             [{"text": "⬅️ Volver", "callback_data": "volver_menu"}]]
+    mostrar(chat_id, texto_avance(AVANCE.avance(ahora=tz_now_gt()), md_escape), teclado_inline(filas), parse_mode="Markdown")
+
+# Menú principal: canastas/h y cajas/h por llenadora (última hora, turno, día)
+@ROUTER.ruta("ritmo")
+def cb_ritmo(chat_id, estado):
+    filas = [[{"text": "🔄 Actualizar", "callback_data": "ritmo"}],
+             [{"text": "⬅️ Volver", "callback_data": "volver_menu"}]]
+    BITACORA.sincronizar()
+    mostrar(chat_id, texto_ritmo(RITMO.ritmos(tz_now_gt(), chat_id), RITMO.ventanas, md_escape), teclado_inline(filas), parse_mode="Markdown")
+
+# Tránsito: totales acumulados hasta ahora (el lote en curso aún no cuenta)
+@ROUTER.ruta("ver_parcial")
+def cb_ver_parcial(chat_id, estado):
+    totales = (estado or {}).get("totales")
+    if not (totales and totales["lotes"]):
+        send_msg(chat_id, "📊 Aún no hay lotes cerrados en este turno.", parse_mode=None)
+        return
+    send_msg(chat_id, texto_parcial(totales, md_escape), parse_mode="Markdown")
+
+def handle_callback(cq):
+    chat_id = cq["message"]["chat"]["id"]
+    # El mensaje del botón tocado pasa a ser el que se edita en el siguiente paso
+    PANTALLA.fijar(chat_id, cq["message"].get("message_id"))
+    answer_callback(cq["id"])
+    ROUTER.despachar(cq.get("data"), chat_id, estados_usuarios.get(chat_id))
+
+def chat_id_de_update(update):
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return None
+
+def procesar_update(update):
+    try:
+        if "message" in update:
+            handle_message(update["message"])
+        elif "callback_query" in update:
+            handle_callback(update["callback_query"])
+    except Exception as e:
+        print("❗ Error:", e)
+    finally:
+        # Persiste lo que el update tocó del estado (incluidas mutaciones en sitio)
+        estados_usuarios.confirmar()
+        # El mensaje activo no pasa al update siguiente (un callback fija el suyo, un mensaje
+        # empieza sin activo): da igual qué proceso atienda el próximo
+        chat_id = chat_id_de_update(update)
+        if chat_id is not None:
+            PANTALLA.olvidar(chat_id)
+
+# Offset de getUpdates: avanza (y se guarda) solo cuando los handlers de un update terminaron
+OFFSET = OffsetConfirmado(POLL_OFFSET_PATH)
+
+def procesar_y_confirmar(update):
+    try:
+        procesar_update(update)
+    finally:
+        OFFSET.terminar(update["update_id"])
 
-    return "\n".join(lineas)
+# Carriles por chat compartidos con el webhook (ver despacho.DespachadorPorChat)
+DESPACHADOR = DespachadorPorChat(procesar_y_confirmar, carriles=CARRILES_CHAT, nombre="polling")
 
 # =========================
 # Bot
 # =========================
+# En polling no hay /metrics: las estadísticas se imprimen cada ESTADISTICAS_LOG_SEG y al salir
+def reportar_estadisticas():
+    partes = []
+    for d in estadisticas_cache():
+        if "hits" in d:
+            partes.append(f"{d.get('documento', '?')} {d['hits']}/{d['hits'] + d['misses']} ({d['hit_ratio']:.0%})")
+    print("📊 Caché (hits/lecturas):", ", ".join(partes))
+    for metodo, r in sorted(TELEGRAM.estadisticas()["metodos"].items()):
+        print(f"📊 Telegram {metodo}: {r['llamadas']} llamadas, {r['errores']} errores | "
+              f"p50 {r['p50_ms']} ms, p95 {r['p95_ms']} ms, p99 {r['p99_ms']} ms, máx {r['max_ms']} ms")
+    rutas = ROUTER.estadisticas()
+    activas = {p: r for p, r in rutas["rutas"].items() if r["llamadas"]}
+    print(f"📊 Rutas de callbacks: {len(activas)} usadas, {rutas['sin_ruta']} sin ruta, {rutas['invalidos']} inválidos")
+    for patron, r in sorted(activas.items(), key=lambda x: -x[1]["llamadas"]):
+        print(f"   {patron}: {r['llamadas']} llamadas, {r['errores']} errores | prom {r['prom_ms']} ms, máx {r['max_ms']} ms")
+
+def despachar(update):
+    chat_id = chat_id_de_update(update)
+    if chat_id is None:
+        OFFSET.terminar(update["update_id"])
+        return
+    # Mismo chat -> mismo carril (orden estricto); chats distintos en paralelo.
+    # Si el carril está lleno se espera: el siguiente getUpdates se frena solo.
+    DESPACHADOR.encolar(chat_id, update, bloquear=True)
+
 def revisar_mensajes():
-    global last_update_id
+    # El siguiente getUpdates sale apenas se reparte el lote, mientras los carriles procesan.
+    # Se pide desde el mayor update visto + 1: los que siguen en vuelo ya quedaron en disco
+    # (OFFSET.asegurar) y, tras una caída, OFFSET.recuperar los vuelve a despachar.
+    pendientes = OFFSET.recuperar()
+    if pendientes:
+        print(f"♻️ Reprocesando {len(pendientes)} updates en vuelo de la ejecución anterior")
+    for update in pendientes:
+        despachar(update)
+
+    proximo_reporte = time.monotonic() + ESTADISTICAS_LOG_SEG
     while True:
+        if ESTADISTICAS_LOG_SEG > 0 and time.monotonic() >= proximo_reporte:
+            proximo_reporte = time.monotonic() + ESTADISTICAS_LOG_SEG
+            reportar_estadisticas()
         try:
-            params = {"timeout": POLL_TIMEOUT}
-            if last_update_id is not None:
-                params["offset"] = last_update_id
-            res = requests.get(f"{API_URL}/getUpdates", params=params, timeout=POLL_TIMEOUT+5)
-            data = res.json()
-
-            for update in data.get("result", []):
-                last_update_id = update["update_id"] + 1
-
-                # Mensajes
-                if "message" in update:
-                    message = update["message"]
-                    chat_id = message["chat"]["id"]
-                    texto = (message.get("text") or "").strip()
-                    estado = estados_usuarios.get(chat_id)
-
-                    if texto in ("/start", "/menu"):
-                        mostrar_menu(chat_id)
-                        continue
-
-                    # Paso cantidad (tránsito)
-                    if estado and estado.get("paso") == "t_cantidad":
-                        try:
-                            cantidad = int(texto)
-                            if cantidad <= 0:
-                                raise ValueError
-                            estado["canastas"] = cantidad
-                            ll = estado.get("llenadora")
-
-                            if ll == "Chub":
-                                estado["pin"] = "único"
-                                # Validación
-                                # Recuperar medida desde config
-                                cfg = get_config_turno().get(str(chat_id), {})
-                                medida = cfg.get(ll, {}).get("medida","")
-                                if not pin_es_valido(medida, estado["pin"]):
-                                    send_msg(chat_id, f"⚠️ Configuración inconsistente: {medida} no admite pin {estado['pin']}. Corrige la medida en Carga de datos.", parse_mode="Markdown")
-                                    estados_usuarios.pop(chat_id, None)
-                                    continue
-                                estado["paso"] = "t_otro"
-                                mostrar_teclado_otro_lote_con_clave(
-                                    chat_id, estado,
-                                    f"✅ Canastas: {cantidad}\nPin asignado automáticamente: único 🔩"
-                                )
-                            elif ll == "M3":
-                                estado["pin"] = "grande"
-                                cfg = get_config_turno().get(str(chat_id), {})
-                                medida = cfg.get(ll, {}).get("medida","")
-                                if not pin_es_valido(medida, estado["pin"]):
-                                    send_msg(chat_id, f"⚠️ Configuración inconsistente: {medida} no admite pin {estado['pin']}. Corrige la medida en Carga de datos.", parse_mode="Markdown")
-                                    estados_usuarios.pop(chat_id, None)
-                                    continue
-                                estado["paso"] = "t_otro"
-                                mostrar_teclado_otro_lote_con_clave(
-                                    chat_id, estado,
-                                    f"✅ Canastas: {cantidad}\nPin asignado automáticamente: grande 🔩"
-                                )
-                            else:
-                                # M1/M2 pedir pin
-                                estado["paso"] = "t_pin"
-                                cfg = get_config_turno().get(str(chat_id), {})
-                                medida = cfg.get(ll, {}).get("medida","—")
-                                mostrar_teclado_pin(chat_id, cantidad, medida)
-
-                        except ValueError:
-                            send_msg(chat_id, "❗ Ingresa un número válido de canastas (entero positivo).", parse_mode=None)
-
-                # Callbacks
-                elif "callback_query" in update:
-                    cq = update["callback_query"]
-                    chat_id = cq["message"]["chat"]["id"]
-                    callback_data = cq["data"]
-                    answer_callback(cq["id"])
-                    estado = estados_usuarios.get(chat_id)
-
-                    # Menú principal
-                    if callback_data == "transito":
-                        estados_usuarios[chat_id] = {"paso": "t_ll"}
-                        mostrar_llenadoras_transito(chat_id)
-
-                    elif callback_data == "carga_menu":
-                        mostrar_menu_carga(chat_id)
-
-                    elif callback_data == "volver_menu":
-                        mostrar_menu(chat_id)
-
-                    # Carga de datos: iniciar
-                    elif callback_data == "carga_nuevo":
-                        iniciar_carga(chat_id)
-
-                    # Carga de datos: Ver
-                    elif callback_data == "carga_ver":
-                        carga_ver(chat_id)
-
-                    # Carga NUEVO: elegir llenadora
-                    elif callback_data.startswith("c_n_ll_"):
-                        ll = callback_data.split("_", 2)[2]
-                        estados_usuarios[chat_id] = {"paso":"carga_producto", "tmp":{"llenadora": ll}}
-                        send_msg(chat_id, f"✅ Llenadora: {ll}\n\nElige *producto*:", teclado_productos(), parse_mode="Markdown")
-
-                    # Carga NUEVO: producto
-                    elif callback_data.startswith("c_n_p_"):
-                        p = callback_data.split("_", 2)[2]
-                        if estado and estado.get("paso") == "carga_producto":
-                            estado["tmp"]["producto"] = p
-                            estado["paso"] = "carga_medida"
-                            send_msg(chat_id, f"✅ Producto: {p}\n\nElige *medida*:", teclado_medidas(), parse_mode="Markdown")
-
-                    # Carga NUEVO: medida
-                    elif callback_data.startswith("c_n_m_"):
-                        m = callback_data.split("_", 2)[2]
-                        if estado and estado.get("paso") == "carga_medida":
-                            estado["tmp"]["medida"] = m
-                            estado["paso"] = "carga_mercado"
-                            send_msg(chat_id, f"✅ Medida: {m}\n\nElige *mercado*:", teclado_mercados(), parse_mode="Markdown")
-
-                    # Carga NUEVO: mercado -> guardar asignación si existe en catálogo
-                    elif callback_data.startswith("c_n_me_"):
-                        me = callback_data.split("_", 3)[3]
-                        if estado and estado.get("paso") == "carga_mercado":
-                            tmp = estado["tmp"]
-                            tmp["mercado"] = me
-                            p, m, me = tmp["producto"], tmp["medida"], tmp["mercado"]
-                            k = combo_key(p,m,me)
-                            catalogo = get_catalogo()
-                            cat = catalogo.get(k)
-                            if not cat or "sku" not in cat or "vida_util_meses" not in cat:
-                                # No existe en catálogo -> pedir completar (MVP: mensaje)
-                                send_msg(chat_id, f"⚠️ Este combo no existe en catálogo o está incompleto:\n{k}\nAgrega en {CATALOGO_SKUS_PATH} el *sku* y *vida_util_meses* y vuelve a intentar.", parse_mode="Markdown")
-                                estados_usuarios.pop(chat_id, None)
-                            else:
-                                # Guardar en config_turno por chat y llenadora
-                                cfg = get_config_turno()
-                                por_chat = cfg.get(str(chat_id), {})
-                                por_chat[tmp["llenadora"]] = {"producto": p, "medida": m, "mercado": me}
-                                cfg[str(chat_id)] = por_chat
-                                set_config_turno(cfg)
-
-                                # Vista previa de clave
-                                clave = generar_clave_envase(tmp["llenadora"], me, cat["sku"], cat["vida_util_meses"])
-                                send_msg(chat_id, f"✅ Configuración guardada para *{tmp['llenadora']}* → {p} {m} {me}\n\n🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode="Markdown")
-                                estados_usuarios.pop(chat_id, None)
-                                # refrescar menú con banner
-                                mostrar_menu(chat_id)
-
-                    # Tránsito: elegir llenadora
-                    elif callback_data.startswith("t_ll_"):
-                        ll = callback_data.split("_", 2)[2]
-                        # Verificar si hay config para esa llenadora
-                        cfg = get_config_turno().get(str(chat_id), {})
-                        combo = cfg.get(ll)
-                        if not combo:
-                            filas = [[{"text":"➕ Crear registro ahora","callback_data":"carga_nuevo"}],
-                                     [{"text":"⬅️ Volver","callback_data":"volver_menu"}]]
-                            send_msg(chat_id, f"⚠️ No hay registro para {ll}.\nUsa *Cargar* para asignar un producto/medida/mercado.", teclado_inline(filas), parse_mode="Markdown")
-                        else:
-                            # Pasar a pedir canastas
-                            estados_usuarios[chat_id] = {"paso":"t_cantidad", "llenadora": ll, "reportes": []}
-                            send_msg(chat_id, f"✅ {ll}: {combo['producto']} {combo['medida']} {combo['mercado']}\n\n🔢 ¿Cuántas canastas se reportaron?", parse_mode="Markdown")
-
-                    # Tránsito: selección de pin manual (M1/M2)
-                    elif callback_data.startswith("pin_"):
-                        pin = callback_data.split("_", 1)[1]
-                        if estado and estado.get("paso") == "t_pin":
-                            ll = estado.get("llenadora")
-                            cfg = get_config_turno().get(str(chat_id), {})
-                            medida = cfg.get(ll, {}).get("medida","—")
-                            if not pin_es_valido(medida, pin):
-                                send_msg(chat_id, f"⚠️ El pin *{pin}* no es válido para {medida}.", parse_mode="Markdown")
-                                mostrar_teclado_pin(chat_id, estado.get("canastas"), medida)
-                                continue
-                            estado["pin"] = pin
-                            estado["paso"] = "t_otro"
-                            mostrar_teclado_otro_lote_con_clave(chat_id, estado, f"✅ Pin: {pin}")
-
-                    # Tránsito: ver clave del envase (según config asignada)
-                    elif callback_data == "ver_clave":
-                        cfg = get_config_turno().get(str(chat_id), {})
-                        estado = estados_usuarios.get(chat_id, {})
-                        ll = estado.get("llenadora")
-                        combo = cfg.get(ll, {})
-                        catalogo = get_catalogo()
-                        k = combo_key(combo.get("producto",""), combo.get("medida",""), combo.get("mercado",""))
-                        cat = catalogo.get(k, {})
-                        sku, vida = cat.get("sku"), cat.get("vida_util_meses")
-                        if ll and combo and sku and vida:
-                            clave = generar_clave_envase(ll, combo["mercado"], sku, vida)
-                            send_msg(chat_id, f"🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode=None)
-                        else:
-                            send_msg(chat_id, "⚠️ Falta información en catálogo o configuración para generar la clave.")
-
-                    # Tránsito: otro lote / finalizar
-                    elif callback_data.startswith("otro_"):
-                        if estado and estado.get("paso") in ("t_otro","t_pin","t_cantidad"):
-                            # Necesitamos: llenadora, canastas, pin y combo desde config
-                            ll = estado.get("llenadora")
-                            cfg_all = get_config_turno()
-                            cfg = cfg_all.get(str(chat_id), {})
-                            combo = cfg.get(ll, {})
-                            if not (ll and "canastas" in estado and "pin" in estado and combo):
-                                send_msg(chat_id, "⚠️ Faltan datos para cerrar el lote.", parse_mode=None)
-                                estados_usuarios.pop(chat_id, None)
-                                continue
-
-                            # Acumular en reportes del estado
-                            if "reportes" not in estado:
-                                estado["reportes"] = []
-                            estado["reportes"].append({
-                                "llenadora": ll,
-                                "canastas": int(estado["canastas"]),
-                                "pin": estado["pin"],
-                            })
-
-                            if callback_data == "otro_si":
-                                # Nuevo lote
-                                estados_usuarios[chat_id] = {"paso":"t_ll"}  # permite cambiar de llenadora si se desea
-                                mostrar_llenadoras_transito(chat_id)
-                            else:
-                                # Resumen final
-                                texto = construir_resumen_elegante(estado["reportes"], chat_id)
-                                send_msg(chat_id, texto, parse_mode="Markdown")
-                                estados_usuarios.pop(chat_id, None)
+            params = {"timeout": POLL_TIMEOUT, "limit": POLL_LIMITE, "allowed_updates": UPDATES_PERMITIDOS}
+            desde = OFFSET.siguiente()
+            if desde is not None:
+                params["offset"] = desde
+            data = TELEGRAM.llamar("getUpdates", params, timeout_lectura=POLL_TIMEOUT+5)
+            if data is None:
+                time.sleep(2)
+                continue
+
+            # Los duplicados solo aparecen si un asegurar() anterior falló y se repidió el lote
+            nuevos = [u for u in data.get("result", []) if OFFSET.registrar(u["update_id"], u)]
+            if nuevos and not OFFSET.asegurar():
+                print("❗ No se pudo guardar el offset; se vuelve a pedir el mismo lote")
+            for update in nuevos:
+                despachar(update)
 
         except Exception as e:
             print("❗ Error:", e)
@@ -688,7 +1021,9 @@ if __name__ == "__main__":
         (ORDENES_SEMANA_PATH, {}),
         (PROGRESO_SEMANA_PATH, {}),
     ]:
-        if not os.path.exists(path):
-            _save_json(path, default)
+        ALMACEN.asegurar(path, default)
+    # SIGTERM -> salida normal para que corran los vaciados de atexit
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    atexit.register(reportar_estadisticas)
     # Loop
     revisar_mensajes()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Catálogo de SKUs indexado y con recarga en caliente
+- El documento plano {"producto|medida|mercado": {sku, vida_util_meses, ...}} se indexa
+  al cargar: combo -> entrada, producto -> medidas -> mercados y SKU -> combo
+- Las consultas son lecturas de dict sobre un índice inmutable (sin E/S ni locks)
+- Recarga: como mucho una vez por intervalo se compara mtime/inode/tamaño del archivo
+  (o la versión en SQLite);
+  si cambió, se carga, se valida y recién entonces se reemplaza el índice de una vez.
+  Un archivo inválido (p. ej. a medio editar) se rechaza y queda el índice anterior
+- Teclados derivados del catálogo serializados una vez y reutilizados hasta que cambie
+"""
+
+import os
+import json
+import time
+import threading
+
+from persistencia import Contador
+
+
+def _revisar_entradas(datos):
+    """(clave, [errores]) por entrada; un SKU repetido cuenta contra la segunda entrada."""
+    skus = {}
+    for k, v in datos.items():
+        errores = []
+        partes = k.split("|") if isinstance(k, str) else []
+        if len(partes) != 3 or not all(partes):
+            yield k, [f"clave inválida (se espera producto|medida|mercado): {k}"]
+            continue
+        if not isinstance(v, dict):
+            yield k, [f"{k}: la entrada debe ser un objeto"]
+            continue
+        sku = v.get("sku")
+        if sku is not None:
+            if not isinstance(sku, (str, int)) or not str(sku).strip():
+                errores.append(f"{k}: sku inválido")
+            elif str(sku) in skus:
+                errores.append(f"{k}: sku {sku} repetido (ya está en {skus[str(sku)]})")
+        vida = v.get("vida_util_meses")
+        if vida is not None and (isinstance(vida, bool) or not isinstance(vida, int) or vida <= 0):
+            errores.append(f"{k}: vida_util_meses debe ser un entero positivo")
+        if not errores and sku is not None:
+            skus[str(sku)] = k
+        yield k, errores
+
+
+def validar_catalogo(datos):
+    """Devuelve la lista de errores (vacía si el catálogo es utilizable)."""
+    if not isinstance(datos, dict):
+        return ["el catálogo debe ser un objeto JSON"]
+    return [e for _, errores in _revisar_entradas(datos) for e in errores]
+
+
+def entradas_validas(datos):
+    """Solo las entradas sin errores (un catálogo no-objeto queda vacío)."""
+    if not isinstance(datos, dict):
+        return {}
+    return {k: datos[k] for k, errores in _revisar_entradas(datos) if not errores}
+
+
+class IndiceCatalogo:
+    """Instantánea inmutable del catálogo con sus índices. No mutar."""
+
+    def __init__(self, datos, version=0):
+        self.datos = datos
+        self.version = version
+        self._combos = {}
+        self.arbol = {}    # producto -> medida -> mercado -> entrada
+        self.por_sku = {}  # sku -> (producto, medida, mercado)
+        for k, v in datos.items():
+            p, m, me = k.split("|")
+            self._combos[(p, m, me)] = v
+            self.arbol.setdefault(p, {}).setdefault(m, {})[me] = v
+            if v.get("sku") is not None:
+                self.por_sku[str(v["sku"])] = (p, m, me)
+
+    def combo(self, producto, medida, mercado):
+        return self._combos.get((producto, medida, mercado))
+
+    def productos(self):
+        return list(self.arbol)
+
+    def medidas(self, producto):
+        return list(self.arbol.get(producto, {}))
+
+    def mercados(self, producto, medida):
+        return list(self.arbol.get(producto, {}).get(medida, {}))
+
+    def combo_de_sku(self, sku):
+        return self.por_sku.get(str(sku))
+
+    def __len__(self):
+        return len(self._combos)
+
+
+class CatalogoRecargable:
+    """Sirve el IndiceCatalogo vigente y lo recarga si el archivo cambió.
+
+    `cargar()` debe lanzar si el archivo no se puede leer (un JSON roto no puede
+    confundirse con un catálogo vacío). Se recarga cuando cambia la firma de
+    `ruta_vigilada` (mtime/inode/tamaño) o, si se pasa, la que devuelve `firma()`
+    (p. ej. la versión en SQLite, que cambia cuando otro proceso guarda el catálogo).
+    Sin ninguna de las dos no hay recarga.
+    """
+
+    def __init__(self, cargar, guardar, ruta_vigilada=None, intervalo=2.0, firma=None):
+        self._cargar = cargar
+        self._guardar = guardar
+        self.ruta = ruta_vigilada
+        self._firma_fn = firma or (self._firma_archivo if ruta_vigilada else None)
+        self.intervalo = intervalo
+        self._indice = None
+        self._firma = None
+        self._proxima_revision = 0.0
+        self._lock = threading.Lock()
+        self._version = 0
+        self.revisiones = Contador()
+        self.recargas = Contador()
+        self.rechazos = Contador()
+
+    def _firma_archivo(self):
+        try:
+            st = os.stat(self.ruta)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def _firma_actual(self):
+        if self._firma_fn is None:
+            return None
+        try:
+            return self._firma_fn()
+        except Exception:
+            return None
+
+    def indice(self):
+        idx = self._indice
+        if idx is None:
+            with self._lock:
+                if self._indice is None:
+                    self._firma = self._firma_actual()
+                    self._proxima_revision = time.monotonic() + self.intervalo
+                    try:
+                        datos = self._cargar()
+                    except Exception as e:
+                        print("❗ Error cargando catálogo:", e)
+                        datos = {}
+                    errores = validar_catalogo(datos)
+                    if errores:
+                        # Sin índice anterior al que volver: se publican solo las entradas válidas
+                        print("⚠️ Catálogo con errores (se ignoran esas entradas):", "; ".join(errores[:5]))
+                        datos = entradas_validas(datos)
+                    self._publicar(datos)
+                return self._indice
+        if self._firma_fn and time.monotonic() >= self._proxima_revision:
+            self._revisar()
+        return self._indice
+
+    def _publicar(self, datos):
+        self._version += 1
+        self._indice = IndiceCatalogo(datos, self._version)
+
+    def _revisar(self):
+        # Solo un hilo revisa; los demás siguen con el índice vigente
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._proxima_revision = time.monotonic() + self.intervalo
+            self.revisiones.inc()
+            firma = self._firma_actual()
+            if firma is None or firma == self._firma:
+                return
+            self._firma = firma  # aunque se rechace: se reintenta cuando vuelva a cambiar
+            try:
+                datos = self._cargar()
+            except Exception as e:
+                self.rechazos.inc()
+                print("⚠️ Catálogo no recargado (no se pudo leer):", e)
+                return
+            errores = validar_catalogo(datos)
+            if errores:
+                self.rechazos.inc()
+                print("⚠️ Catálogo no recargado:", "; ".join(errores[:5]))
+                return
+            self._publicar(datos)
+            self.recargas.inc()
+        finally:
+            self._lock.release()
+
+    def escribir(self, datos):
+        errores = validar_catalogo(datos)
+        if errores:
+            print("⚠️ Catálogo no guardado:", "; ".join(errores[:5]))
+            return False
+        with self._lock:
+            ok = self._guardar(datos)
+            self._publicar(datos)
+            self._firma = self._firma_actual()
+            return ok
+
+    def estadisticas(self):
+        idx = self._indice
+        return {
+            "documento": "catalogo",
+            "version": idx.version if idx else 0,
+            "combos": len(idx) if idx else 0,
+            "revisiones": self.revisiones.valor(),
+            "recargas": self.recargas.valor(),
+            "rechazos": self.rechazos.valor(),
+        }
+
+
+def serializar_teclado(filas):
+    # reply_markup ya como texto JSON: la Bot API lo acepta así y no se re-serializa en cada envío
+    return json.dumps({"inline_keyboard": filas}, ensure_ascii=False, separators=(",", ":"))
+
+
+class CacheTeclados:
+    """reply_markup serializados por clave, válidos mientras no cambie la versión del catálogo.
+
+    `obtener(clave, construir)` llama a construir(indice) -> filas solo la primera vez
+    para esa versión del catálogo.
+    """
+
+    def __init__(self, catalogo):
+        self.catalogo = catalogo
+        self._version = None
+        self._teclados = {}
+        self.hits = Contador()
+        self.construidos = Contador()
+
+    def obtener(self, clave, construir):
+        idx = self.catalogo.indice()
+        teclados = self._teclados
+        if self._version != idx.version:
+            # Catálogo nuevo: se descarta todo (se publica un dict nuevo, sin mutar el que leen otros hilos)
+            teclados = {}
+            self._teclados, self._version = teclados, idx.version
+        t = teclados.get(clave)
+        if t is None:
+            t = teclados[clave] = serializar_teclado(construir(idx))
+            self.construidos.inc()
+        else:
+            self.hits.inc()
+        return t
+
+    def estadisticas(self):
+        return {"version": self._version, "teclados": len(self._teclados),
+                "hits": self.hits.valor(), "construidos": self.construidos.valor()}
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Claves de envase (3 líneas impresas en la lata)
+  B 06:40 26 L 291        letra de llenadora, hora, año, día juliano
+  EXP 15 ABR 27           vencimiento (día 15 fijo); FDA: "BEST BY" y mes en inglés
+  6173 194916             SKU
+- Calendario precalculado por año: día juliano de cada fecha y, por vida útil,
+  la línea de vencimiento de cada mes de producción (no se recalcula por clave)
+- Claves memorizadas por (llenadora, mercado, SKU, vida útil, minuto) con LRU
+- Series para impresoras de etiquetas: todas las claves de un rango (cada N minutos),
+  armadas por día sobre las tablas y escritas en streaming como CSV o JSONL
+
+Uso como script (lee config_turno/catálogo con ALMACEN_BACKEND/SQLITE_PATH como los bots):
+  python claves_envase.py exportar CHAT_ID 2026-10-18T06:00 2026-10-18T14:00 \
+      [--llenadora M1] [--paso 1] [--formato csv|jsonl] [--salida claves.csv]
+  python claves_envase.py clave CHAT_ID M1 2026-10-13T03:40 [--historial historial_config.jsonl]
+      (la clave de esa hora según el historial de asignaciones, ver historial_config.py)
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+LETRA_LLENADORA = {"M1":"B", "M2":"C", "M3":"D"}  # Chub pendiente
+LLENADORAS = ["M1", "M2", "M3", "Chub"]
+
+# "HH:MM" de cada minuto del día
+HHMM = [f"{h:02d}:{m:02d}" for h in range(24) for m in range(60)]
+
+MESES_ES = ["ENE","FEB","MAR","ABR","MAY","JUN","JUL","AGO","SEP","OCT","NOV","DIC"]
+MESES_EN = ["JAN","FEB","MAR","APR","MAY","JUN","JUL","AUG","SEP","OCT","NOV","DEC"]
+
+
+class CalendarioAnio:
+    """Tablas de un año de producción."""
+
+    def __init__(self, anio, vidas=()):
+        self.anio = anio
+        self.yy = f"{anio % 100:02d}"
+        # inicio_mes[m] + día = día juliano (m = 1..12)
+        self.inicio_mes = [0] * 13
+        for m in range(2, 13):
+            self.inicio_mes[m] = (datetime(anio, m, 1) - datetime(anio, 1, 1)).days
+        self._lock = threading.Lock()
+        self._venc = {}  # (vida, fda) -> [línea 2 por mes 1..12]
+        for vida in vidas:
+            self.lineas_vencimiento(vida, False)
+            self.lineas_vencimiento(vida, True)
+
+    def dia_juliano(self, mes, dia):
+        return self.inicio_mes[mes] + dia
+
+    def lineas_vencimiento(self, vida, fda):
+        lineas = self._venc.get((vida, fda))
+        if lineas is None:
+            lineas = [None]
+            for mes in range(1, 13):
+                y = self.anio + (mes - 1 + vida) // 12
+                m = (mes - 1 + vida) % 12 + 1
+                if fda:
+                    lineas.append(f"BEST BY 15 {MESES_EN[m - 1]} {y % 100:02d}")
+                else:
+                    lineas.append(f"EXP 15 {MESES_ES[m - 1]} {y % 100:02d}")
+            with self._lock:
+                lineas = self._venc.setdefault((vida, fda), lineas)
+        return lineas
+
+
+class GeneradorClaves:
+    """`clave()` devuelve exactamente lo mismo que la versión original de generar_clave_envase.
+
+    letras: llenadora -> letra de la línea 1 (Chub usa `letra_chub` o "—").
+    vidas: función opcional que devuelve las vidas útiles del catálogo, para
+    precalcular sus vencimientos al crear el calendario de cada año.
+    """
+
+    def __init__(self, letras, vidas=None, max_claves=4096):
+        self.letras = dict(letras)
+        self._vidas = vidas or (lambda: ())
+        self._anios = {}
+        self._lock = threading.Lock()
+        self._clave_minuto = lru_cache(maxsize=max_claves)(self._calcular)
+
+    def calendario(self, anio):
+        cal = self._anios.get(anio)
+        if cal is None:
+            with self._lock:
+                cal = self._anios.get(anio)
+                if cal is None:
+                    cal = self._anios[anio] = CalendarioAnio(anio, set(self._vidas()))
+        return cal
+
+    def letra(self, llenadora, letra_chub=None):
+        if llenadora == "Chub":
+            return letra_chub if letra_chub else "—"  # pendiente
+        return self.letras.get(llenadora, "—")
+
+    def clave(self, llenadora, mercado, sku, vida_util_meses, fecha_ref=None, letra_chub=None):
+        ahora = fecha_ref or datetime.now()
+        return self._clave_minuto(llenadora, mercado == "FDA", sku, vida_util_meses, letra_chub,
+                                  ahora.year, ahora.month, ahora.day, ahora.hour, ahora.minute)
+
+    def _calcular(self, llenadora, fda, sku, vida, letra_chub, anio, mes, dia, hora, minuto):
+        cal = self.calendario(anio)
+        linea1 = f"{self.letra(llenadora, letra_chub)} {hora:02d}:{minuto:02d} {cal.yy} L {cal.dia_juliano(mes, dia)}"
+        linea2 = cal.lineas_vencimiento(vida, fda)[mes]
+        return f"{linea1}\n{linea2}\n6173 {sku}"
+
+    def serie_lineas(self, llenadora, mercado, sku, vida_util_meses, desde, hasta, paso_min=1, letra_chub=None):
+        """(ts "YYYY-MM-DDTHH:MM", línea 1, línea 2, línea 3) para desde <= ts < hasta cada paso_min.
+
+        No pasa por la caché: por cada día se arman una vez las partes fijas (juliano,
+        vencimiento, SKU) y por minuto solo se concatena la hora.
+        """
+        paso = max(1, int(paso_min))
+        desde = desde.replace(second=0, microsecond=0) + (timedelta(minutes=1) if desde.second or desde.microsecond else timedelta(0))
+        pre = f"{self.letra(llenadora, letra_chub)} "
+        linea3 = f"6173 {sku}"
+        fda = mercado == "FDA"
+        dia = datetime(desde.year, desde.month, desde.day)
+        minuto = desde.hour * 60 + desde.minute
+        while dia < hasta:
+            restante = (hasta - dia).total_seconds() / 60.0
+            fin = 1440 if restante >= 1440 else int(-(-restante // 1))
+            if minuto < fin:
+                cal = self.calendario(dia.year)
+                fecha = dia.strftime("%Y-%m-%dT")
+                suf = f" {cal.yy} L {cal.dia_juliano(dia.month, dia.day)}"
+                linea2 = cal.lineas_vencimiento(vida_util_meses, fda)[dia.month]
+                for hm in HHMM[minuto:fin:paso]:
+                    yield fecha + hm, pre + hm + suf, linea2, linea3
+            if minuto < 1440:
+                minuto += paso * -(-(1440 - minuto) // paso)
+            minuto -= 1440
+            dia += timedelta(days=1)
+
+    def serie(self, llenadora, mercado, sku, vida_util_meses, desde, hasta, paso_min=1, letra_chub=None):
+        """(ts, clave) con el mismo texto que clave(); ver serie_lineas."""
+        for ts, l1, l2, l3 in self.serie_lineas(llenadora, mercado, sku, vida_util_meses, desde, hasta, paso_min, letra_chub):
+            yield ts, f"{l1}\n{l2}\n{l3}"
+
+    def estadisticas(self):
+        info = self._clave_minuto.cache_info()
+        total = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_ratio": round(info.hits / total, 4) if total else 0.0,
+            "en_cache": info.currsize,
+            "anios": sorted(self._anios),
+        }
+
+
+# =========================
+# Exportación por lotes
+# =========================
+def asignaciones_de_config(cfg_chat, catalogo, llenadora=None):
+    """Combos asignados a las llenadoras de un chat (config_turno[chat_id]) con su SKU y vida útil.
+
+    Se omiten las llenadoras sin asignación o cuyo combo está incompleto en el catálogo.
+    """
+    salida = []
+    for ll in ([llenadora] if llenadora else LLENADORAS):
+        combo = cfg_chat.get(ll)
+        if not combo:
+            continue
+        cat = catalogo.get(f"{combo.get('producto','')}|{combo.get('medida','')}|{combo.get('mercado','')}", {})
+        if not (cat.get("sku") and cat.get("vida_util_meses")):
+            continue
+        salida.append({"llenadora": ll, "producto": combo["producto"], "medida": combo["medida"],
+                       "mercado": combo["mercado"], "sku": cat["sku"], "vida_util_meses": cat["vida_util_meses"]})
+    return salida
+
+
+COLUMNAS = ["ts", "llenadora", "producto", "medida", "mercado", "sku", "linea1", "linea2", "linea3"]
+
+def exportar_claves(generador, asignaciones, desde, hasta, salida, formato="csv", paso_min=1, letra_chub=None):
+    """Escribe en `salida` (archivo de texto) las claves de cada asignación, por llenadora y en orden de tiempo.
+
+    Se genera y escribe fila por fila: la memoria no crece con el rango. Devuelve las filas escritas.
+    """
+    n = 0
+    if formato == "csv":
+        w = csv.writer(salida)
+        w.writerow(COLUMNAS)
+    for a in asignaciones:
+        fijos = [a["llenadora"], a["producto"], a["medida"], a["mercado"], a["sku"]]
+        filas = generador.serie_lineas(a["llenadora"], a["mercado"], a["sku"], a["vida_util_meses"],
+                                       desde, hasta, paso_min, letra_chub)
+        if formato == "csv":
+            for ts, l1, l2, l3 in filas:
+                w.writerow([ts, *fijos, l1, l2, l3])
+                n += 1
+        else:
+            # Partes fijas serializadas una vez por llenadora
+            medio = json.dumps(dict(zip(COLUMNAS[1:6], fijos)), ensure_ascii=False)[1:-1]
+            for ts, l1, l2, l3 in filas:
+                salida.write(f'{{"ts": "{ts}", {medio}, "linea1": {json.dumps(l1, ensure_ascii=False)}, '
+                             f'"linea2": "{l2}", "linea3": {json.dumps(l3, ensure_ascii=False)}}}\n')
+                n += 1
+    return n
+
+
+def _fecha(texto):
+    return datetime.fromisoformat(texto)
+
+
+def _clave_historica(args):
+    from historial_config import HistorialConfig, interpretar_fecha
+    cuando = interpretar_fecha(args.fecha)
+    if cuando is None:
+        print(f"⚠️ Fecha no reconocida: {args.fecha}", file=sys.stderr)
+        return 2
+    r = HistorialConfig(args.historial).vigente(args.chat_id, args.llenadora, cuando)
+    if not (r and r.get("sku") and r.get("vida_util_meses")):
+        print(f"⚠️ {args.llenadora} no tenía una asignación registrada en el chat {args.chat_id} a esa hora.", file=sys.stderr)
+        return 1
+    generador = GeneradorClaves(LETRA_LLENADORA, vidas=lambda: {r["vida_util_meses"]})
+    print(generador.clave(args.llenadora, r["mercado"], r["sku"], r["vida_util_meses"], cuando, args.letra_chub))
+    print(f"# {r['producto']} {r['medida']} {r['mercado']} asignado {r['ts']}", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="claves_envase.py", description="Series de claves de envase para impresión")
+    sub = ap.add_subparsers(dest="comando")
+    ex = sub.add_parser("exportar", help="claves de un rango de tiempo según config_turno de un chat")
+    ex.add_argument("chat_id")
+    ex.add_argument("desde", type=_fecha, help="inicio (incluido), ej. 2026-10-18T06:00")
+    ex.add_argument("hasta", type=_fecha, help="fin (excluido)")
+    ex.add_argument("--llenadora", choices=LLENADORAS, help="solo esta llenadora (por defecto todas)")
+    ex.add_argument("--paso", type=int, default=1, help="minutos entre claves (por defecto 1)")
+    ex.add_argument("--formato", choices=["csv", "jsonl"], default="csv")
+    ex.add_argument("--salida", help="archivo de salida (por defecto stdout)")
+    ex.add_argument("--letra-chub", help="letra de línea 1 para Chub")
+    cl = sub.add_parser("clave", help="la clave que se imprimía a una hora pasada (historial de config)")
+    cl.add_argument("chat_id")
+    cl.add_argument("llenadora", choices=LLENADORAS)
+    cl.add_argument("fecha", help="ej. 2026-10-13T03:40 o '13/10/2026 03:40'")
+    cl.add_argument("--historial", default=os.getenv("HISTORIAL_CONFIG_PATH", "historial_config.jsonl"))
+    cl.add_argument("--letra-chub", help="letra de línea 1 para Chub")
+    args = ap.parse_args(argv)
+    if args.comando == "clave":
+        return _clave_historica(args)
+    if args.comando != "exportar":
+        ap.print_help()
+        return 2
+
+    from persistencia import crear_almacen
+    catalogo_path, config_path = "catalogo_skus.json", "config_turno.json"
+    almacen = crear_almacen(os.getenv("ALMACEN_BACKEND", "json"), threading.Lock(),
+                            os.getenv("SQLITE_PATH", "bot.sqlite3"), catalogo_path, config_path,
+                            [catalogo_path, config_path])
+    catalogo = almacen.cargar(catalogo_path, {})
+    cfg_chat = almacen.cargar(config_path, {}).get(str(args.chat_id), {})
+    asignaciones = asignaciones_de_config(cfg_chat, catalogo, args.llenadora)
+    if not asignaciones:
+        print(f"⚠️ El chat {args.chat_id} no tiene llenadoras asignadas con combo completo en catálogo.", file=sys.stderr)
+        return 1
+
+    vidas = {a["vida_util_meses"] for a in asignaciones}
+    generador = GeneradorClaves(LETRA_LLENADORA, vidas=lambda: vidas)
+    salida = open(args.salida, "w", encoding="utf-8", newline="") if args.salida else sys.stdout
+    try:
+        n = exportar_claves(generador, asignaciones, args.desde, args.hasta, salida,
+                            args.formato, args.paso, args.letra_chub)
+    finally:
+        if args.salida:
+            salida.close()
+    print(f"✅ {n} claves exportadas", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
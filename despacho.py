@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Despacho de updates fuera del request HTTP
+- Cola acotada: si se llena, encolar() devuelve False y el webhook responde 503
+  (Telegram reintenta más tarde) en lugar de crecer sin límite
+- Pool de hilos que drena la cola
+- Métricas de contrapresión: profundidad, rechazados, espera en cola, en proceso
+- Despacho por chat: cada chat_id cae siempre en el mismo carril (cola + hilo),
+  así sus updates se procesan en orden estricto y chats distintos en paralelo
+- Offset de getUpdates confirmado en disco: solo avanza sobre el prefijo contiguo
+  de updates ya procesados y guarda los que siguen en vuelo, así un reinicio no
+  pierde ni salta updates aunque a Telegram se le pida desde el mayor visto
+"""
+
+import json
+import time
+import zlib
+import queue
+import atexit
+import threading
+from contextlib import contextmanager
+
+from persistencia import Contador, EscrituraDiferida, escribir_json_atomico
+
+
+class ColaTrabajo:
+    def __init__(self, procesar, workers=4, capacidad=1000, nombre="updates", lock=None):
+        self.nombre = nombre
+        self._lock_proceso = lock  # opcional: se toma mientras se procesa cada item
+        self.capacidad = capacidad
+        self._procesar = procesar
+        self._cola = queue.Queue(maxsize=capacidad)
+        self._lock = threading.Lock()
+        self._en_proceso = 0
+        self._iniciados = 0
+        self._espera_total_ms = 0.0
+        self._espera_max_ms = 0.0
+        self.encolados = Contador()
+        self.rechazados = Contador()
+        self.procesados = Contador()
+        self.errores = Contador()
+        self._hilos = []
+        for i in range(max(1, workers)):
+            h = threading.Thread(target=self._worker, name=f"{nombre}-{i}", daemon=True)
+            h.start()
+            self._hilos.append(h)
+        atexit.register(self.detener)
+
+    def encolar(self, item, bloquear=False):
+        # bloquear=True espera lugar en la cola (contrapresión hacia quien produce)
+        try:
+            self._cola.put((time.monotonic(), item), block=bloquear)
+        except queue.Full:
+            self.rechazados.inc()
+            return False
+        self.encolados.inc()
+        return True
+
+    def _worker(self):
+        while True:
+            entrada = self._cola.get()
+            if entrada is None:
+                self._cola.task_done()
+                return
+            t_encolado, item = entrada
+            espera_ms = (time.monotonic() - t_encolado) * 1000.0
+            with self._lock:
+                self._en_proceso += 1
+                self._iniciados += 1
+                self._espera_total_ms += espera_ms
+                if espera_ms > self._espera_max_ms:
+                    self._espera_max_ms = espera_ms
+            try:
+                if self._lock_proceso is not None:
+                    with self._lock_proceso:
+                        self._procesar(item)
+                else:
+                    self._procesar(item)
+            except Exception as e:
+                self.errores.inc()
+                print(f"Error en worker {self.nombre}:", e)
+            finally:
+                with self._lock:
+                    self._en_proceso -= 1
+                self.procesados.inc()
+                self._cola.task_done()
+
+    def detener(self, timeout=10.0):
+        # Deja terminar lo ya encolado (hasta `timeout`) y apaga los hilos
+        limite = time.monotonic() + timeout
+        while self._cola.unfinished_tasks and time.monotonic() < limite:
+            time.sleep(0.05)
+        for _ in self._hilos:
+            try:
+                self._cola.put_nowait(None)
+            except queue.Full:
+                break
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "cola": self.nombre,
+                "profundidad": self._cola.qsize(),
+                "capacidad": self.capacidad,
+                "workers": len(self._hilos),
+                "en_proceso": self._en_proceso,
+                "encolados": self.encolados.valor(),
+                "rechazados": self.rechazados.valor(),
+                "procesados": self.procesados.valor(),
+                "errores": self.errores.valor(),
+                "espera_prom_ms": round(self._espera_total_ms / self._iniciados, 2) if self._iniciados else 0.0,
+                "espera_max_ms": round(self._espera_max_ms, 2),
+            }
+
+
+class DespachadorPorChat:
+    """Reparte updates en carriles por chat_id (un hilo por carril).
+
+    Un chat siempre cae en el mismo carril, así que sus updates se procesan en
+    orden y nunca en paralelo entre sí; chats de carriles distintos avanzan en
+    paralelo. `en_orden(chat_id)` permite procesar fuera de la cola (p. ej. en el
+    hilo del request) con la misma exclusión del carril.
+
+    `bloqueo(i)` da el lock (reentrante) del carril i; con un BloqueoArchivo por
+    carril la exclusión vale también entre procesos, siempre que todos usen el
+    mismo número de carriles.
+    """
+
+    def __init__(self, procesar, carriles=8, capacidad_por_carril=250, nombre="chats", bloqueo=None):
+        self.nombre = nombre
+        self._locks = [(bloqueo or (lambda i: threading.RLock()))(i) for i in range(max(1, carriles))]
+        self._carriles = [
+            ColaTrabajo(procesar, workers=1, capacidad=capacidad_por_carril,
+                        nombre=f"{nombre}-{i}", lock=self._locks[i])
+            for i in range(len(self._locks))
+        ]
+
+    def _indice(self, chat_id):
+        return zlib.crc32(str(chat_id).encode()) % len(self._carriles)
+
+    def encolar(self, chat_id, item, bloquear=False):
+        return self._carriles[self._indice(chat_id)].encolar(item, bloquear=bloquear)
+
+    @contextmanager
+    def en_orden(self, chat_id):
+        with self._locks[self._indice(chat_id)]:
+            yield
+
+    def pendientes(self):
+        return sum(c._cola.unfinished_tasks for c in self._carriles)
+
+    def detener(self, timeout=10.0):
+        for c in self._carriles:
+            c.detener(timeout)
+
+    def estadisticas(self):
+        carriles = [c.estadisticas() for c in self._carriles]
+        total = {"cola": self.nombre, "carriles": len(carriles)}
+        for clave in ("profundidad", "capacidad", "en_proceso", "encolados", "rechazados", "procesados", "errores"):
+            total[clave] = sum(c[clave] for c in carriles)
+        total["profundidad_max_carril"] = max(c["profundidad"] for c in carriles)
+        total["espera_max_ms"] = max(c["espera_max_ms"] for c in carriles)
+        return total
+
+
+class OffsetConfirmado:
+    """Offset de long-polling que sobrevive reinicios.
+
+    `registrar(update_id, update)` marca un update como en vuelo (False si ya estaba
+    en vuelo o terminado). `terminar(update_id)` lo da por procesado; el offset
+    confirmado es el menor update en vuelo, o el siguiente al mayor visto si no
+    queda ninguno.
+
+    A Telegram se le pide desde `siguiente()` (el mayor visto + 1), así que un
+    update en vuelo no vuelve a llegar. Como ese getUpdates ya lo descarta del lado
+    de Telegram, antes `asegurar()` escribe en disco el offset confirmado junto con
+    los updates en vuelo; tras una caída `recuperar()` los devuelve para
+    reprocesarlos. Lo que solo cambia al terminar se persiste con escritura diferida.
+    """
+
+    def __init__(self, path, retardo=0.2, max_retardo=1.0):
+        self.path = path
+        self._cond = threading.Condition()
+        self._en_vuelo = {}       # update_id -> update
+        self._terminados = set()  # procesados por encima del offset confirmado
+        self._max_visto = None
+        self.confirmado, self._recuperados = self._cargar()
+        self._siguiente = self.confirmado
+        self.duplicados = Contador()
+        self._flush = EscrituraDiferida(
+            f"offset-{path}",
+            lambda doc, claves=None: escribir_json_atomico(path, doc) or True,
+            retardo=retardo, max_retardo=max_retardo,
+        )
+
+    def _cargar(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+            return doc.get("offset"), list(doc.get("en_vuelo", []))
+        except (OSError, ValueError, AttributeError, TypeError):
+            return None, []
+
+    def _doc(self):
+        return {"offset": self.confirmado, "en_vuelo": [self._en_vuelo[u] for u in sorted(self._en_vuelo)]}
+
+    def registrar(self, update_id, update=None):
+        with self._cond:
+            if (update_id in self._en_vuelo or update_id in self._terminados
+                    or (self.confirmado is not None and update_id < self.confirmado)):
+                self.duplicados.inc()
+                return False
+            self._en_vuelo[update_id] = update if update is not None else {"update_id": update_id}
+            if self._max_visto is None or update_id > self._max_visto:
+                self._max_visto = update_id
+            return True
+
+    def asegurar(self):
+        # Escribe ya los updates en vuelo; solo entonces siguiente() pasa de ellos.
+        with self._cond:
+            hasta = self._max_visto
+            self._flush.marcar(self._doc())
+        if not self._flush.vaciar():
+            return False
+        with self._cond:
+            if hasta is not None and (self._siguiente is None or hasta + 1 > self._siguiente):
+                self._siguiente = hasta + 1
+        return True
+
+    def siguiente(self):
+        # Offset para el próximo getUpdates (None = lo que Telegram tenga pendiente)
+        with self._cond:
+            return self._siguiente
+
+    def recuperar(self):
+        # Updates que quedaron en vuelo en la ejecución anterior, ya registrados de nuevo
+        with self._cond:
+            pendientes, self._recuperados = self._recuperados, []
+        return [u for u in pendientes if self.registrar(u["update_id"], u)]
+
+    def terminar(self, update_id):
+        with self._cond:
+            self._en_vuelo.pop(update_id, None)
+            self._terminados.add(update_id)
+            nuevo = min(self._en_vuelo) if self._en_vuelo else self._max_visto + 1
+            if self.confirmado is None or nuevo > self.confirmado:
+                self.confirmado = nuevo
+                self._terminados = {u for u in self._terminados if u >= nuevo}
+            self._flush.marcar(self._doc())
+
+    def en_vuelo(self):
+        with self._cond:
+            return len(self._en_vuelo)
+
+    def estadisticas(self):
+        with self._cond:
+            return {
+                "offset": self.confirmado,
+                "en_vuelo": len(self._en_vuelo),
+                "duplicados": self.duplicados.valor(),
+                "escrituras": self._flush.escrituras.valor(),
+            }
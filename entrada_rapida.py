@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Entrada rápida de tránsito: varios lotes en un solo mensaje
+- Formato: `M1 12 p, M2 8 g, M3 20, Chub 5` (lotes separados por coma, punto y coma o salto de línea)
+- Cada lote: llenadora, canastas (entero positivo) y pin opcional (p/pequeño, g/grande, u/único)
+- M3 y Chub llevan pin automático (grande / único), igual que el flujo con botones
+- En M1/M2 el pin puede omitirse si la medida configurada admite uno solo
+- Todo o nada: con un solo lote inválido no se devuelve ninguno, solo la lista de errores
+"""
+
+import re
+
+from claves_envase import LLENADORAS
+
+PIN_AUTOMATICO = {"M3": "grande", "Chub": "único"}
+
+PINES = {
+    "p": "pequeño", "peq": "pequeño", "pequeño": "pequeño", "pequeno": "pequeño",
+    "g": "grande", "gr": "grande", "grande": "grande",
+    "u": "único", "único": "único", "unico": "único",
+}
+
+_POR_NOMBRE = {ll.lower(): ll for ll in LLENADORAS}
+_LLENADORA = "|".join(re.escape(ll.lower()) for ll in LLENADORAS)
+_INICIO = re.compile(rf"^\s*({_LLENADORA})\s+\d", re.IGNORECASE)
+_LOTE = re.compile(rf"^({_LLENADORA})\s+(\d+)\s*(\S+)?$", re.IGNORECASE)
+_SEPARADOR = re.compile(r"[,;\n]+")
+
+
+def parece_entrada_rapida(texto):
+    """True si el mensaje empieza como un lote (`M1 12 ...`): así no se confunde con otros textos."""
+    return bool(_INICIO.match(texto or ""))
+
+
+def interpretar_lotes(texto, cfg_chat, pines_permitidos):
+    """Parsea y valida contra la config del chat.
+
+    `cfg_chat`: {llenadora: {"producto", "medida", "mercado"}} (config_turno del chat).
+    `pines_permitidos(medida)`: conjunto de pines válidos para la medida.
+    Devuelve (lotes, errores); cada lote: {"llenadora", "combo", "canastas", "pin"}.
+    """
+    lotes, errores = [], []
+    partes = [p.strip() for p in _SEPARADOR.split(texto or "") if p.strip()]
+    if not partes:
+        return [], ["Mensaje vacío."]
+    for n, parte in enumerate(partes, 1):
+        m = _LOTE.match(parte)
+        if not m:
+            errores.append(f"Lote {n} ({parte}): se esperaba 'llenadora canastas [pin]'.")
+            continue
+        ll = _POR_NOMBRE[m.group(1).lower()]
+        canastas = int(m.group(2))
+        if canastas <= 0:
+            errores.append(f"Lote {n} ({parte}): las canastas deben ser un entero positivo.")
+            continue
+        combo = cfg_chat.get(ll)
+        if not combo:
+            errores.append(f"Lote {n}: no hay registro para {ll}; usa Cargar para asignarle un producto.")
+            continue
+        medida = combo.get("medida", "")
+        permitidos = pines_permitidos(medida)
+        pin = None
+        if m.group(3):
+            pin = PINES.get(m.group(3).lower())
+            if pin is None:
+                errores.append(f"Lote {n} ({parte}): pin '{m.group(3)}' desconocido (usa p, g o u).")
+                continue
+        auto = PIN_AUTOMATICO.get(ll)
+        if auto:
+            if pin and pin != auto:
+                errores.append(f"Lote {n}: {ll} siempre usa pin {auto}.")
+                continue
+            pin = auto
+        elif pin is None:
+            if len(permitidos) != 1:
+                errores.append(f"Lote {n}: falta el pin para {ll} ({medida}).")
+                continue
+            pin = next(iter(permitidos))
+        if pin not in permitidos:
+            errores.append(f"Lote {n}: el pin {pin} no es válido para {medida} ({ll}).")
+            continue
+        lotes.append({"llenadora": ll, "combo": combo, "canastas": canastas, "pin": pin})
+    return (lotes, []) if not errores else ([], errores)
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Estado conversacional por chat fuera del dict del proceso
+- Backends: memoria (LRU + TTL + tope de memoria), archivo SQLite y socket local
+  compatible con Redis (GET/SET EX/DEL, SCAN), fuera de la memoria del bot
+- TTL por entrada (se renueva en cada escritura): los flujos abandonados expiran solos
+- EstadosConversacion: fachada tipo dict que usan los handlers (get / [] / pop);
+  lo que se toca durante un update se persiste con confirmar() al terminarlo
+- Métricas: aciertos, fallos, expirados, desalojados, entradas y bytes
+- Con sqlite o socket el estado se comparte entre procesos (workers del webhook); el resto
+  de lo que cachean los bots se revalida entre ellos con MULTIPROCESO (ver webhookBot.py)
+
+Uso como script (servidor RESP mínimo para desarrollo):
+  python estados.py servidor unix:/tmp/estados.sock
+  python estados.py servidor 127.0.0.1:6390
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+import socketserver
+from collections import OrderedDict
+
+from persistencia import Contador
+
+
+def _serializar(estado):
+    return json.dumps(estado, ensure_ascii=False, separators=(",", ":"))
+
+
+class _MetricasEstados:
+    def __init__(self):
+        self.hits = Contador()
+        self.misses = Contador()
+        self.expirados = Contador()
+        self.desalojados = Contador()
+
+    def resumen(self):
+        return {
+            "hits": self.hits.valor(),
+            "misses": self.misses.valor(),
+            "expirados": self.expirados.valor(),
+            "desalojados": self.desalojados.valor(),
+        }
+
+# =========================
+# Backend: memoria
+# =========================
+class AlmacenEstadosMemoria:
+    """LRU con TTL y tope de bytes/entradas.
+
+    Como todas las entradas usan el mismo TTL y se renueva al escribir, el orden LRU
+    coincide con el de expiración: barrer expirados es sacar por el frente.
+    Guarda el objeto mismo (sin serializar), así las mutaciones en sitio no se pierden.
+    """
+
+    nombre = "memoria"
+
+    def __init__(self, ttl=43200, max_bytes=16 * 1024 * 1024, max_entradas=10000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()  # clave -> (estado, expira, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.metricas = _MetricasEstados()
+
+    def leer(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.metricas.misses.inc()
+                return None
+            if entrada[1] <= time.monotonic():
+                self._quitar(clave)
+                self.metricas.expirados.inc()
+                self.metricas.misses.inc()
+                return None
+            self.metricas.hits.inc()
+            return entrada[0]
+
+    def escribir(self, clave, estado):
+        tam = len(_serializar(estado))
+        with self._lock:
+            self._quitar(clave)
+            self._datos[clave] = (estado, time.monotonic() + self.ttl, tam)
+            self._bytes += tam
+            self._barrer()
+
+    def borrar(self, clave):
+        with self._lock:
+            self._quitar(clave)
+
+    def _quitar(self, clave):
+        entrada = self._datos.pop(clave, None)
+        if entrada is not None:
+            self._bytes -= entrada[2]
+
+    def _barrer(self):
+        ahora = time.monotonic()
+        while self._datos:
+            clave, (_, expira, _) = next(iter(self._datos.items()))
+            if expira <= ahora:
+                self._quitar(clave)
+                self.metricas.expirados.inc()
+            elif self._bytes > self.max_bytes or len(self._datos) > self.max_entradas:
+                self._quitar(clave)
+                self.metricas.desalojados.inc()
+            else:
+                break
+
+    def estadisticas(self):
+        with self._lock:
+            self._barrer()
+            return dict(self.metricas.resumen(), backend=self.nombre, entradas=len(self._datos), bytes=self._bytes)
+
+# =========================
+# Backend: SQLite
+# =========================
+class AlmacenEstadosSQLite:
+    """Archivo SQLite (WAL) compartible entre procesos; expira por columna `expira`."""
+
+    nombre = "sqlite"
+
+    def __init__(self, db_path, ttl=43200, intervalo_barrido=60.0):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.intervalo_barrido = intervalo_barrido
+        self._ultimo_barrido = 0.0
+        self._local = threading.local()
+        self.metricas = _MetricasEstados()
+        self._cx().execute("""CREATE TABLE IF NOT EXISTS estados (
+            clave  TEXT PRIMARY KEY,
+            datos  TEXT NOT NULL,
+            expira REAL NOT NULL
+        )""")
+        self._cx().execute("CREATE INDEX IF NOT EXISTS estados_expira ON estados (expira)")
+
+    def _cx(self):
+        cx = getattr(self._local, "cx", None)
+        if cx is None:
+            cx = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            cx.execute("PRAGMA journal_mode=WAL")
+            cx.execute("PRAGMA synchronous=NORMAL")
+            self._local.cx = cx
+        return cx
+
+    def leer(self, clave):
+        fila = self._cx().execute("SELECT datos, expira FROM estados WHERE clave = ?", (clave,)).fetchone()
+        if fila is None:
+            self.metricas.misses.inc()
+            return None
+        if fila[1] <= time.time():
+            self._cx().execute("DELETE FROM estados WHERE clave = ? AND expira <= ?", (clave, time.time()))
+            self.metricas.expirados.inc()
+            self.metricas.misses.inc()
+            return None
+        self.metricas.hits.inc()
+        return json.loads(fila[0])
+
+    def escribir(self, clave, estado):
+        ahora = time.time()
+        self._cx().execute("INSERT OR REPLACE INTO estados (clave, datos, expira) VALUES (?,?,?)",
+                           (clave, _serializar(estado), ahora + self.ttl))
+        if ahora - self._ultimo_barrido > self.intervalo_barrido:
+            self._ultimo_barrido = ahora
+            n = self._cx().execute("DELETE FROM estados WHERE expira <= ?", (ahora,)).rowcount
+            for _ in range(max(0, n)):
+                self.metricas.expirados.inc()
+
+    def borrar(self, clave):
+        self._cx().execute("DELETE FROM estados WHERE clave = ?", (clave,))
+
+    def estadisticas(self):
+        entradas, tam = self._cx().execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(datos)), 0) FROM estados WHERE expira > ?", (time.time(),)
+        ).fetchone()
+        return dict(self.metricas.resumen(), backend=self.nombre, entradas=entradas, bytes=tam)
+
+# =========================
+# Backend: socket RESP (compatible con Redis)
+# =========================
+def _abrir_socket(direccion, timeout):
+    if direccion.startswith("unix:"):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(direccion[5:])
+        return s
+    host, _, puerto = direccion.rpartition(":")
+    return socket.create_connection((host or "127.0.0.1", int(puerto)), timeout=timeout)
+
+
+def _codificar(*args):
+    partes = [f"*{len(args)}\r\n".encode()]
+    for a in args:
+        b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+        partes.append(b"$%d\r\n%s\r\n" % (len(b), b))
+    return b"".join(partes)
+
+
+def _leer_respuesta(f):
+    linea = f.readline()
+    if not linea:
+        raise ConnectionError("conexión cerrada")
+    tipo, resto = linea[:1], linea[1:-2]
+    if tipo == b"+":
+        return resto.decode()
+    if tipo == b"-":
+        raise RuntimeError(resto.decode())
+    if tipo == b":":
+        return int(resto)
+    if tipo == b"$":
+        n = int(resto)
+        if n < 0:
+            return None
+        datos = f.read(n + 2)
+        return datos[:-2]
+    if tipo == b"*":
+        n = int(resto)
+        return None if n < 0 else [_leer_respuesta(f) for _ in range(n)]
+    raise RuntimeError(f"respuesta RESP inválida: {linea!r}")
+
+
+class AlmacenEstadosSocket:
+    """Cliente RESP mínimo (GET / SET EX / DEL) contra Redis o el servidor local de este módulo."""
+
+    nombre = "socket"
+
+    def __init__(self, direccion, ttl=43200, prefijo="estado:", timeout=2.0):
+        self.direccion = direccion
+        self.ttl = int(ttl)
+        self.prefijo = prefijo
+        self.timeout = timeout
+        self._local = threading.local()
+        self.metricas = _MetricasEstados()
+
+    def _comando(self, *args):
+        # Una conexión por hilo; si se cae, se reabre una vez
+        for intento in (1, 2):
+            con = getattr(self._local, "con", None)
+            try:
+                if con is None:
+                    s = _abrir_socket(self.direccion, self.timeout)
+                    con = self._local.con = (s, s.makefile("rb"))
+                con[0].sendall(_codificar(*args))
+                return _leer_respuesta(con[1])
+            except (OSError, ConnectionError):
+                self._local.con = None
+                if intento == 2:
+                    raise
+
+    def leer(self, clave):
+        datos = self._comando("GET", self.prefijo + clave)
+        if datos is None:
+            # Redis expira por su cuenta: desde aquí no se distingue expirado de inexistente
+            self.metricas.misses.inc()
+            return None
+        self.metricas.hits.inc()
+        return json.loads(datos)
+
+    def escribir(self, clave, estado):
+        self._comando("SET", self.prefijo + clave, _serializar(estado), "EX", self.ttl)
+
+    def borrar(self, clave):
+        self._comando("DEL", self.prefijo + clave)
+
+    def contar(self):
+        # DBSIZE contaría todas las claves de la base (compartida): solo las de este prefijo
+        patron = re.sub(r"([*?\[\]\\])", r"\\\1", self.prefijo) + "*"
+        cursor, n = b"0", 0
+        while True:
+            cursor, claves = self._comando("SCAN", cursor, "MATCH", patron, "COUNT", 1000)
+            n += len(claves)
+            if cursor in (b"0", "0"):
+                return n
+
+    def estadisticas(self):
+        try:
+            entradas = self.contar()
+        except Exception:
+            entradas = None
+        return dict(self.metricas.resumen(), backend=self.nombre, entradas=entradas)
+
+# =========================
+# Fachada usada por los handlers
+# =========================
+class EstadosConversacion:
+    """Se usa como el antiguo dict `estados_usuarios` (get / [] / pop / in).
+
+    Lo leído o escrito durante un update queda en un conjunto de trabajo del hilo;
+    confirmar() persiste al final del update solo lo que cambió (asignado, borrado o
+    mutado en sitio: lo leído se compara con la copia serializada al leerlo) y
+    descarta el conjunto. Una entrada solo leída no se reescribe ni renueva su TTL.
+    Los carriles por chat garantizan que un chat no se procesa en dos hilos a la vez.
+    """
+
+    _BORRADO = object()
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._local = threading.local()
+
+    def _trabajo(self):
+        t = getattr(self._local, "trabajo", None)
+        if t is None:
+            t = self._local.trabajo = {}
+            self._local.leidos = {}   # clave -> serialización al leer (entradas aún sin cambios)
+        return t
+
+    def get(self, chat_id, default=None):
+        clave = str(chat_id)
+        t = self._trabajo()
+        if clave in t:
+            v = t[clave]
+            return default if v is self._BORRADO else v
+        v = self.backend.leer(clave)
+        if v is None:
+            return default
+        t[clave] = v
+        self._local.leidos[clave] = _serializar(v)
+        return v
+
+    def __getitem__(self, chat_id):
+        v = self.get(chat_id)
+        if v is None:
+            raise KeyError(chat_id)
+        return v
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __setitem__(self, chat_id, estado):
+        self._trabajo()[str(chat_id)] = estado
+        self._local.leidos.pop(str(chat_id), None)
+
+    def pop(self, chat_id, default=None):
+        v = self.get(chat_id)
+        self._trabajo()[str(chat_id)] = self._BORRADO
+        self._local.leidos.pop(str(chat_id), None)
+        return default if v is None else v
+
+    def confirmar(self):
+        t = getattr(self._local, "trabajo", None)
+        leidos = getattr(self._local, "leidos", None) or {}
+        self._local.trabajo = self._local.leidos = None
+        if not t:
+            return
+        for clave, v in t.items():
+            try:
+                if v is not self._BORRADO and leidos.get(clave) == _serializar(v):
+                    continue   # solo leído: ni se reescribe ni se renueva el TTL
+                if v is self._BORRADO:
+                    self.backend.borrar(clave)
+                else:
+                    self.backend.escribir(clave, v)
+            except Exception as e:
+                print(f"❗ Error guardando estado del chat {clave}:", e)
+
+    def descartar(self):
+        self._local.trabajo = self._local.leidos = None
+
+    def __len__(self):
+        return self.backend.estadisticas().get("entradas") or 0
+
+    def estadisticas(self):
+        return self.backend.estadisticas()
+
+
+def crear_almacen_estados(backend, ttl, max_bytes, max_entradas, sqlite_path, direccion_socket):
+    if backend == "sqlite":
+        return AlmacenEstadosSQLite(sqlite_path, ttl=ttl)
+    if backend == "socket":
+        return AlmacenEstadosSocket(direccion_socket, ttl=ttl)
+    return AlmacenEstadosMemoria(ttl=ttl, max_bytes=max_bytes, max_entradas=max_entradas)
+
+# =========================
+# Servidor RESP local (sustituto de Redis para desarrollo)
+# =========================
+def _patron_glob(patron):
+    # Glob de Redis (*, ? y escapes con \) -> regex; los corchetes se toman literales
+    partes, i = [], 0
+    while i < len(patron):
+        c = patron[i]
+        if c == "\\" and i + 1 < len(patron):
+            i += 1
+            partes.append(re.escape(patron[i]))
+        elif c == "*":
+            partes.append(".*")
+        elif c == "?":
+            partes.append(".")
+        else:
+            partes.append(re.escape(c))
+        i += 1
+    return re.compile("".join(partes), re.DOTALL)
+
+
+def _bulk(b):
+    return b"$%d\r\n%s\r\n" % (len(b), b)
+
+
+class _ManejadorRESP(socketserver.StreamRequestHandler):
+    def handle(self):
+        datos, lock = self.server.datos, self.server.lock
+        while True:
+            try:
+                args = _leer_respuesta(self.rfile)
+            except (ConnectionError, RuntimeError, ValueError):
+                return
+            if not isinstance(args, list) or not args:
+                return
+            cmd = args[0].decode().upper()
+            ahora = time.time()
+            with lock:
+                if cmd == "PING":
+                    r = b"+PONG\r\n"
+                elif cmd == "GET":
+                    v = datos.get(args[1])
+                    if v is not None and v[1] is not None and v[1] <= ahora:
+                        del datos[args[1]]
+                        v = None
+                    r = b"$-1\r\n" if v is None else b"$%d\r\n%s\r\n" % (len(v[0]), v[0])
+                elif cmd == "SET":
+                    expira = None
+                    if len(args) >= 5 and args[3].decode().upper() == "EX":
+                        expira = ahora + int(args[4])
+                    datos[args[1]] = (args[2], expira)
+                    r = b"+OK\r\n"
+                elif cmd == "DEL":
+                    n = sum(1 for k in args[1:] if datos.pop(k, None) is not None)
+                    r = b":%d\r\n" % n
+                elif cmd == "DBSIZE":
+                    for k in [k for k, v in datos.items() if v[1] is not None and v[1] <= ahora]:
+                        del datos[k]
+                    r = b":%d\r\n" % len(datos)
+                elif cmd == "SCAN":
+                    # Una sola pasada (cursor 0 de vuelta); solo se atiende MATCH, COUNT se ignora
+                    opciones = [a.decode() for a in args[2:]]
+                    regex = None
+                    if "MATCH" in (o.upper() for o in opciones[::2]):
+                        i = [o.upper() for o in opciones].index("MATCH")
+                        regex = _patron_glob(opciones[i + 1])
+                    claves = [k for k, v in datos.items()
+                              if (v[1] is None or v[1] > ahora)
+                              and (regex is None or regex.fullmatch(k.decode("utf-8", "replace")))]
+                    r = (b"*2\r\n" + _bulk(b"0") + b"*%d\r\n" % len(claves)
+                         + b"".join(_bulk(k) for k in claves))
+                else:
+                    r = b"-ERR comando no soportado\r\n"
+            self.wfile.write(r)
+
+
+def servidor_resp_local(direccion):
+    if direccion.startswith("unix:"):
+        ruta = direccion[5:]
+        if os.path.exists(ruta):
+            os.unlink(ruta)
+        srv = socketserver.ThreadingUnixStreamServer(ruta, _ManejadorRESP)
+    else:
+        host, _, puerto = direccion.rpartition(":")
+        srv = socketserver.ThreadingTCPServer((host or "127.0.0.1", int(puerto)), _ManejadorRESP)
+    srv.daemon_threads = True
+    srv.datos = {}
+    srv.lock = threading.Lock()
+    return srv
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "servidor":
+        srv = servidor_resp_local(sys.argv[2])
+        print(f"Servidor de estados (RESP) escuchando en {sys.argv[2]}")
+        srv.serve_forever()
+    else:
+        print("Uso: python estados.py servidor unix:/ruta.sock | host:puerto")
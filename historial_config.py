@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Historial de config_turno por chat y llenadora (append-only)
+- Cada asignación guardada desde Carga se agrega como una línea JSON con su ts y la
+  entrada de catálogo de ese momento (sku, vida útil): si el catálogo cambia después,
+  la clave de entonces se sigue pudiendo regenerar igual
+- Índice en memoria por (chat, llenadora): ts ordenados -> bisect, O(log n) por consulta
+- vigente(chat, llenadora, ts) devuelve la asignación activa a esa hora; con ella y
+  fecha_ref=ts, GeneradorClaves.clave() reproduce la clave impresa
+- Los cambios son pocos (los hace una persona): cada uno se escribe con fsync al momento
+- Varios procesos: las escrituras se serializan con un bloqueo de archivo y cada consulta
+  lee primero lo que otros agregaron al final del archivo desde la última vez
+
+Registro:
+  {"ts": "2026-10-13T03:12:40", "chat_id": "123", "llenadora": "M1", "producto": "FND",
+   "medida": "8oz", "mercado": "RTCA", "sku": "194916", "vida_util_meses": 18}
+"""
+
+import os
+import json
+import threading
+from bisect import bisect_right
+from datetime import datetime
+
+from persistencia import BloqueoArchivo, Contador
+
+FORMATO_TS = "%Y-%m-%dT%H:%M:%S"
+FORMATOS_FECHA = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M",
+                  "%d/%m/%Y %H:%M", "%d/%m/%y %H:%M"]
+
+
+def interpretar_fecha(texto, ahora=None):
+    """'2026-10-13 03:40', '2026-10-13T03:40', '13/10/2026 03:40' o '13/10 03:40' (año actual)."""
+    texto = " ".join((texto or "").split())
+    for fmt in FORMATOS_FECHA:
+        try:
+            return datetime.strptime(texto, fmt)
+        except ValueError:
+            continue
+    try:
+        return datetime.strptime(f"{texto} {(ahora or datetime.now()).year}", "%d/%m %H:%M %Y")
+    except ValueError:
+        return None
+
+
+class HistorialConfig:
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._bloqueo = BloqueoArchivo(f"{ruta}.lock")
+        self._ts = {}          # (chat, llenadora) -> [ts] ordenados
+        self._registros = {}   # (chat, llenadora) -> [registro] en el mismo orden
+        self._leido = 0        # bytes del archivo ya indexados
+        self.registrados = Contador()
+        self.errores = Contador()
+        with self._lock:
+            self._ponerse_al_dia()
+
+    def _ponerse_al_dia(self):
+        # Con self._lock tomado: indexa las líneas completas que se agregaron desde la última vez
+        try:
+            tam = os.path.getsize(self.ruta)
+        except OSError:
+            return
+        if tam < self._leido:
+            # El archivo se reemplazó o se truncó: se vuelve a indexar desde cero
+            self._ts, self._registros, self._leido = {}, {}, 0
+        if tam == self._leido:
+            return
+        with open(self.ruta, "rb") as f:
+            f.seek(self._leido)
+            datos = f.read(tam - self._leido)
+        fin = datos.rfind(b"\n") + 1   # una línea a medio escribir se deja para la próxima
+        for linea in datos[:fin].splitlines():
+            try:
+                self._indexar(json.loads(linea))
+            except (ValueError, KeyError, TypeError):
+                self.errores.inc()
+        self._leido += fin
+
+    def _indexar(self, r):
+        k = (str(r["chat_id"]), r["llenadora"])
+        lista = self._ts.setdefault(k, [])
+        regs = self._registros.setdefault(k, [])
+        # Casi siempre llega en orden: bisect_right deja el más nuevo al final entre iguales
+        i = bisect_right(lista, r["ts"])
+        lista.insert(i, r["ts"])
+        regs.insert(i, r)
+
+    @staticmethod
+    def _nuevo(chat_id, llenadora, combo, cat, ts, origen):
+        r = {"ts": (ts or datetime.now()).strftime(FORMATO_TS), "chat_id": str(chat_id), "llenadora": llenadora,
+             "producto": combo.get("producto"), "medida": combo.get("medida"), "mercado": combo.get("mercado"),
+             "sku": (cat or {}).get("sku"), "vida_util_meses": (cat or {}).get("vida_util_meses")}
+        if origen:
+            r["origen"] = origen
+        return r
+
+    def registrar(self, chat_id, llenadora, combo, cat, ts=None, origen=None):
+        """Agrega una asignación. `cat`: entrada del catálogo (sku, vida_util_meses)."""
+        r = self._nuevo(chat_id, llenadora, combo, cat, ts, origen)
+        with self._lock, self._bloqueo:
+            self._agregar(r)
+        self.registrados.inc()
+        return r
+
+    def registrar_si_falta(self, chat_id, llenadora, combo, cat, ts=None, origen=None):
+        """Como registrar(), pero solo si la serie no tiene asignaciones (atómico entre procesos).
+
+        Devuelve el registro agregado, o None si ya había uno.
+        """
+        r = self._nuevo(chat_id, llenadora, combo, cat, ts, origen)
+        with self._lock, self._bloqueo:
+            self._ponerse_al_dia()
+            if self._ts.get((r["chat_id"], llenadora)):
+                return None
+            self._agregar(r)
+        self.registrados.inc()
+        return r
+
+    def _agregar(self, r):
+        # Con self._lock y el bloqueo tomados: lo de otros procesos primero, luego la línea propia
+        self._ponerse_al_dia()
+        linea = (json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8")
+        try:
+            with open(self.ruta, "ab") as f:
+                if f.tell() > self._leido:
+                    # Con el bloqueo tomado nadie está escribiendo: es una línea cortada por una caída
+                    linea = b"\n" + linea
+                f.write(linea)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            self.errores.inc()
+            print("❗ Error escribiendo historial de config:", e)
+            self._indexar(r)   # al menos queda en memoria
+            return
+        self._ponerse_al_dia()
+
+    def vigente(self, chat_id, llenadora, ts):
+        """Asignación activa en `ts` (datetime o texto ISO), o None si no había ninguna."""
+        ts = ts if isinstance(ts, str) else ts.strftime(FORMATO_TS)
+        k = (str(chat_id), llenadora)
+        with self._lock:
+            self._ponerse_al_dia()
+            lista = self._ts.get(k)
+            if not lista:
+                return None
+            i = bisect_right(lista, ts) - 1
+            return self._registros[k][i] if i >= 0 else None
+
+    def tiene(self, chat_id, llenadora):
+        with self._lock:
+            self._ponerse_al_dia()
+            return bool(self._ts.get((str(chat_id), llenadora)))
+
+    def historial(self, chat_id, llenadora):
+        with self._lock:
+            self._ponerse_al_dia()
+            return list(self._registros.get((str(chat_id), llenadora), []))
+
+    def estadisticas(self):
+        with self._lock:
+            entradas = sum(len(v) for v in self._ts.values())
+        return {"documento": "historial_config", "entradas": entradas, "series": len(self._ts),
+                "registrados": self.registrados.valor(), "errores": self.errores.valor()}
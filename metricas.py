@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Métricas en formato de texto de Prometheus (/metrics)
+- Contadores e histogramas con un fragmento por hilo: observar() no toma locks,
+  solo escribe en el dict del hilo actual
+- Agregación perezosa: los fragmentos se suman recién al exponer; los de hilos
+  terminados se pliegan en un acumulado base para no crecer sin límite
+- Medidores calculados al exponer (profundidad de colas, tamaño de estados, ...)
+"""
+
+import threading
+from bisect import bisect_left
+
+BUCKETS_SEG = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escapar(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres, valores, extra=None):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _num(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Fragmentada:
+    """Base: un dict {valores de etiquetas -> acumulado} por hilo."""
+
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fragmentos = []  # (hilo, dict)
+        self._base = {}
+        self._umbral = 64
+
+    def _fragmento(self):
+        f = getattr(self._local, "f", None)
+        if f is None:
+            f = self._local.f = {}
+            with self._lock:
+                self._fragmentos.append((threading.current_thread(), f))
+                if len(self._fragmentos) > self._umbral:
+                    self._plegar()
+        return f
+
+    def _plegar(self):
+        # Con el lock tomado: los hilos muertos ya no escriben, se suman al acumulado base
+        vivos = []
+        for hilo, f in self._fragmentos:
+            if hilo.is_alive():
+                vivos.append((hilo, f))
+            else:
+                self._sumar(self._base, f)
+        self._fragmentos = vivos
+        self._umbral = max(64, 2 * len(vivos))
+
+    def _agregado(self):
+        with self._lock:
+            self._plegar()
+            total = {}
+            self._sumar(total, self._base)
+            for _, f in self._fragmentos:
+                self._sumar(total, f.copy())
+        return total
+
+    def lineas(self):
+        raise NotImplementedError
+
+
+class ContadorMetrica(_Fragmentada):
+    tipo = "counter"
+
+    def inc(self, etiquetas=(), n=1):
+        f = self._fragmento()
+        f[etiquetas] = f.get(etiquetas, 0) + n
+
+    @staticmethod
+    def _sumar(destino, origen):
+        for k, v in origen.items():
+            destino[k] = destino.get(k, 0) + v
+
+    def lineas(self):
+        for k, v in sorted(self._agregado().items()):
+            yield f"{self.nombre}{_etiquetas(self.etiquetas, k)} {_num(v)}"
+
+
+class Histograma(_Fragmentada):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEG):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(buckets)
+
+    def observar(self, valor, etiquetas=()):
+        # [conteo por bucket (no acumulado) ..., conteo +Inf, suma]
+        f = self._fragmento()
+        v = f.get(etiquetas)
+        if v is None:
+            v = f[etiquetas] = [0] * (len(self.buckets) + 1) + [0.0]
+        v[bisect_left(self.buckets, valor)] += 1
+        v[-1] += valor
+
+    @staticmethod
+    def _sumar(destino, origen):
+        for k, v in origen.items():
+            d = destino.get(k)
+            if d is None:
+                destino[k] = list(v)
+            else:
+                for i, x in enumerate(v):
+                    d[i] += x
+
+    def lineas(self):
+        for k, v in sorted(self._agregado().items()):
+            acumulado = 0
+            for limite, n in zip(self.buckets + (float("inf"),), v[:-1]):
+                acumulado += n
+                le = 'le="%s"' % _num(limite)
+                yield f"{self.nombre}_bucket{_etiquetas(self.etiquetas, k, le)} {acumulado}"
+            yield f"{self.nombre}_sum{_etiquetas(self.etiquetas, k)} {_num(v[-1])}"
+            yield f"{self.nombre}_count{_etiquetas(self.etiquetas, k)} {acumulado}"
+
+
+class Medidor:
+    """Valor calculado al exponer: fn() -> número o {valores de etiquetas: número}."""
+
+    def __init__(self, nombre, ayuda, fn, etiquetas=(), tipo="gauge"):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.fn = fn
+        self.etiquetas = tuple(etiquetas)
+        self.tipo = tipo
+
+    def lineas(self):
+        valores = self.fn()
+        if not isinstance(valores, dict):
+            valores = {(): valores}
+        for k, v in sorted(valores.items()):
+            if v is not None:
+                yield f"{self.nombre}{_etiquetas(self.etiquetas, k)} {_num(v)}"
+
+
+class Registro:
+    def __init__(self):
+        self._metricas = []
+
+    def _agregar(self, m):
+        self._metricas.append(m)
+        return m
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._agregar(ContadorMetrica(nombre, ayuda, etiquetas))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEG):
+        return self._agregar(Histograma(nombre, ayuda, etiquetas, buckets))
+
+    def medidor(self, nombre, ayuda, fn, etiquetas=(), tipo="gauge"):
+        return self._agregar(Medidor(nombre, ayuda, fn, etiquetas, tipo))
+
+    def exponer(self):
+        salida = []
+        for m in self._metricas:
+            try:
+                lineas = list(m.lineas())
+            except Exception as e:
+                print(f"❗ Error calculando métrica {m.nombre}:", e)
+                continue
+            salida.append(f"# HELP {m.nombre} {m.ayuda}")
+            salida.append(f"# TYPE {m.nombre} {m.tipo}")
+            salida.extend(lineas)
+        return "\n".join(salida) + "\n"
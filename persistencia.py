@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistencia compartida por ambos bots (webhook y long-polling)
+- Caché en memoria de documentos JSON (catálogo, configuración de turno)
+- Lecturas sin lock: se entrega la instantánea vigente (¡no mutarla!)
+- Escrituras write-through: se persiste y se reemplaza la instantánea completa
+- Varios procesos: cada caché compara la firma del documento guardado (mtime del
+  archivo o versión en SQLite) y recarga si otro proceso lo cambió; las
+  actualizaciones se serializan con un bloqueo de archivo (flock)
+- Contadores de aciertos/fallos de caché
+- Escritura diferida: ráfagas de cambios se agrupan en una sola escritura atómica
+  (archivo temporal + fsync + rename) hecha por un hilo en segundo plano
+- Almacenes intercambiables detrás de _load_json/_save_json:
+  JSON (por defecto, un archivo por documento) o SQLite (WAL, una fila por
+  chat/llenadora/combo), con migración única desde los JSON existentes
+
+Uso como script:
+  python persistencia.py migrar [bot.sqlite3]   # fuerza la importación JSON -> SQLite
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import time
+import atexit
+import threading
+from contextlib import nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin flock, el bloqueo de archivo queda solo entre hilos
+    fcntl = None
+
+# =========================
+# Contadores
+# =========================
+class Contador:
+    # Entero protegido por lock: inc() y valor() son exactos desde cualquier hilo
+    __slots__ = ("_n", "_lock")
+
+    def __init__(self):
+        self._n = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self._n += n
+
+    def valor(self):
+        with self._lock:
+            return self._n
+
+# =========================
+# Escritura atómica
+# =========================
+def escribir_json_atomico(path, data, indent=2):
+    # Nunca deja el archivo a medio escribir: se escribe aparte y se renombra encima
+    tmp = f"{path}.tmp"
+    separadores = (",", ":") if indent is None else None
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent, separators=separadores)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass  # algunos sistemas no permiten fsync de directorios
+
+# =========================
+# Bloqueo entre procesos
+# =========================
+class BloqueoArchivo:
+    """Lock reentrante entre hilos y, donde hay fcntl, entre procesos (flock sobre `ruta`).
+
+    Se usa como `with bloqueo:`; solo la primera entrada del hilo que lo tiene toma el flock.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.RLock()
+        self._nivel = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._nivel == 0 and fcntl is not None:
+            try:
+                fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except OSError:
+                    os.close(fd)
+                    raise
+            except OSError:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._nivel += 1
+        return self
+
+    def __exit__(self, *_):
+        self._nivel -= 1
+        if self._nivel == 0 and self._fd is not None:
+            fd, self._fd = self._fd, None
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        self._lock.release()
+        return False
+
+# =========================
+# Caché de documentos
+# =========================
+class DocumentoCache:
+    """Documento JSON parseado una sola vez y servido desde memoria.
+
+    `cargar()` devuelve el documento desde disco y `guardar(doc, claves)` lo
+    persiste; `claves` son las claves de primer nivel que cambiaron (None = todas).
+    Los lectores reciben la instantánea vigente sin tomar el lock; los
+    escritores nunca la modifican en sitio, sino que publican una copia nueva.
+
+    Compartido entre procesos: `firma()` devuelve la versión de lo guardado (None =
+    documento de este proceso, nunca se revalida). Las lecturas la comparan como mucho
+    cada `intervalo` segundos y recargan si cambió; las escrituras toman `bloqueo`
+    (un BloqueoArchivo) y `actualizar()` revalida antes de aplicar, así no se pisan
+    cambios de otro proceso. Con firma, `guardar` debe ser síncrono.
+    """
+
+    def __init__(self, nombre, cargar, guardar, firma=None, intervalo=0.0, bloqueo=None):
+        self.nombre = nombre
+        self._cargar = cargar
+        self._guardar = guardar
+        self._firma_fn = firma
+        self.intervalo = intervalo
+        self._bloqueo = bloqueo
+        self._doc = None
+        self._firma = None
+        self._proxima_revision = 0.0
+        self._lock = threading.Lock()  # solo escritores, primera carga y recargas
+        self.hits = Contador()
+        self.misses = Contador()
+        self.recargas = Contador()
+
+    def _firma_actual(self):
+        try:
+            return self._firma_fn()
+        except Exception:
+            return None
+
+    def _cargar_si_cambio(self):
+        # Con self._lock tomado: carga la primera vez o si otro proceso cambió el documento
+        if self._doc is not None and self._firma_fn is None:
+            return
+        self._proxima_revision = time.monotonic() + self.intervalo
+        if self._doc is not None:
+            firma = self._firma_actual()
+            if firma == self._firma:
+                return
+            self.recargas.inc()
+        else:
+            self.misses.inc()
+            firma = self._firma_actual() if self._firma_fn else None
+        # La firma se toma antes de cargar: si cambia mientras tanto, la próxima revisión recarga
+        self._firma = firma
+        self._doc = self._cargar()
+
+    def leer(self):
+        doc = self._doc
+        if doc is not None and (self._firma_fn is None or time.monotonic() < self._proxima_revision):
+            self.hits.inc()
+            return doc
+        with self._lock:
+            if self._doc is not None:
+                self.hits.inc()
+            self._cargar_si_cambio()
+            return self._doc
+
+    def _escrito(self):
+        # Tras escribir con el bloqueo tomado nadie más pudo cambiarlo: la firma nueva es la propia.
+        # Sin bloqueo no se sabe, y la próxima revisión recarga.
+        if self._firma_fn is not None:
+            self._firma = self._firma_actual() if self._bloqueo is not None else None
+
+    def escribir(self, data):
+        with self._lock, self._bloqueo or nullcontext():
+            ok = self._guardar(data)
+            self._doc = data
+            self._escrito()
+            return ok
+
+    def actualizar(self, fn, claves=None):
+        # Copy-on-write: fn recibe una copia superficial y devuelve el documento nuevo
+        with self._lock, self._bloqueo or nullcontext():
+            self._proxima_revision = 0.0
+            self._cargar_si_cambio()
+            nuevo = fn(dict(self._doc))
+            ok = self._guardar(nuevo, claves)
+            self._doc = nuevo
+            self._escrito()
+            return ok
+
+    def estadisticas(self):
+        hits, misses = self.hits.valor(), self.misses.valor()
+        total = hits + misses
+        return {
+            "documento": self.nombre,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            "recargas": self.recargas.valor(),
+        }
+
+# =========================
+# Escritura diferida
+# =========================
+class EscrituraDiferida:
+    """Persiste en segundo plano la última versión marcada de un documento.
+
+    Tras `marcar(doc)` se espera `retardo` segundos sin cambios nuevos antes de
+    escribir (debounce), pero nunca más de `max_retardo` desde el primer cambio
+    pendiente. Al salir del proceso se hace un vaciado final garantizado.
+    """
+
+    def __init__(self, nombre, guardar, retardo=0.5, max_retardo=5.0):
+        self.nombre = nombre
+        self._guardar = guardar
+        self.retardo = retardo
+        self.max_retardo = max(max_retardo, retardo)
+        self._cond = threading.Condition()
+        self._lock_escritura = threading.Lock()
+        self._pendiente = None
+        self._claves = None
+        self._primer_cambio = None
+        self._ultimo_cambio = None
+        self._detenido = False
+        self.marcas = Contador()
+        self.escrituras = Contador()
+        self.errores = Contador()
+        self._hilo = threading.Thread(target=self._bucle, name=f"flush-{nombre}", daemon=True)
+        self._hilo.start()
+        atexit.register(self.detener)
+
+    def marcar(self, doc, claves=None):
+        # claves: claves de primer nivel modificadas (None = documento completo)
+        with self._cond:
+            ahora = time.monotonic()
+            if self._pendiente is None:
+                self._primer_cambio = ahora
+                self._claves = set(claves) if claves is not None else None
+            elif self._claves is not None:
+                if claves is None:
+                    self._claves = None
+                else:
+                    self._claves.update(claves)
+            self._pendiente = doc
+            self._ultimo_cambio = ahora
+            self.marcas.inc()
+            self._cond.notify()
+        return True
+
+    def _plazo(self):
+        return min(self._ultimo_cambio + self.retardo, self._primer_cambio + self.max_retardo)
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while self._pendiente is None and not self._detenido:
+                    self._cond.wait()
+                if self._pendiente is None and self._detenido:
+                    return
+                while not self._detenido:
+                    espera = self._plazo() - time.monotonic()
+                    if espera <= 0:
+                        break
+                    self._cond.wait(espera)
+            self.vaciar()
+            if self._detenido:
+                return
+
+    def vaciar(self):
+        # Escribe ya lo pendiente (si hay); si falla, queda pendiente para reintentar.
+        # _lock_escritura evita que una versión vieja termine de escribirse después de una nueva.
+        with self._lock_escritura:
+            with self._cond:
+                doc, claves = self._pendiente, self._claves
+                self._pendiente, self._claves = None, None
+            if doc is None:
+                return True
+            try:
+                ok = self._guardar(doc, claves)
+            except Exception:
+                ok = False
+            if ok:
+                self.escrituras.inc()
+                return True
+            self.errores.inc()
+            with self._cond:
+                if self._pendiente is None:
+                    ahora = time.monotonic()
+                    self._pendiente, self._claves = doc, claves
+                    self._primer_cambio = self._ultimo_cambio = ahora
+                else:
+                    # llegó una versión más nueva: conserva también las claves que no se escribieron
+                    if self._claves is not None:
+                        self._claves = None if claves is None else self._claves | claves
+            return False
+
+    def detener(self):
+        with self._cond:
+            self._detenido = True
+            self._cond.notify()
+        self._hilo.join(timeout=self.max_retardo + 5)
+        return self.vaciar()
+
+    def estadisticas(self):
+        return {
+            "documento": self.nombre,
+            "marcas": self.marcas.valor(),
+            "escrituras": self.escrituras.valor(),
+            "errores": self.errores.valor(),
+            "pendiente": self._pendiente is not None,
+        }
+
+# =========================
+# Almacenes (backends)
+# =========================
+class AlmacenJSON:
+    """Backend por defecto: un archivo JSON por documento (la ruta es el nombre)."""
+
+    nombre = "json"
+
+    def __init__(self, lock):
+        self._lock = lock
+
+    def cargar(self, path, default):
+        with self._lock:
+            if not os.path.exists(path):
+                return default
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+    def guardar(self, path, data, claves=None, indent=2):
+        # Un documento JSON no admite escrituras parciales: siempre se reescribe completo
+        with self._lock:
+            escribir_json_atomico(path, data, indent=indent)
+        return True
+
+    def asegurar(self, path, default):
+        if not os.path.exists(path):
+            self.guardar(path, default)
+
+    def firma(self, path):
+        # Cada guardado reemplaza el archivo (rename): cambia el inode y el mtime
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+
+class AlmacenSQLite:
+    """Backend SQLite en modo WAL.
+
+    - Catálogo: una fila por combo (clave `producto|medida|mercado`)
+    - Configuración de turno: una fila por (chat, llenadora)
+    - Resto de documentos: una fila por clave de primer nivel
+    Las escrituras con `claves` solo tocan las filas de esas claves.
+    Cada guardado sube `version:<documento>` en meta (la firma que ven otros procesos).
+    """
+
+    nombre = "sqlite"
+
+    ESQUEMA = """
+    CREATE TABLE IF NOT EXISTS catalogo (
+        combo_key TEXT PRIMARY KEY,
+        producto  TEXT,
+        medida    TEXT,
+        mercado   TEXT,
+        datos     TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS catalogo_producto_medida ON catalogo (producto, medida);
+    CREATE TABLE IF NOT EXISTS config_turno (
+        chat_id   TEXT NOT NULL,
+        llenadora TEXT NOT NULL,
+        datos     TEXT NOT NULL,
+        PRIMARY KEY (chat_id, llenadora)
+    );
+    CREATE TABLE IF NOT EXISTS documentos (
+        documento TEXT NOT NULL,
+        clave     TEXT NOT NULL,
+        datos     TEXT NOT NULL,
+        PRIMARY KEY (documento, clave)
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        clave TEXT PRIMARY KEY,
+        valor TEXT
+    );
+    """
+
+    def __init__(self, db_path, catalogo_path, config_path):
+        self.db_path = db_path
+        self._catalogo_path = catalogo_path
+        self._config_path = config_path
+        self._local = threading.local()
+        self._conexion().executescript(self.ESQUEMA)
+
+    def _conexion(self):
+        # Una conexión por hilo; WAL permite lectores concurrentes con un escritor
+        cx = getattr(self._local, "cx", None)
+        if cx is None:
+            cx = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            cx.execute("PRAGMA journal_mode=WAL")
+            cx.execute("PRAGMA synchronous=NORMAL")
+            cx.execute("PRAGMA busy_timeout=10000")
+            self._local.cx = cx
+        return cx
+
+    class _Transaccion:
+        def __init__(self, cx):
+            self.cx = cx
+
+        def __enter__(self):
+            self.cx.execute("BEGIN IMMEDIATE")
+            return self.cx
+
+        def __exit__(self, tipo, *_):
+            self.cx.execute("ROLLBACK" if tipo else "COMMIT")
+            return False
+
+    def _tx(self):
+        return self._Transaccion(self._conexion())
+
+    # --- lectura ---
+    def cargar(self, path, default):
+        cx = self._conexion()
+        if path == self._catalogo_path:
+            filas = cx.execute("SELECT combo_key, datos FROM catalogo").fetchall()
+            doc = {k: json.loads(d) for k, d in filas}
+        elif path == self._config_path:
+            doc = {}
+            for chat, ll, d in cx.execute("SELECT chat_id, llenadora, datos FROM config_turno"):
+                doc.setdefault(chat, {})[ll] = json.loads(d)
+        else:
+            filas = cx.execute("SELECT clave, datos FROM documentos WHERE documento = ?", (path,)).fetchall()
+            doc = {k: json.loads(d) for k, d in filas}
+        return doc if doc else default
+
+    # --- escritura ---
+    def guardar(self, path, data, claves=None, indent=None):
+        with self._tx() as cx:
+            if claves is None:
+                self._borrar(cx, path, None)
+                claves = data.keys()
+            for clave in claves:
+                self._borrar(cx, path, clave)
+                if clave in data:
+                    self._insertar(cx, path, clave, data[clave])
+            cx.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES (?, "
+                       "COALESCE((SELECT CAST(valor AS INTEGER) FROM meta WHERE clave = ?), 0) + 1)",
+                       (f"version:{path}", f"version:{path}"))
+        return True
+
+    def firma(self, path):
+        fila = self._conexion().execute("SELECT valor FROM meta WHERE clave = ?", (f"version:{path}",)).fetchone()
+        return int(fila[0]) if fila else None
+
+    def _borrar(self, cx, path, clave):
+        if path == self._catalogo_path:
+            sql, args, col = "DELETE FROM catalogo WHERE 1 = 1", (), "combo_key"
+        elif path == self._config_path:
+            sql, args, col = "DELETE FROM config_turno WHERE 1 = 1", (), "chat_id"
+        else:
+            sql, args, col = "DELETE FROM documentos WHERE documento = ?", (path,), "clave"
+        if clave is not None:
+            sql += f" AND {col} = ?"
+            args += (str(clave),)
+        cx.execute(sql, args)
+
+    def _insertar(self, cx, path, clave, valor):
+        if path == self._catalogo_path:
+            partes = (clave.split("|") + ["", "", ""])[:3]
+            cx.execute("INSERT INTO catalogo (combo_key, producto, medida, mercado, datos) VALUES (?,?,?,?,?)",
+                       (clave, *partes, json.dumps(valor, ensure_ascii=False)))
+        elif path == self._config_path:
+            cx.executemany("INSERT INTO config_turno (chat_id, llenadora, datos) VALUES (?,?,?)",
+                           [(str(clave), ll, json.dumps(combo, ensure_ascii=False)) for ll, combo in (valor or {}).items()])
+        else:
+            cx.execute("INSERT INTO documentos (documento, clave, datos) VALUES (?,?,?)",
+                       (path, str(clave), json.dumps(valor, ensure_ascii=False)))
+
+    def asegurar(self, path, default):
+        pass  # las tablas ya existen; un documento vacío no necesita filas
+
+    # --- migración ---
+    def migrado(self):
+        fila = self._conexion().execute("SELECT valor FROM meta WHERE clave = 'migrado_json'").fetchone()
+        return fila is not None
+
+    def migrar_desde_json(self, rutas):
+        # Importa cada JSON existente (reemplazando lo que haya) y deja la marca de migración
+        importados = {}
+        for path in rutas:
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self.guardar(path, data)
+                importados[path] = len(data)
+        with self._tx() as cx:
+            cx.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('migrado_json', ?)",
+                       (time.strftime("%Y-%m-%dT%H:%M:%S"),))
+        return importados
+
+
+def crear_almacen(backend, lock, sqlite_path, catalogo_path, config_path, rutas_json):
+    """Devuelve el almacén configurado; SQLite importa los JSON la primera vez que se abre."""
+    if backend == "sqlite":
+        almacen = AlmacenSQLite(sqlite_path, catalogo_path, config_path)
+        if not almacen.migrado():
+            importados = almacen.migrar_desde_json(rutas_json)
+            print(f"Migración JSON -> SQLite ({sqlite_path}): {importados}")
+        return almacen
+    return AlmacenJSON(lock)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrar":
+        destino = sys.argv[2] if len(sys.argv) > 2 else os.getenv("SQLITE_PATH", "bot.sqlite3")
+        almacen = AlmacenSQLite(destino, "catalogo_skus.json", "config_turno.json")
+        print(almacen.migrar_desde_json(["catalogo_skus.json", "config_turno.json",
+                                         "ordenes_semana.json", "progreso_semana.json"]))
+    else:
+        print("Uso: python persistencia.py migrar [bot.sqlite3]")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ritmo de producción por llenadora en ventanas deslizantes
+- Cada lote cerrado (con su ts) suma canastas y cajas a tres ventanas por chat y
+  llenadora: última hora, turno (TURNO_HORAS) y día (24 h)
+- Cada chat ve solo su producción: M1 de una línea no se mezcla con M1 de otra
+- Cada ventana es un anillo de cubetas de tamaño fijo: una cubeta vieja se reutiliza
+  cuando el tiempo da la vuelta, así la memoria por serie no crece con el uso
+- Las cajas ya vienen calculadas con CAJAS_POR_CANASTA al cerrar el lote
+- Al arrancar se puede recargar desde la bitácora (lotes de las últimas 24 h)
+"""
+
+import threading
+from datetime import datetime
+
+from claves_envase import LLENADORAS
+
+
+class VentanaCircular:
+    """Suma deslizante sobre `cubetas` cubetas de duracion/cubetas segundos."""
+
+    __slots__ = ("duracion", "n", "ancho", "_id", "_canastas", "_cajas", "_lotes")
+
+    def __init__(self, duracion_seg, cubetas):
+        self.duracion = float(duracion_seg)
+        self.n = int(cubetas)
+        self.ancho = self.duracion / self.n
+        self._id = [None] * self.n      # índice absoluto (t // ancho) de lo que guarda cada cubeta
+        self._canastas = [0] * self.n
+        self._cajas = [0.0] * self.n
+        self._lotes = [0] * self.n
+
+    def agregar(self, t, canastas, cajas):
+        """`t` en segundos epoch. Devuelve False si el lote es más viejo que lo que cubre el anillo."""
+        i = int(t // self.ancho)
+        s = i % self.n
+        if self._id[s] != i:
+            if self._id[s] is not None and self._id[s] > i:
+                return False
+            self._id[s] = i
+            self._canastas[s] = 0
+            self._cajas[s] = 0.0
+            self._lotes[s] = 0
+        self._canastas[s] += canastas
+        self._cajas[s] += cajas
+        self._lotes[s] += 1
+        return True
+
+    def totales(self, t):
+        actual = int(t // self.ancho)
+        minimo = actual - self.n + 1
+        canastas, cajas, lotes = 0, 0.0, 0
+        for s in range(self.n):
+            i = self._id[s]
+            if i is not None and minimo <= i <= actual:
+                canastas += self._canastas[s]
+                cajas += self._cajas[s]
+                lotes += self._lotes[s]
+        return canastas, cajas, lotes
+
+
+class RitmoLlenadoras:
+    """Ventanas por (chat, llenadora). `ventanas`: [(nombre, duración en segundos, cubetas)]."""
+
+    def __init__(self, turno_horas=8, ventanas=None):
+        self.ventanas = ventanas or [
+            ("hora", 3600, 60),                        # cubetas de 1 min
+            ("turno", int(turno_horas * 3600), 96),    # 5 min con turno de 8 h
+            ("día", 86400, 96),                        # 15 min
+        ]
+        self._lock = threading.Lock()
+        self._series = {}   # (chat_id, llenadora) -> {"ventanas": [VentanaCircular], "primero": epoch}
+        self.descartados = 0
+
+    def _de(self, clave):
+        d = self._series.get(clave)
+        if d is None:
+            d = self._series[clave] = {
+                "ventanas": [VentanaCircular(dur, n) for _, dur, n in self.ventanas], "primero": None}
+        return d
+
+    def registrar(self, ts, chat_id, llenadora, canastas, cajas):
+        """`ts`: datetime del lote (o texto ISO, como en la bitácora)."""
+        if isinstance(ts, str):
+            ts = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S")
+        t = ts.timestamp()
+        with self._lock:
+            d = self._de((str(chat_id), llenadora))
+            if not all([v.agregar(t, int(canastas), float(cajas)) for v in d["ventanas"]]):
+                self.descartados += 1
+            d["primero"] = t if d["primero"] is None else min(d["primero"], t)
+
+    def cargar(self, registros):
+        """Recarga desde registros de la bitácora (ts, chat_id, llenadora, canastas, cajas)."""
+        n = 0
+        for r in registros:
+            try:
+                self.registrar(r["ts"], r["chat_id"], r["llenadora"], r["canastas"], r["cajas"])
+                n += 1
+            except (KeyError, TypeError, ValueError):
+                continue
+        return n
+
+    def ritmos(self, ahora=None, chat_id=None):
+        """{llenadora: {ventana: {canastas, cajas, lotes, canastas_h, cajas_h, horas}}} de `chat_id`
+        (None = todos los chats sumados).
+
+        Si la primera producción vista es más reciente que la ventana, el ritmo se divide
+        por el tiempo transcurrido desde entonces (mínimo 1 h, para no inflar el primer lote).
+        """
+        t = (ahora or datetime.now()).timestamp()
+        chat = None if chat_id is None else str(chat_id)
+        sumas = {}   # llenadora -> ([[canastas, cajas, lotes] por ventana], primero)
+        with self._lock:
+            for (ch, ll), d in self._series.items():
+                if chat is not None and ch != chat:
+                    continue
+                acum, primero = sumas.get(ll) or ([[0, 0.0, 0] for _ in self.ventanas], d["primero"])
+                for a, v in zip(acum, d["ventanas"]):
+                    for i, x in enumerate(v.totales(t)):
+                        a[i] += x
+                sumas[ll] = (acum, min(primero, d["primero"]))
+        res = {}
+        for ll, (acum, primero) in sumas.items():
+            fila = {}
+            for (nombre, dur, _), (canastas, cajas, lotes) in zip(self.ventanas, acum):
+                horas = max(1.0, min(dur, t - primero) / 3600.0)
+                fila[nombre] = {"canastas": canastas, "cajas": cajas, "lotes": lotes, "horas": horas,
+                                "canastas_h": canastas / horas, "cajas_h": cajas / horas}
+            res[ll] = fila
+        return res
+
+    def estadisticas(self):
+        with self._lock:
+            return {"series": len(self._series), "llenadoras": len({ll for _, ll in self._series}),
+                    "chats": len({ch for ch, _ in self._series}), "descartados": self.descartados,
+                    "cubetas_por_serie": sum(n for _, _, n in self.ventanas)}
+
+
+def _etiqueta(nombre, horas_ventana):
+    return {"hora": "1 h", "día": "24 h"}.get(nombre, f"{horas_ventana:g} h")
+
+
+def texto_ritmo(ritmos, ventanas, esc=str):
+    """Vista para Telegram (Markdown). `ventanas` como en RitmoLlenadoras.ventanas."""
+    def fmt(v):
+        s = f"{v:,.1f}".replace(",", " ")
+        return s[:-2] if s.endswith(".0") else s
+
+    lineas = ["⏱ *Ritmo por llenadora*", "🧺 canastas/h | 📦 cajas/h"]
+    orden = LLENADORAS + sorted(ll for ll in ritmos if ll not in LLENADORAS)
+    for ll in orden:
+        fila = ritmos.get(ll)
+        if not fila or not any(v["lotes"] for v in fila.values()):
+            lineas.append(f"\n*{esc(ll)}*: sin lotes en las últimas 24 h")
+            continue
+        lineas.append(f"\n*{esc(ll)}*")
+        for nombre, dur, _ in ventanas:
+            v = fila[nombre]
+            lineas.append(f"• {_etiqueta(nombre, dur / 3600.0)}: 🧺 {fmt(v['canastas_h'])} | 📦 {fmt(v['cajas_h'])}"
+                          f"  ({v['lotes']} lotes)")
+    return "\n".join(lineas)
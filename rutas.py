@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Enrutador de callback_data (botones inline)
+- Rutas registradas por patrón: "carga_menu" (exacta) o "c_n_ll_{llenadora}" (prefijo + argumentos)
+- Resolución: un dict para las exactas y, para prefijos, una consulta por cada largo de prefijo
+  distinto (pocos), del más largo al más corto: agregar rutas no encarece las demás
+- Argumentos tipados ({n:int}, {x:float}, {s} = str) separados por "_"; el último se queda
+  con el resto del payload, así valores con "_" no se cortan
+- Métricas por ruta: llamadas, errores, latencia total/máxima; observadores para monitoreo
+"""
+
+import time
+import threading
+
+from persistencia import Contador
+
+_TIPOS = {"str": str, "int": int, "float": float}
+
+
+class Ruta:
+    def __init__(self, patron, handler):
+        self.patron = patron
+        self.handler = handler
+        i = patron.find("{")
+        self.prefijo = patron if i < 0 else patron[:i]
+        self.args = []
+        if i >= 0:
+            for parte in patron[i:].split("_"):
+                if not (parte.startswith("{") and parte.endswith("}")):
+                    raise ValueError(f"patrón inválido: {patron}")
+                nombre, _, tipo = parte[1:-1].partition(":")
+                self.args.append((nombre, _TIPOS[tipo or "str"]))
+        self.llamadas = Contador()
+        self.errores = Contador()
+        self._lock = threading.Lock()
+        self._total_seg = 0.0
+        self._max_seg = 0.0
+
+    def parsear(self, resto):
+        if not self.args:
+            return {}
+        valores = resto.split("_", len(self.args) - 1)
+        if len(valores) != len(self.args) or not all(valores):
+            return None
+        try:
+            return {nombre: tipo(v) for (nombre, tipo), v in zip(self.args, valores)}
+        except ValueError:
+            return None
+
+    def medir(self, seg):
+        with self._lock:
+            self._total_seg += seg
+            if seg > self._max_seg:
+                self._max_seg = seg
+
+    def estadisticas(self):
+        n = self.llamadas.valor()
+        with self._lock:
+            return {
+                "llamadas": n,
+                "errores": self.errores.valor(),
+                "prom_ms": round(self._total_seg * 1000.0 / n, 3) if n else 0.0,
+                "max_ms": round(self._max_seg * 1000.0, 3),
+            }
+
+
+class Enrutador:
+    """Despacha callback_data a handler(chat_id, estado, **args)."""
+
+    def __init__(self, nombre="callbacks"):
+        self.nombre = nombre
+        self._exactas = {}
+        self._prefijos = {}
+        self._largos = []
+        self.sin_ruta = Contador()
+        self.invalidos = Contador()
+        self.observadores = []  # fn(patron, segundos, ok) tras cada despacho
+
+    def ruta(self, patron):
+        def registrar(handler):
+            r = Ruta(patron, handler)
+            if not r.args:
+                self._exactas[r.prefijo] = r
+            else:
+                if r.prefijo in self._prefijos:
+                    raise ValueError(f"prefijo duplicado: {r.prefijo}")
+                self._prefijos[r.prefijo] = r
+                self._largos = sorted({len(p) for p in self._prefijos}, reverse=True)
+            return handler
+        return registrar
+
+    def resolver(self, data):
+        # -> (Ruta, args) o (None, None)
+        r = self._exactas.get(data)
+        if r is not None:
+            return r, {}
+        for n in self._largos:
+            if n < len(data):
+                r = self._prefijos.get(data[:n])
+                if r is not None:
+                    args = r.parsear(data[n:])
+                    if args is None:
+                        self.invalidos.inc()
+                        return None, None
+                    return r, args
+        self.sin_ruta.inc()
+        return None, None
+
+    def despachar(self, data, chat_id, estado):
+        r, args = self.resolver(data or "")
+        if r is None:
+            return False
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            r.handler(chat_id, estado, **args)
+            ok = True
+        except Exception:
+            r.errores.inc()
+            raise
+        finally:
+            seg = time.perf_counter() - t0
+            r.llamadas.inc()
+            r.medir(seg)
+            for obs in self.observadores:
+                try:
+                    obs(r.patron, seg, ok)
+                except Exception:
+                    pass
+        return True
+
+    def estadisticas(self):
+        rutas = {r.patron: r.estadisticas() for r in list(self._exactas.values()) + list(self._prefijos.values())}
+        return {"enrutador": self.nombre, "rutas": rutas,
+                "sin_ruta": self.sin_ruta.valor(), "invalidos": self.invalidos.valor()}
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP compartido para la Bot API de Telegram
+- Una sola requests.Session con pool de conexiones keep-alive (sin TCP+TLS por llamada)
+- Timeouts explícitos de conexión y lectura (un Telegram colgado no bloquea el worker)
+- Estadísticas de latencia por método (llamadas, errores, promedio, p50/p95/p99, máx.)
+- Respuesta en línea del webhook: una llamada "diferible" puede viajar en el cuerpo
+  de la respuesta HTTP al webhook en vez de hacer un request saliente
+- Programador de envíos: cubo de tokens global + uno por chat, respeta 429 retry_after
+  (reencola), prioriza respuestas interactivas sobre resúmenes y mantiene el orden por chat
+- Mensaje activo por chat: los pasos de un flujo editan el mismo mensaje (editMessageText)
+  en vez de enviar uno nuevo cada vez
+"""
+
+import time
+import heapq
+import queue
+import atexit
+import itertools
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from persistencia import Contador
+
+# Prioridades del programador (menor = antes)
+INTERACTIVO = 0
+MASIVO = 1
+
+def _futuro_hecho(valor):
+    f = Future()
+    f.set_result(valor)
+    return f
+
+
+class LatenciasMetodo:
+    # Acumulados + ventana de las últimas N muestras para percentiles
+    def __init__(self, ventana=512):
+        self.llamadas = 0
+        self.errores = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.muestras = deque(maxlen=ventana)
+
+    def registrar(self, ms, ok):
+        self.llamadas += 1
+        if not ok:
+            self.errores += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+        self.muestras.append(ms)
+
+    def resumen(self):
+        orden = sorted(self.muestras)
+
+        def pct(p):
+            if not orden:
+                return 0.0
+            return round(orden[min(len(orden) - 1, int(p / 100.0 * len(orden)))], 2)
+
+        return {
+            "llamadas": self.llamadas,
+            "errores": self.errores,
+            "prom_ms": round(self.total_ms / self.llamadas, 2) if self.llamadas else 0.0,
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+class RespuestaWebhook:
+    # Llamada reservada para el cuerpo de la respuesta HTTP del webhook (a lo sumo una)
+    def __init__(self):
+        self.reservada = None   # (metodo, payload)
+        self.agotada = False    # ya hubo varios mensajes: todo sale por la red
+
+    def cuerpo(self):
+        if not self.reservada:
+            return None
+        metodo, payload = self.reservada
+        return dict(payload, method=metodo)
+
+
+class ClienteTelegram:
+    def __init__(self, api_url, pool=10, timeout_conexion=3.05, timeout_lectura=10.0):
+        self.api_url = api_url
+        self.timeout = (timeout_conexion, timeout_lectura)
+        self.session = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=pool, pool_block=False, max_retries=0)
+        self.session.mount("https://", adaptador)
+        self.session.mount("http://", adaptador)
+        self._lock = threading.Lock()
+        self._latencias = {}
+        self._local = threading.local()
+        self.en_respuesta = 0  # llamadas que viajaron en la respuesta del webhook
+        self.programador = None  # ProgramadorEnvios opcional para los envíos con chat_id
+        self.observadores = []   # fn(metodo, segundos, ok) tras cada llamada HTTP
+
+    @contextmanager
+    def respuesta_en_linea(self):
+        """Dentro del bloque, los envíos diferibles del hilo se pueden reservar para la respuesta del webhook.
+
+        - answerCallbackQuery queda reservada y el resto sale por la red
+        - un único sendMessage queda reservado; si el handler emite varios, todos salen por la red
+        """
+        resp = RespuestaWebhook()
+        self._local.respuesta = resp
+        try:
+            yield resp
+        finally:
+            self._local.respuesta = None
+            if resp.reservada and resp.reservada[0] != "answerCallbackQuery" and self.programador:
+                # Si el chat aún tiene mensajes en cola, la respuesta los adelantaría: se encola también
+                chat_id = resp.reservada[1].get("chat_id")
+                if self.programador.pendientes(chat_id):
+                    metodo, payload = resp.reservada
+                    resp.reservada = None
+                    self.programador.encolar(metodo, payload, chat_id)
+            if resp.reservada:
+                with self._lock:
+                    self.en_respuesta += 1
+
+    def llamar(self, metodo, payload=None, timeout_lectura=None):
+        """POST JSON a /<metodo> (síncrono). Devuelve el JSON de respuesta o None si falló la red."""
+        return self._post(metodo, payload, timeout_lectura)
+
+    def enviar(self, metodo, payload, chat_id=None, prioridad=INTERACTIVO, diferible=False):
+        """Envío saliente; devuelve un Future con el JSON de respuesta (None si se descartó).
+
+        Con `chat_id` y programador configurado, pasa por la cola con límites de tasa.
+        `diferible`: el llamador no necesita el resultado, así que dentro de
+        respuesta_en_linea() puede viajar en la respuesta del webhook.
+        """
+        resp = getattr(self._local, "respuesta", None)
+        if resp is not None and not diferible and chat_id is not None:
+            # Un envío por la red no puede adelantarse al mensaje reservado para la respuesta
+            previa = resp.reservada
+            resp.agotada = True
+            if previa is not None and previa[0] != "answerCallbackQuery":
+                resp.reservada = None
+                self._despachar(previa[0], previa[1], previa[1].get("chat_id"), prioridad)
+        if diferible and resp is not None:
+            previa = resp.reservada
+            if previa is None and not (resp.agotada and metodo != "answerCallbackQuery"):
+                resp.reservada = (metodo, payload)
+                return _futuro_hecho({"ok": True, "result": True, "en_respuesta": True})
+            if previa is not None and previa[0] != "answerCallbackQuery":
+                # Varios mensajes: el reservado sale por la red (antes que este) y no se reserva más
+                resp.reservada = None
+                resp.agotada = True
+                self._despachar(previa[0], previa[1], previa[1].get("chat_id"), prioridad)
+        return self._despachar(metodo, payload, chat_id, prioridad)
+
+    def _despachar(self, metodo, payload, chat_id, prioridad):
+        if self.programador is not None and chat_id is not None:
+            return self.programador.encolar(metodo, payload, chat_id, prioridad)
+        return _futuro_hecho(self._post(metodo, payload, None))
+
+    def _post(self, metodo, payload, timeout_lectura):
+        timeout = self.timeout if timeout_lectura is None else (self.timeout[0], timeout_lectura)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            res = self.session.post(f"{self.api_url}/{metodo}", json=payload or {}, timeout=timeout)
+            try:
+                data = res.json()
+            except ValueError:
+                data = {"ok": False, "error_code": res.status_code, "description": res.text[:200]}
+            ok = bool(data.get("ok"))
+            # Editar con el mismo contenido (p. ej. "Actualizar" sin cambios) no es un error real
+            if not ok and "message is not modified" not in (data.get("description") or ""):
+                print(f"❗ Telegram {metodo} respondió {data.get('error_code')}: {data.get('description')}")
+            return data
+        except requests.RequestException as e:
+            print(f"❗ Error de red en {metodo}:", e)
+            return None
+        finally:
+            self._registrar(metodo, (time.perf_counter() - t0) * 1000.0, ok)
+
+    def _registrar(self, metodo, ms, ok):
+        with self._lock:
+            lat = self._latencias.get(metodo)
+            if lat is None:
+                lat = self._latencias[metodo] = LatenciasMetodo()
+            lat.registrar(ms, ok)
+        for obs in self.observadores:
+            try:
+                obs(metodo, ms / 1000.0, ok)
+            except Exception:
+                pass
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "metodos": {metodo: lat.resumen() for metodo, lat in self._latencias.items()},
+                "en_respuesta_webhook": self.en_respuesta,
+            }
+
+
+# =========================
+# Mensaje activo por chat
+# =========================
+class MensajesActivos:
+    """Mensaje "activo" de cada chat: cada paso de un flujo lo edita en lugar de enviar otro.
+
+    - `fijar()` al recibir un callback (el mensaje del botón tocado); un envío nuevo queda
+      activo cuando su Future trae el message_id (sin bloquear el handler)
+    - `mostrar()` edita el activo con editMessageText; sin activo, envía uno nuevo
+    - si la edición falla con 400 (mensaje borrado o demasiado viejo) se envía uno nuevo
+    - `cerrar()` quita el teclado del activo (editMessageReplyMarkup) y lo olvida: lo que
+      venga después (resumen, clave) sale como mensaje nuevo y no quedan botones viejos
+    Estas llamadas nunca son diferibles: se necesita su resultado.
+    El activo dura lo que dura un update: los bots llaman `olvidar()` al terminar cada uno,
+    así el siguiente no depende de lo que recuerde este proceso.
+    """
+
+    def __init__(self, cliente, max_chats=10000):
+        self.cliente = cliente
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._activos = OrderedDict()  # chat -> message_id, o un _Pendiente mientras se envía
+        self.ediciones = Contador()
+        self.nuevos = Contador()
+        self.reenviados = Contador()
+        self.cerrados = Contador()
+
+    class _Pendiente:
+        pass
+
+    def _poner(self, chat, valor):
+        self._activos[chat] = valor
+        self._activos.move_to_end(chat)
+        while len(self._activos) > self.max_chats:
+            self._activos.popitem(last=False)
+
+    def fijar(self, chat_id, message_id):
+        if message_id is None:
+            return
+        with self._lock:
+            self._poner(str(chat_id), message_id)
+
+    def activo(self, chat_id):
+        with self._lock:
+            mid = self._activos.get(str(chat_id))
+        return None if isinstance(mid, self._Pendiente) else mid
+
+    def olvidar(self, chat_id):
+        with self._lock:
+            self._activos.pop(str(chat_id), None)
+
+    def mostrar(self, chat_id, payload, prioridad=INTERACTIVO):
+        """payload como el de sendMessage (chat_id, text, reply_markup, parse_mode). Devuelve un Future."""
+        mid = self.activo(chat_id)
+        if mid is None:
+            return self._nuevo(chat_id, payload, prioridad)
+        self.ediciones.inc()
+        futuro = self.cliente.enviar("editMessageText", dict(payload, message_id=mid),
+                                     chat_id=chat_id, prioridad=prioridad)
+        futuro.add_done_callback(lambda f: self._tras_editar(f, chat_id, mid, payload, prioridad))
+        return futuro
+
+    def _tras_editar(self, futuro, chat_id, mid, payload, prioridad):
+        data = futuro.result()
+        if data is None or data.get("ok") or "not modified" in (data.get("description") or ""):
+            return
+        descripcion = data.get("description") or ""
+        if data.get("error_code") == 400 and ("not found" in descripcion or "can't be edited" in descripcion):
+            with self._lock:
+                if self._activos.get(str(chat_id)) == mid:
+                    del self._activos[str(chat_id)]
+            self.reenviados.inc()
+            self._nuevo(chat_id, payload, prioridad)
+
+    def _nuevo(self, chat_id, payload, prioridad):
+        pendiente = self._Pendiente()
+        with self._lock:
+            self._poner(str(chat_id), pendiente)
+        self.nuevos.inc()
+        futuro = self.cliente.enviar("sendMessage", payload, chat_id=chat_id, prioridad=prioridad)
+        futuro.add_done_callback(lambda f: self._tras_enviar(f, chat_id, pendiente))
+        return futuro
+
+    def _tras_enviar(self, futuro, chat_id, pendiente):
+        res = (futuro.result() or {}).get("result")
+        mid = res.get("message_id") if isinstance(res, dict) else None
+        with self._lock:
+            # Solo si nadie lo reemplazó mientras tanto (otro callback, olvidar, ...)
+            if self._activos.get(str(chat_id)) is pendiente:
+                if mid is None:
+                    del self._activos[str(chat_id)]
+                else:
+                    self._activos[str(chat_id)] = mid
+
+    def cerrar(self, chat_id):
+        with self._lock:
+            mid = self._activos.pop(str(chat_id), None)
+        if mid is None or isinstance(mid, self._Pendiente):
+            return None
+        self.cerrados.inc()
+        return self.cliente.enviar("editMessageReplyMarkup",
+                                   {"chat_id": chat_id, "message_id": mid, "reply_markup": {"inline_keyboard": []}},
+                                   chat_id=chat_id)
+
+    def estadisticas(self):
+        with self._lock:
+            chats = len(self._activos)
+        return {"chats": chats, "ediciones": self.ediciones.valor(), "nuevos": self.nuevos.valor(),
+                "reenviados": self.reenviados.valor(), "cerrados": self.cerrados.valor()}
+
+
+# =========================
+# Programador de envíos
+# =========================
+class CuboTokens:
+    def __init__(self, tasa, capacidad):
+        self.tasa = float(tasa)
+        self.capacidad = float(capacidad)
+        self.tokens = float(capacidad)
+        self.t = time.monotonic()
+
+    def espera(self, ahora):
+        # Segundos hasta tener un token (0 si hay uno ya)
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.t) * self.tasa)
+        self.t = ahora
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.tasa
+
+    def tomar(self):
+        self.tokens -= 1.0
+
+    def lleno(self, ahora):
+        # Un cubo lleno equivale a uno nuevo: se puede descartar sin cambiar los límites
+        return self.tokens + (ahora - self.t) * self.tasa >= self.capacidad
+
+
+class _Envio:
+    __slots__ = ("metodo", "payload", "chat", "prioridad", "seq", "futuro", "intentos")
+
+    def __init__(self, metodo, payload, chat, prioridad, seq):
+        self.metodo = metodo
+        self.payload = payload
+        self.chat = chat
+        self.prioridad = prioridad
+        self.seq = seq
+        self.futuro = Future()
+        self.intentos = 0
+
+
+class ProgramadorEnvios:
+    """Cola de salida con límites de tasa de Telegram.
+
+    - Orden estricto por chat: un envío en vuelo por chat, FIFO dentro del chat
+    - Entre chats gana la prioridad del primer envío pendiente (INTERACTIVO antes que MASIVO)
+    - Cubo global (~30 msg/s) y cubo por chat; un 429 reprograma el chat tras `retry_after`
+    - Los cubos de chats sin pendientes que ya se rellenaron se descartan cada `intervalo_poda` s
+    """
+
+    def __init__(self, llamar, tasa_global=30.0, tasa_chat=1.0, rafaga_chat=3, hilos=4,
+                 max_por_chat=100, max_reintentos=5, intervalo_poda=60.0):
+        self._llamar = llamar
+        self.tasa_chat = tasa_chat
+        self.rafaga_chat = rafaga_chat
+        self.max_por_chat = max_por_chat
+        self.max_reintentos = max_reintentos
+        self._global = CuboTokens(tasa_global, max(1.0, tasa_global))
+        self._cubos = {}
+        self.intervalo_poda = intervalo_poda
+        self._proxima_poda = time.monotonic() + intervalo_poda
+        self._colas = {}        # chat -> deque[_Envio]; un chat está aquí mientras tenga pendientes
+        self._listos = []       # heap (prioridad, seq, chat)
+        self._en_espera = []    # heap (listo_en, seq, chat)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._salida = queue.Queue()
+        self._detenido = False
+        self.encolados = Contador()
+        self.enviados = Contador()
+        self.demorados = Contador()
+        self.descartados = Contador()
+        self.limitados_429 = Contador()
+        threading.Thread(target=self._bucle, name="programador-envios", daemon=True).start()
+        for i in range(max(1, hilos)):
+            threading.Thread(target=self._emisor, name=f"emisor-{i}", daemon=True).start()
+        atexit.register(self.detener)
+
+    # --- API ---
+    def encolar(self, metodo, payload, chat_id, prioridad=INTERACTIVO):
+        chat = str(chat_id)
+        with self._cond:
+            cola = self._colas.setdefault(chat, deque())
+            envio = _Envio(metodo, payload, chat, prioridad, next(self._seq))
+            if len(cola) >= self.max_por_chat:
+                self.descartados.inc()
+                print(f"❗ Cola de salida llena para chat {chat}: se descarta {metodo}")
+                envio.futuro.set_result(None)
+                return envio.futuro
+            cola.append(envio)
+            self.encolados.inc()
+            if len(cola) == 1:
+                # Chat sin pendientes previos: entra a competir por turno
+                heapq.heappush(self._listos, (envio.prioridad, envio.seq, chat))
+                self._cond.notify()
+            return envio.futuro
+
+    def pendientes(self, chat_id):
+        with self._cond:
+            return len(self._colas.get(str(chat_id), ()))
+
+    # --- despacho ---
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._detenido and not self._colas:
+                        return
+                    ahora = time.monotonic()
+                    if ahora >= self._proxima_poda:
+                        self._podar(ahora)
+                    while self._en_espera and self._en_espera[0][0] <= ahora:
+                        _, _, chat = heapq.heappop(self._en_espera)
+                        cabeza = self._colas[chat][0]
+                        heapq.heappush(self._listos, (cabeza.prioridad, cabeza.seq, chat))
+                    if self._listos:
+                        espera_global = self._global.espera(ahora)
+                        if espera_global <= 0:
+                            break
+                        self._cond.wait(espera_global)
+                        continue
+                    timeout = self._en_espera[0][0] - ahora if self._en_espera else None
+                    self._cond.wait(timeout)
+                _, _, chat = heapq.heappop(self._listos)
+                cubo = self._cubos.get(chat)
+                if cubo is None:
+                    cubo = self._cubos[chat] = CuboTokens(self.tasa_chat, self.rafaga_chat)
+                espera_chat = cubo.espera(ahora)
+                if espera_chat > 0:
+                    self.demorados.inc()
+                    heapq.heappush(self._en_espera, (ahora + espera_chat, next(self._seq), chat))
+                    continue
+                cubo.tomar()
+                self._global.tomar()
+                envio = self._colas[chat][0]
+            self._salida.put(envio)
+
+    def _podar(self, ahora):
+        # Con el lock tomado
+        self._proxima_poda = ahora + self.intervalo_poda
+        for chat in [c for c, cubo in self._cubos.items() if c not in self._colas and cubo.lleno(ahora)]:
+            del self._cubos[chat]
+
+    def _emisor(self):
+        while True:
+            envio = self._salida.get()
+            envio.intentos += 1
+            try:
+                data = self._llamar(envio.metodo, envio.payload)
+            except Exception as e:
+                # Un error inesperado cuenta como falla de red: el envío se reintenta o se
+                # descarta, pero el chat nunca queda bloqueado con él a la cabeza
+                print(f"❗ Error enviando {envio.metodo} al chat {envio.chat}:", e)
+                data = None
+            self._terminar(envio, data)
+
+    def _terminar(self, envio, data):
+        chat = envio.chat
+        with self._cond:
+            reintento = None
+            if data is not None and data.get("error_code") == 429:
+                self.limitados_429.inc()
+                retry_after = (data.get("parameters") or {}).get("retry_after", 1)
+                reintento = float(retry_after)
+            elif data is None and envio.intentos < self.max_reintentos:
+                reintento = min(30.0, 0.5 * 2 ** envio.intentos)  # error de red: backoff
+            if reintento is not None and envio.intentos < self.max_reintentos:
+                # El envío sigue a la cabeza de su chat: el orden se conserva
+                self.demorados.inc()
+                heapq.heappush(self._en_espera, (time.monotonic() + reintento, next(self._seq), chat))
+                self._cond.notify()
+                return
+            cola = self._colas[chat]
+            cola.popleft()
+            if reintento is not None or data is None:
+                self.descartados.inc()
+            else:
+                self.enviados.inc()
+            if cola:
+                heapq.heappush(self._listos, (cola[0].prioridad, cola[0].seq, chat))
+            else:
+                del self._colas[chat]
+            self._cond.notify()
+        envio.futuro.set_result(data)
+
+    def detener(self, timeout=10.0):
+        # Da tiempo a vaciar lo pendiente antes de salir
+        limite = time.monotonic() + timeout
+        with self._cond:
+            self._detenido = True
+            self._cond.notify()
+            while self._colas and time.monotonic() < limite:
+                self._cond.wait(0.05)
+
+    def estadisticas(self):
+        with self._cond:
+            return {
+                "en_cola": sum(len(c) for c in self._colas.values()),
+                "chats_con_pendientes": len(self._colas),
+                "cubos_chat": len(self._cubos),
+                "encolados": self.encolados.valor(),
+                "enviados": self.enviados.valor(),
+                "demorados": self.demorados.valor(),
+                "descartados": self.descartados.valor(),
+                "limitados_429": self.limitados_429.valor(),
+            }
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Servidor local que imita la Bot API de Telegram (pruebas de carga y de resiliencia sin red)
+- Responde sendMessage, answerCallbackQuery, editMessageText, editMessageReplyMarkup,
+  getUpdates (long polling con offset/limit/allowed_updates), getMe y set/deleteWebhook
+- Registra cada llamada (método, payload, instante); reply_markup puede llegar como objeto
+  o como texto JSON (así lo mandan los teclados serializados) y se guarda ya decodificado
+- Fallas configurables: latencia fija + jitter, tasa de errores 500 y de 429 con retry_after
+- Control por HTTP en /_falso/...: inyectar updates, leer llamadas/estadísticas, cambiar
+  la configuración y reiniciar
+
+Uso:
+  python telegram_falso.py [--puerto 8081] [--latencia-ms 40] [--jitter-ms 20] [--error 0.01] [--429 0.02]
+  TELEGRAM_API_BASE=http://127.0.0.1:8081 python webhookBot.py
+
+En el mismo proceso:
+  srv = ServidorTelegramFalso(latencia_ms=30).iniciar()
+  os.environ["TELEGRAM_API_BASE"] = srv.url   # antes de importar el bot
+  srv.encolar_update(srv.update_mensaje(123, "/start"))
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+METODOS_CON_FALLAS = ("sendMessage", "answerCallbackQuery", "editMessageText", "editMessageReplyMarkup")
+CONFIGURABLES = ("latencia_ms", "jitter_ms", "tasa_error", "tasa_429", "retry_after", "metodos_con_fallas")
+
+
+def _decodificar_markup(valor):
+    if isinstance(valor, str):
+        try:
+            return json.loads(valor)
+        except ValueError:
+            return valor
+    return valor
+
+
+class ServidorTelegramFalso:
+    """Bot API falsa en memoria. Todos los parámetros de fallas se pueden cambiar en caliente con configurar()."""
+
+    def __init__(self, host="127.0.0.1", puerto=0, latencia_ms=0.0, jitter_ms=0.0, tasa_error=0.0,
+                 tasa_429=0.0, retry_after=1, metodos_con_fallas=METODOS_CON_FALLAS, semilla=None,
+                 max_llamadas=100000):
+        self.latencia_ms = latencia_ms
+        self.jitter_ms = jitter_ms
+        self.tasa_error = tasa_error
+        self.tasa_429 = tasa_429
+        self.retry_after = retry_after
+        self.metodos_con_fallas = set(metodos_con_fallas)
+        self.max_llamadas = max_llamadas
+        self._azar = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._reiniciar()
+        self._httpd = ThreadingHTTPServer((host, puerto), self._crear_handler())
+        self._httpd.daemon_threads = True
+        self._hilo = None
+
+    def _reiniciar(self):
+        self.llamadas = []                 # (metodo, payload, time.time())
+        self.conteo = defaultdict(int)     # metodo -> llamadas recibidas
+        self.fallas = defaultdict(int)     # "500"/"429"/"400" -> respuestas con error
+        self._updates = []                 # pendientes de entregar por getUpdates
+        self._update_id = itertools.count(1)
+        self._message_id = defaultdict(lambda: itertools.count(1))
+        self._mensajes = {}                # (chat_id, message_id) -> {"text", "reply_markup"}
+        self._ultimo_teclado = {}          # chat_id -> último message_id del bot con teclado inline
+
+    # --- ciclo de vida ---
+    @property
+    def url(self):
+        host, puerto = self._httpd.server_address[:2]
+        return f"http://{host}:{puerto}"
+
+    def url_api(self, token="TEST"):
+        return f"{self.url}/bot{token}"
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._httpd.serve_forever, name="telegram-falso", daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        with self._cond:
+            self._cond.notify_all()
+
+    def configurar(self, **valores):
+        with self._lock:
+            for k, v in valores.items():
+                if k not in CONFIGURABLES:
+                    raise ValueError(f"parámetro desconocido: {k}")
+                if k == "metodos_con_fallas":
+                    v = set(v)
+                setattr(self, k, v)
+
+    def reiniciar(self):
+        with self._cond:
+            self._reiniciar()
+
+    # --- updates entrantes ---
+    def encolar_update(self, update):
+        """Agrega un update (se le asigna update_id si no trae) y despierta a los getUpdates en espera."""
+        with self._cond:
+            if "update_id" not in update:
+                update = dict(update, update_id=next(self._update_id))
+            self._updates.append(update)
+            self._cond.notify_all()
+            return update["update_id"]
+
+    def update_mensaje(self, chat_id, texto, usuario=None):
+        return {"message": {"message_id": next(self._message_id[str(chat_id)]), "date": int(time.time()),
+                            "chat": {"id": chat_id, "type": "private"},
+                            "from": {"id": usuario or chat_id, "is_bot": False, "first_name": "Operador"},
+                            "text": texto}}
+
+    def update_callback(self, chat_id, data, message_id=None, usuario=None):
+        """Sin `message_id`, el botón tocado es del último mensaje con teclado enviado a ese chat."""
+        if message_id is None:
+            with self._lock:
+                message_id = self._ultimo_teclado.get(str(chat_id))
+        return {"callback_query": {"id": f"cq{chat_id}_{next(self._message_id[str(chat_id)])}",
+                                   "from": {"id": usuario or chat_id, "is_bot": False, "first_name": "Operador"},
+                                   "message": {"message_id": message_id or 1, "chat": {"id": chat_id, "type": "private"}},
+                                   "chat_instance": str(chat_id), "data": data}}
+
+    # --- consultas ---
+    def llamadas_de(self, metodo=None, chat_id=None):
+        with self._lock:
+            return [(m, p, t) for m, p, t in self.llamadas
+                    if (metodo is None or m == metodo)
+                    and (chat_id is None or str(p.get("chat_id")) == str(chat_id))]
+
+    def estadisticas(self):
+        with self._lock:
+            return {"llamadas": dict(self.conteo), "fallas": dict(self.fallas),
+                    "updates_pendientes": len(self._updates), "mensajes": len(self._mensajes),
+                    "latencia_ms": self.latencia_ms, "jitter_ms": self.jitter_ms,
+                    "tasa_error": self.tasa_error, "tasa_429": self.tasa_429}
+
+    # --- Bot API ---
+    def atender(self, metodo, payload):
+        """(status HTTP, cuerpo JSON) para una llamada a la Bot API."""
+        if "reply_markup" in payload:
+            payload["reply_markup"] = _decodificar_markup(payload["reply_markup"])
+        with self._lock:
+            self.conteo[metodo] += 1
+            if len(self.llamadas) < self.max_llamadas:
+                self.llamadas.append((metodo, payload, time.time()))
+            espera = self.latencia_ms + (self._azar.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+            falla = None
+            if metodo in self.metodos_con_fallas:
+                r = self._azar.random()
+                if r < self.tasa_429:
+                    falla = "429"
+                elif r < self.tasa_429 + self.tasa_error:
+                    falla = "500"
+        if espera > 0:
+            time.sleep(espera / 1000.0)
+        if falla == "429":
+            return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                               {"retry_after": self.retry_after})
+        if falla == "500":
+            return self._error(500, "Internal Server Error")
+
+        fn = getattr(self, "_api_" + metodo, None)
+        if fn is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        return fn(payload)
+
+    def _error(self, codigo, descripcion, parametros=None):
+        with self._lock:
+            self.fallas[str(codigo)] += 1
+        cuerpo = {"ok": False, "error_code": codigo, "description": descripcion}
+        if parametros:
+            cuerpo["parameters"] = parametros
+        return codigo, cuerpo
+
+    def _api_getMe(self, payload):
+        return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Falso", "username": "falso_bot"}}
+
+    def _api_setWebhook(self, payload):
+        return 200, {"ok": True, "result": True, "description": "Webhook was set"}
+
+    def _api_deleteWebhook(self, payload):
+        return 200, {"ok": True, "result": True, "description": "Webhook was deleted"}
+
+    def _api_answerCallbackQuery(self, payload):
+        if not payload.get("callback_query_id"):
+            return self._error(400, "Bad Request: query is too old and response timeout expired or query ID is invalid")
+        return 200, {"ok": True, "result": True}
+
+    def _api_sendMessage(self, payload):
+        chat_id, texto = payload.get("chat_id"), payload.get("text")
+        if chat_id is None:
+            return self._error(400, "Bad Request: chat_id is empty")
+        if not texto:
+            return self._error(400, "Bad Request: message text is empty")
+        with self._lock:
+            message_id = next(self._message_id[str(chat_id)])
+            self._mensajes[(str(chat_id), message_id)] = {"text": texto, "reply_markup": payload.get("reply_markup")}
+            if payload.get("reply_markup"):
+                self._ultimo_teclado[str(chat_id)] = message_id
+        return 200, {"ok": True, "result": {"message_id": message_id, "date": int(time.time()),
+                                            "chat": {"id": chat_id, "type": "private"}, "text": texto}}
+
+    def _editar(self, payload, campos):
+        try:
+            clave = (str(payload.get("chat_id")), int(payload.get("message_id")))
+        except (TypeError, ValueError):
+            return self._error(400, "Bad Request: message identifier is not specified")
+        with self._lock:
+            msg = self._mensajes.get(clave)
+            if msg is None:
+                modificado = None
+            else:
+                nuevo = dict(msg, **{c: payload.get(c) for c in campos})
+                modificado = nuevo != msg
+                msg.update(nuevo)
+        if modificado is None:
+            return self._error(400, "Bad Request: message to edit not found")
+        if not modificado:
+            return self._error(400, "Bad Request: message is not modified")
+        return 200, {"ok": True, "result": {"message_id": clave[1], "chat": {"id": payload.get("chat_id")},
+                                            "text": msg["text"]}}
+
+    def _api_editMessageText(self, payload):
+        if not payload.get("text"):
+            return self._error(400, "Bad Request: message text is empty")
+        return self._editar(payload, ("text", "reply_markup"))
+
+    def _api_editMessageReplyMarkup(self, payload):
+        return self._editar(payload, ("reply_markup",))
+
+    def _api_getUpdates(self, payload):
+        offset = int(payload.get("offset") or 0)
+        limite = max(1, min(100, int(payload.get("limit") or 100)))
+        timeout = float(payload.get("timeout") or 0)
+        permitidos = payload.get("allowed_updates")
+        if isinstance(permitidos, str):
+            permitidos = json.loads(permitidos)
+        limite_t = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                # El offset confirma (y descarta) todo lo anterior, como en Telegram
+                if offset:
+                    self._updates = [u for u in self._updates if u["update_id"] >= offset]
+                salida = [u for u in self._updates
+                          if not permitidos or any(t in u for t in permitidos)][:limite]
+                restante = limite_t - time.monotonic()
+                if salida or restante <= 0:
+                    return 200, {"ok": True, "result": salida}
+                self._cond.wait(restante)
+
+    # --- HTTP ---
+    def _crear_handler(self):
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, como el pool de requests espera
+
+            def log_message(self, *args):
+                pass
+
+            def _payload(self):
+                partes = urlsplit(self.path)
+                payload = dict(parse_qsl(partes.query))
+                largo = int(self.headers.get("Content-Length") or 0)
+                if largo:
+                    cuerpo = self.rfile.read(largo)
+                    tipo = self.headers.get("Content-Type", "")
+                    if "json" in tipo:
+                        payload.update(json.loads(cuerpo or b"{}"))
+                    else:
+                        payload.update(parse_qsl(cuerpo.decode("utf-8")))
+                return partes.path, payload
+
+            def _responder(self, status, cuerpo):
+                datos = json.dumps(cuerpo, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def _atender(self):
+                try:
+                    ruta, payload = self._payload()
+                except ValueError:
+                    return self._responder(400, {"ok": False, "error_code": 400, "description": "Bad Request: can't parse JSON"})
+                partes = ruta.strip("/").split("/")
+                if partes[0] == "_falso":
+                    return self._responder(*servidor._control(partes[1:], payload))
+                if len(partes) != 2 or not partes[0].startswith("bot"):
+                    return self._responder(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                self._responder(*servidor.atender(partes[1], payload))
+
+            do_GET = _atender
+            do_POST = _atender
+
+        return Handler
+
+    def _control(self, partes, payload):
+        accion = partes[0] if partes else ""
+        if accion == "estadisticas":
+            return 200, self.estadisticas()
+        if accion == "llamadas":
+            llamadas = self.llamadas_de(payload.get("metodo"), payload.get("chat_id"))
+            return 200, [{"metodo": m, "payload": p, "t": t} for m, p, t in llamadas]
+        if accion == "updates":
+            updates = payload.get("updates") or [payload]
+            return 200, {"update_ids": [self.encolar_update(u) for u in updates]}
+        if accion == "config":
+            try:
+                self.configurar(**payload)
+            except ValueError as e:
+                return 400, {"ok": False, "description": str(e)}
+            return 200, self.estadisticas()
+        if accion == "reiniciar":
+            self.reiniciar()
+            return 200, {"ok": True}
+        return 404, {"ok": False, "description": "Not Found"}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="telegram_falso.py", description="Bot API de Telegram falsa para pruebas locales")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--puerto", type=int, default=8081)
+    ap.add_argument("--latencia-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error", type=float, default=0.0, help="fracción de respuestas 500")
+    ap.add_argument("--429", dest="tasa_429", type=float, default=0.0, help="fracción de respuestas 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--semilla", type=int)
+    args = ap.parse_args(argv)
+    srv = ServidorTelegramFalso(args.host, args.puerto, args.latencia_ms, args.jitter_ms, args.error,
+                                args.tasa_429, args.retry_after, semilla=args.semilla)
+    print(f"🧪 Bot API falsa en {srv.url} (TELEGRAM_API_BASE={srv.url})")
+    try:
+        srv._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv._httpd.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
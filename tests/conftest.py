@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos viven en la raíz del repo (sin paquete)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def servidor():
+    # Bot API falsa en un puerto libre; se detiene al terminar la prueba
+    from telegram_falso import ServidorTelegramFalso
+    srv = ServidorTelegramFalso(semilla=1).iniciar()
+    try:
+        yield srv
+    finally:
+        srv.detener()
@@ -0,0 +1,59 @@
+import json
+import threading
+
+import pytest
+
+from persistencia import AlmacenJSON, AlmacenSQLite, crear_almacen
+
+CATALOGO = {"FND|8oz|RTCA": {"sku": "194916", "vida_util_meses": 18}}
+CONFIG = {"5": {"M1": {"producto": "FND", "medida": "8oz", "mercado": "RTCA"}},
+          "7": {"M2": {"producto": "FNA", "medida": "8oz", "mercado": "RTCA"}}}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def almacen(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    if request.param == "json":
+        return AlmacenJSON(threading.Lock())
+    return AlmacenSQLite(str(tmp_path / "bot.sqlite3"), "catalogo_skus.json", "config_turno.json")
+
+
+def test_ida_y_vuelta_por_documento(almacen):
+    almacen.guardar("catalogo_skus.json", CATALOGO)
+    almacen.guardar("config_turno.json", CONFIG)
+    almacen.guardar("progreso_semana.json", {"2026-W42": {"a": 1}})
+    assert almacen.cargar("catalogo_skus.json", {}) == CATALOGO
+    assert almacen.cargar("config_turno.json", {}) == CONFIG
+    assert almacen.cargar("no_existe.json", {"d": 1}) == {"d": 1}
+
+
+def test_escritura_parcial_solo_toca_las_claves_indicadas(almacen):
+    almacen.guardar("config_turno.json", CONFIG)
+    nuevo = {"5": {"M3": {"producto": "FRD", "medida": "28oz", "mercado": "FDA"}}, "7": CONFIG["7"]}
+    almacen.guardar("config_turno.json", nuevo, claves={"5"})
+    assert almacen.cargar("config_turno.json", {}) == nuevo
+    # una clave indicada que ya no está en el documento se borra
+    almacen.guardar("config_turno.json", {"7": CONFIG["7"]}, claves={"5"})
+    assert almacen.cargar("config_turno.json", {}) == {"7": CONFIG["7"]}
+
+
+def test_la_firma_cambia_con_cada_guardado(almacen):
+    assert almacen.firma("config_turno.json") is None
+    almacen.guardar("config_turno.json", CONFIG)
+    f1 = almacen.firma("config_turno.json")
+    almacen.guardar("config_turno.json", CONFIG, claves={"5"})
+    f2 = almacen.firma("config_turno.json")
+    assert None not in (f1, f2) and f1 != f2
+    assert almacen.firma("catalogo_skus.json") is None   # cada documento tiene la suya
+
+
+def test_sqlite_importa_los_json_una_sola_vez(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "catalogo_skus.json").write_text(json.dumps(CATALOGO))
+    (tmp_path / "config_turno.json").write_text(json.dumps(CONFIG))
+    rutas = ["catalogo_skus.json", "config_turno.json"]
+    a = crear_almacen("sqlite", threading.Lock(), "bot.sqlite3", *rutas, rutas)
+    assert a.migrado() and a.cargar("config_turno.json", {}) == CONFIG
+    (tmp_path / "config_turno.json").write_text("{}")
+    b = crear_almacen("sqlite", threading.Lock(), "bot.sqlite3", *rutas, rutas)
+    assert b.cargar("config_turno.json", {}) == CONFIG
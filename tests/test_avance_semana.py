@@ -0,0 +1,54 @@
+from datetime import datetime
+
+from avance_semana import AvanceSemanal, fin_semana_iso, semana_iso_id, texto_avance
+from persistencia import DocumentoCache
+
+ORDENES = {"2026-W42": {"FND|8oz|RTCA": {"cajas": 20000}, "FNA|8oz|RTCA": 8000}}
+
+
+def _avance(ordenes=ORDENES):
+    guardados = []
+    progreso = DocumentoCache("progreso_semana", lambda: {},
+                              lambda d, claves=None: guardados.append(claves) or True)
+    return AvanceSemanal(progreso, lambda: ordenes), guardados
+
+
+def test_semana_iso_y_cierre():
+    assert semana_iso_id(datetime(2026, 10, 18, 23, 59)) == "2026-W42"
+    assert semana_iso_id(datetime(2027, 1, 1)) == "2026-W53"
+    assert fin_semana_iso("2026-W42") == datetime(2026, 10, 19)
+
+
+def test_avance_con_ritmo_y_proyeccion():
+    av, guardados = _avance()
+    av.registrar(datetime(2026, 10, 14, 6, 10), "FND|8oz|RTCA", 1000.0, 10)
+    av.registrar(datetime(2026, 10, 14, 7, 30), "FND|8oz|RTCA", 1000.0, 10)
+    av.registrar(datetime(2026, 10, 14, 7, 45), "FRD|28oz|FDA", 96.0, 4)
+    assert guardados == [{"2026-W42"}] * 3   # solo se escribe la semana tocada
+    res = av.avance(ahora=datetime(2026, 10, 14, 8, 0))
+    filas = {f["combo"]: f for f in res["filas"]}
+    assert [f["combo"] for f in res["filas"]] == ["FNA|8oz|RTCA", "FND|8oz|RTCA", "FRD|28oz|FDA"]
+    fnd = filas["FND|8oz|RTCA"]
+    # 2000 cajas desde las 06:00 -> 1000 cajas/h; faltan 18000 -> 18 h
+    assert fnd["pct"] == 10.0 and fnd["ritmo_cajas_h"] == 1000.0
+    assert fnd["fin_estimado"] == datetime(2026, 10, 15, 2, 0) and fnd["a_tiempo"]
+    assert filas["FNA|8oz|RTCA"]["a_tiempo"] is False
+    assert filas["FRD|28oz|FDA"]["meta"] is None and filas["FRD|28oz|FDA"]["lotes"] == 1
+    texto = texto_avance(res)
+    assert "Cierre: dom 18/10 23:59" in texto
+    assert "⏸ Sin producción reciente" in texto and "(sin orden)" in texto
+
+
+def test_por_hora_se_recorta():
+    av, _ = _avance()
+    for h in range(60):
+        av.registrar(datetime(2026, 10, 12, 0, 0).replace(day=12 + h // 24, hour=h % 24), "FND|8oz|RTCA", 10.0, 1)
+    c = av.progreso.leer()["2026-W42"]["FND|8oz|RTCA"]
+    assert len(c["por_hora"]) == 48 and min(c["por_hora"]) == "2026-10-12T12"
+    assert c["lotes"] == 60 and c["primero"] == "2026-10-12T00:00:00"
+
+
+def test_ordenes_ilegibles_no_rompen_el_avance():
+    av, _ = _avance()
+    av._cargar_ordenes = lambda: 1 / 0
+    assert av.avance(ahora=datetime(2026, 10, 14))["filas"] == []
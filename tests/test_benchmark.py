@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+import benchmark
+
+
+def test_percentiles_y_resumen():
+    assert benchmark.percentil([], 50) == 0.0
+    r = benchmark.resumen_latencias([0.001 * i for i in range(1, 101)])
+    assert r["n"] == 100 and r["p50_ms"] == 51.0 and r["max_ms"] == 100.0
+
+
+def test_sesiones_completas_en_ambos_modos_sin_fallas(tmp_path):
+    # Humo de punta a punta: los dos bots contra la Bot API falsa, cada uno en su proceso
+    pytest.importorskip("flask")
+    salida = tmp_path / "benchmark.json"
+    assert benchmark.main(["--chats", "2", "--sesiones", "1", "--latencia-ms", "0", "--jitter-ms", "0",
+                           "--salida", str(salida)]) == 0
+    resultados = {r["modo"]: r for r in json.loads(salida.read_text())["resultados"]}
+    assert set(resultados) == {"webhook", "polling"}
+    for r in resultados.values():
+        assert r["fallidas"] == 0
+        assert r["interacciones"] == 2 * len(benchmark.SESION)
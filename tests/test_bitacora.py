@@ -0,0 +1,109 @@
+from datetime import datetime
+
+from bitacora import BitacoraLotes
+
+
+def _lote(ts, chat="1", ll="M1", canastas=10):
+    return {"ts": ts, "chat_id": chat, "llenadora": ll, "canastas": canastas, "cajas": canastas * 93.5}
+
+
+def test_consultar_filtra_por_rango_y_chat(tmp_path):
+    b = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    try:
+        b.registrar(_lote(datetime(2026, 10, 13, 6, 0)))
+        b.registrar(_lote(datetime(2026, 10, 13, 7, 0), chat="2"))
+        b.registrar(_lote(datetime(2026, 10, 14, 6, 0)))
+        # sin vaciar: los pendientes también se ven
+        assert len(list(b.consultar())) == 3
+        assert b.vaciar()
+        res = list(b.consultar(desde=datetime(2026, 10, 13), hasta=datetime(2026, 10, 14), chat_id=1))
+        assert [r["ts"] for r in res] == ["2026-10-13T06:00:00"]
+    finally:
+        b.detener()
+
+
+def test_segmentos_por_dia_y_el_indice_descarta_los_que_no_aplican(tmp_path):
+    b = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    for dia in (13, 14, 15):
+        b.registrar(_lote(datetime(2026, 10, dia, 6, 0), chat=str(dia)))
+    b.detener()
+    assert b.estadisticas()["segmentos"] == 3
+    segs = list(b.segmentos_para(desde=datetime(2026, 10, 14), hasta=datetime(2026, 10, 15)))
+    assert [s["dia"] for s in segs] == ["2026-10-14"]
+    assert [s["dia"] for s in b.segmentos_para(chat_id=15)] == ["2026-10-15"]
+
+
+def test_reabrir_reconstruye_el_indice_atrasado(tmp_path):
+    b = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    b.registrar(_lote(datetime(2026, 10, 13, 6, 0)))
+    b.detener()
+    # una línea escrita tras el último índice (corte antes de actualizarlo) y otra truncada
+    with open(tmp_path / "lotes-000001.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"ts": "2026-10-13T08:00:00", "chat_id": "1", "llenadora": "M2"}\n{"ts": "2026-')
+    b2 = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    try:
+        assert [r["llenadora"] for r in b2.consultar()] == ["M1", "M2"]
+        assert b2.estadisticas()["segmentos"] == 1
+    finally:
+        b2.detener()
+
+
+def test_falla_a_mitad_de_lote_reintenta_solo_lo_no_escrito(tmp_path, monkeypatch):
+    b = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    original = BitacoraLotes._agregar_a_archivo
+    llamadas = []
+
+    def falla_el_segundo(ruta, datos, tam_previo):
+        llamadas.append(ruta)
+        if len(llamadas) == 2:
+            raise OSError("disco lleno")
+        original(ruta, datos, tam_previo)
+
+    monkeypatch.setattr(BitacoraLotes, "_agregar_a_archivo", staticmethod(falla_el_segundo))
+    b.registrar(_lote(datetime(2026, 10, 13, 6, 0)))
+    b.registrar(_lote(datetime(2026, 10, 14, 6, 0)))   # otro día: otro segmento
+    assert not b.vaciar()
+    assert [r["ts"][:10] for r in b._pendientes] == ["2026-10-14"]
+    assert b.vaciar()
+    b.detener()
+    assert [r["ts"][:10] for r in b.consultar()] == ["2026-10-13", "2026-10-14"]
+    assert b.estadisticas()["escritos"] == 2 and b.estadisticas()["errores"] == 1
+
+
+def test_el_directorio_se_crea_con_la_primera_escritura(tmp_path):
+    directorio = tmp_path / "bitacora"
+    b = BitacoraLotes(str(directorio), intervalo_fsync=60)
+    assert not directorio.exists()
+    assert list(b.consultar()) == []
+    b.registrar(_lote(datetime(2026, 10, 13, 6, 0)))
+    b.detener()
+    assert len(list(directorio.glob("lotes-*.jsonl"))) == 1
+
+
+def test_dos_procesos_comparten_segmentos_y_avisan_lo_ajeno(tmp_path):
+    # Dos instancias sobre el mismo directorio, como dos workers
+    a = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    b = BitacoraLotes(str(tmp_path), intervalo_fsync=60)
+    vistos = []
+    b.observadores.append(vistos.append)
+    try:
+        a.registrar(_lote(datetime(2026, 10, 13, 6, 0), chat="1"))
+        a.vaciar()
+        b.registrar(_lote(datetime(2026, 10, 13, 7, 0), chat="2"))
+        b.vaciar()                       # antes de escribir, b lee lo de a
+        assert [r["chat_id"] for r in vistos] == ["1"]
+        a.registrar(_lote(datetime(2026, 10, 13, 8, 0), chat="1", ll="M2"))
+        a.vaciar()
+        assert b.sincronizar() == 1 and vistos[-1]["llenadora"] == "M2"
+        assert b.sincronizar() == 0
+        # mismo segmento para los dos, sin líneas pisadas, y cada uno lo consulta completo
+        assert len(list(tmp_path.glob("lotes-*.jsonl"))) == 1
+        esperado = ["06:00", "07:00", "08:00"]
+        assert [r["ts"][11:16] for r in a.consultar()] == esperado
+        assert [r["ts"][11:16] for r in b.consultar(chat_id="1")] == ["06:00", "08:00"]
+        c = BitacoraLotes(str(tmp_path))
+        assert [r["ts"][11:16] for r in c.consultar()] == esperado
+        c.detener()
+    finally:
+        a.detener()
+        b.detener()
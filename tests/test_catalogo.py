@@ -0,0 +1,75 @@
+import json
+
+from catalogo import CacheTeclados, CatalogoRecargable, validar_catalogo, entradas_validas
+
+BUENO = {"FND|8oz|RTCA": {"sku": "194916", "vida_util_meses": 18},
+         "FNA|8oz|RTCA": {"sku": "194917", "vida_util_meses": 18}}
+
+
+def test_validar_catalogo_bueno():
+    assert validar_catalogo(BUENO) == []
+
+
+def test_entradas_validas_descarta_solo_las_malas():
+    datos = dict(BUENO, malo={"sku": "1"}, **{"FRD|8oz|RTCA": "no-objeto",
+                                               "FRS|8oz|RTCA": {"sku": "194916"},
+                                               "FNP|8oz|RTCA": {"vida_util_meses": 0}})
+    assert len(validar_catalogo(datos)) == 4
+    assert entradas_validas(datos) == BUENO
+    assert entradas_validas(["no", "objeto"]) == {}
+
+
+def test_carga_inicial_con_entradas_invalidas_publica_las_validas():
+    datos = dict(BUENO, malo={"sku": "1"}, **{"FRD|8oz|RTCA": 5})
+    cat = CatalogoRecargable(lambda: datos, lambda d: True)
+    idx = cat.indice()
+    assert len(idx) == 2
+    assert idx.combo("FND", "8oz", "RTCA")["sku"] == "194916"
+    assert cat.indice() is idx
+
+
+def test_carga_inicial_que_no_es_objeto_queda_vacia():
+    cat = CatalogoRecargable(lambda: ["x"], lambda d: True)
+    assert len(cat.indice()) == 0
+
+
+def test_recarga_rechaza_catalogo_invalido(tmp_path):
+    ruta = tmp_path / "catalogo.json"
+    ruta.write_text(json.dumps(BUENO))
+    cat = CatalogoRecargable(lambda: json.loads(ruta.read_text()), lambda d: True,
+                             ruta_vigilada=str(ruta), intervalo=0)
+    v1 = cat.indice()
+    ruta.write_text(json.dumps({"malo": {}}) + " " * 10)
+    assert cat.indice() is v1
+    assert cat.rechazos.valor() == 1
+
+
+def test_recarga_por_firma_sin_archivo_vigilado():
+    # Con SQLite no hay archivo: la versión que otro proceso sube al guardar hace de firma
+    doc, version = {"datos": BUENO}, [1]
+    cat = CatalogoRecargable(lambda: doc["datos"], lambda d: True, intervalo=0, firma=lambda: version[0])
+    v1 = cat.indice()
+    assert cat.indice() is v1
+    doc["datos"] = dict(BUENO, **{"FRD|28oz|FDA": {"sku": "200001", "vida_util_meses": 24}})
+    version[0] = 2
+    assert len(cat.indice()) == len(BUENO) + 1 and cat.recargas.valor() == 1
+
+
+def test_cache_teclados_construye_una_vez_por_version():
+    cat = CatalogoRecargable(lambda: BUENO, lambda d: True)
+    cache = CacheTeclados(cat)
+    construidos = []
+
+    def productos(idx):
+        construidos.append(idx.version)
+        return [[{"text": p, "callback_data": f"c_n_p_{p}"}] for p in idx.productos()]
+
+    t1 = cache.obtener("productos", productos)
+    assert cache.obtener("productos", productos) is t1
+    assert json.loads(t1)["inline_keyboard"][0][0]["callback_data"].startswith("c_n_p_")
+    nuevo = dict(BUENO, **{"FRD|28oz|FDA": {"sku": "194999", "vida_util_meses": 24}})
+    assert cat.escribir(nuevo)
+    t2 = cache.obtener("productos", productos)
+    assert t2 != t1 and len(json.loads(t2)["inline_keyboard"]) == 3
+    assert construidos == [1, 2]
+    assert cache.estadisticas() == {"version": 2, "teclados": 1, "hits": 1, "construidos": 2}
@@ -0,0 +1,108 @@
+import io
+import csv
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from claves_envase import (LETRA_LLENADORA, MESES_EN, MESES_ES, GeneradorClaves, asignaciones_de_config,
+                           exportar_claves, main)
+
+
+# Copia de referencia de generar_clave_envase tal como estaba en webhookBot.py antes de GeneradorClaves
+def _generar_clave_envase_original(llenadora, mercado, sku, vida_util_meses, fecha_ref, letra_chub=None):
+    ahora = fecha_ref
+    yy = ahora.year % 100
+    hhmm = ahora.strftime("%H:%M")
+    ddd = ahora.timetuple().tm_yday
+    if llenadora == "Chub":
+        letra = letra_chub if letra_chub else "—"
+    else:
+        letra = LETRA_LLENADORA.get(llenadora, "—")
+    linea1 = f"{letra} {hhmm} {yy:02d} L {ddd}"
+    y = ahora.year + (ahora.month - 1 + vida_util_meses) // 12
+    m = (ahora.month - 1 + vida_util_meses) % 12 + 1
+    venc = datetime(y, m, 15, ahora.hour, ahora.minute)
+    if mercado == "FDA":
+        linea2 = f"BEST BY 15 {MESES_EN[venc.month - 1]} {venc.year % 100:02d}"
+    else:
+        linea2 = f"EXP 15 {MESES_ES[venc.month - 1]} {venc.year % 100:02d}"
+    return f"{linea1}\n{linea2}\n6173 {sku}"
+
+
+FECHAS = [datetime(2026, 1, 1, 0, 0), datetime(2026, 10, 18, 6, 40), datetime(2026, 12, 31, 23, 59),
+          datetime(2028, 2, 29, 12, 5), datetime(2028, 3, 1, 0, 1), datetime(2099, 7, 15, 9, 9)]
+
+
+@pytest.mark.parametrize("fecha", FECHAS)
+@pytest.mark.parametrize("llenadora,letra_chub", [("M1", None), ("M3", None), ("Chub", None), ("Chub", "E"), ("X9", None)])
+@pytest.mark.parametrize("mercado,vida", [("RTCA", 18), ("FDA", 24), ("RTCA", 1), ("FDA", 120)])
+def test_clave_igual_a_la_original(fecha, llenadora, letra_chub, mercado, vida):
+    gen = GeneradorClaves(LETRA_LLENADORA, vidas=lambda: {18})
+    esperada = _generar_clave_envase_original(llenadora, mercado, "194916", vida, fecha, letra_chub)
+    assert gen.clave(llenadora, mercado, "194916", vida, fecha, letra_chub) == esperada
+    # segunda vez sale de la caché y sigue igual
+    assert gen.clave(llenadora, mercado, "194916", vida, fecha, letra_chub) == esperada
+
+
+def test_todo_un_anio_bisiesto_minuto_a_minuto_cada_hora():
+    gen = GeneradorClaves(LETRA_LLENADORA, max_claves=16)
+    t = datetime(2028, 1, 1, 0, 17)
+    while t.year == 2028:
+        assert gen.clave("M2", "RTCA", "1", 18, t) == _generar_clave_envase_original("M2", "RTCA", "1", 18, t)
+        t += timedelta(hours=7)
+
+
+def test_serie_coincide_con_clave_y_respeta_los_limites():
+    gen = GeneradorClaves(LETRA_LLENADORA)
+    desde, hasta = datetime(2026, 12, 31, 23, 50, 30), datetime(2027, 1, 1, 0, 10)
+    serie = list(gen.serie("M1", "FDA", "194916", 18, desde, hasta, paso_min=3))
+    assert serie[0][0] == "2026-12-31T23:51" and serie[-1][0] == "2027-01-01T00:09"
+    assert [ts[-2:] for ts, _ in serie] == ["51", "54", "57", "00", "03", "06", "09"]
+    for ts, clave in serie:
+        assert clave == gen.clave("M1", "FDA", "194916", 18, datetime.fromisoformat(ts))
+
+
+CATALOGO = {"FND|8oz|RTCA": {"sku": "194916", "vida_util_meses": 18},
+            "FRD|28oz|FDA": {"sku": "194999", "vida_util_meses": 24},
+            "FNA|8oz|RTCA": {"sku": "194917"}}
+CFG_CHAT = {"M1": {"producto": "FND", "medida": "8oz", "mercado": "RTCA"},
+            "M2": {"producto": "FNA", "medida": "8oz", "mercado": "RTCA"},   # sin vida útil: se omite
+            "M3": {"producto": "FRD", "medida": "28oz", "mercado": "FDA"}}
+
+
+def test_asignaciones_omite_combos_incompletos():
+    asig = asignaciones_de_config(CFG_CHAT, CATALOGO)
+    assert [a["llenadora"] for a in asig] == ["M1", "M3"]
+    assert [a["llenadora"] for a in asignaciones_de_config(CFG_CHAT, CATALOGO, "M3")] == ["M3"]
+
+
+@pytest.mark.parametrize("formato", ["csv", "jsonl"])
+def test_exportar_coincide_con_clave(formato):
+    gen = GeneradorClaves(LETRA_LLENADORA)
+    salida = io.StringIO()
+    desde, hasta = datetime(2026, 10, 18, 23, 58), datetime(2026, 10, 19, 0, 2)
+    n = exportar_claves(gen, asignaciones_de_config(CFG_CHAT, CATALOGO), desde, hasta, salida, formato)
+    salida.seek(0)
+    if formato == "csv":
+        filas = list(csv.DictReader(salida))
+    else:
+        filas = [json.loads(linea) for linea in salida]
+    assert n == len(filas) == 8
+    for f in filas:
+        vida = CATALOGO[f"{f['producto']}|{f['medida']}|{f['mercado']}"]["vida_util_meses"]
+        clave = gen.clave(f["llenadora"], f["mercado"], f["sku"], vida, datetime.fromisoformat(f["ts"]))
+        assert "\n".join([f["linea1"], f["linea2"], f["linea3"]]) == clave
+
+
+def test_cli_exportar(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ALMACEN_BACKEND", "json")
+    (tmp_path / "catalogo_skus.json").write_text(json.dumps(CATALOGO))
+    (tmp_path / "config_turno.json").write_text(json.dumps({"5": CFG_CHAT}))
+    assert main(["exportar", "5", "2026-10-18T06:00", "2026-10-18T07:00", "--llenadora", "M1",
+                 "--paso", "15", "--formato", "jsonl", "--salida", "claves.jsonl"]) == 0
+    filas = [json.loads(linea) for linea in (tmp_path / "claves.jsonl").read_text().splitlines()]
+    assert [f["ts"] for f in filas] == ["2026-10-18T06:00", "2026-10-18T06:15", "2026-10-18T06:30", "2026-10-18T06:45"]
+    assert main(["exportar", "9", "2026-10-18T06:00", "2026-10-18T07:00"]) == 1
+    assert "4 claves exportadas" in capsys.readouterr().err
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import fcntl
+import threading
+
+from despacho import ColaTrabajo, DespachadorPorChat, OffsetConfirmado
+from persistencia import BloqueoArchivo
+
+
+def test_cola_procesa_y_cuenta_errores():
+    vistos = []
+
+    def procesar(item):
+        if item == "malo":
+            raise ValueError("falla")
+        vistos.append(item)
+
+    cola = ColaTrabajo(procesar, workers=2, capacidad=10, nombre="prueba")
+    for item in ("a", "malo", "b"):
+        assert cola.encolar(item)
+    cola.detener()
+    st = cola.estadisticas()
+    assert sorted(vistos) == ["a", "b"]
+    assert st["procesados"] == 3 and st["errores"] == 1 and st["rechazados"] == 0
+
+
+def test_cola_llena_rechaza_sin_bloquear():
+    empezo, soltar = threading.Event(), threading.Event()
+
+    def procesar(item):
+        empezo.set()
+        soltar.wait(5)
+
+    cola = ColaTrabajo(procesar, workers=1, capacidad=2, nombre="llena")
+    assert cola.encolar(0)
+    assert empezo.wait(5)
+    # el worker está ocupado: caben dos más y el resto se rechaza (el webhook responde 503)
+    assert [cola.encolar(i) for i in range(1, 6)] == [True, True, False, False, False]
+    assert cola.estadisticas()["rechazados"] == 3
+    soltar.set()
+    cola.detener()
+    assert cola.estadisticas()["procesados"] == 3
+
+
+def test_despachador_mantiene_el_orden_por_chat_y_no_solapa_un_chat():
+    vistos, activos, solapes = [], {}, []
+    lock = threading.Lock()
+
+    def procesar(item):
+        chat, n = item
+        with lock:
+            if activos.get(chat):
+                solapes.append(item)
+            activos[chat] = True
+        time.sleep(0.001)
+        with lock:
+            activos[chat] = False
+            vistos.append(item)
+
+    d = DespachadorPorChat(procesar, carriles=4, capacidad_por_carril=100)
+    for n in range(20):
+        for chat in (1, 2, 3, 4, 5):
+            assert d.encolar(chat, (chat, n))
+    d.detener()
+    assert not solapes
+    for chat in (1, 2, 3, 4, 5):
+        assert [n for c, n in vistos if c == chat] == list(range(20))
+    assert d.estadisticas()["procesados"] == 100
+
+
+def test_en_orden_excluye_al_carril_del_chat():
+    empezo = threading.Event()
+    d = DespachadorPorChat(lambda item: empezo.set(), carriles=2)
+    with d.en_orden(9):
+        d.encolar(9, "x")
+        # el carril del chat 9 no puede procesar mientras se tiene su lock
+        assert not empezo.wait(0.1)
+    assert empezo.wait(5)
+    d.detener()
+
+
+def test_carril_con_bloqueo_de_archivo_lo_toma_mientras_procesa(tmp_path):
+    def tomado(i):
+        # flock es por descriptor abierto: otro open del mismo proceso choca igual que otro worker
+        fd = os.open(str(tmp_path / f"carril-{i}.lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+
+    vistos = []
+    d = DespachadorPorChat(lambda item: vistos.append(tomado(item)), carriles=2,
+                           bloqueo=lambda i: BloqueoArchivo(str(tmp_path / f"carril-{i}.lock")))
+    carril = d._indice(9)
+    d.encolar(9, carril)
+    d.detener()
+    assert vistos == [True]
+    with d.en_orden(9):
+        assert tomado(carril) and not tomado(1 - carril)
+    assert not tomado(carril)
+
+
+def test_offset_solo_avanza_sobre_el_prefijo_terminado(tmp_path):
+    ruta = str(tmp_path / "offset.json")
+    off = OffsetConfirmado(ruta, retardo=0.01, max_retardo=0.05)
+    for u in (10, 11, 12):
+        assert off.registrar(u)
+    assert not off.registrar(11)          # duplicado
+    off.terminar(12)
+    assert off.confirmado == 10           # 10 y 11 siguen en vuelo
+    off.terminar(10)
+    assert off.confirmado == 11
+    off.terminar(11)
+    assert off.confirmado == 13 and off.en_vuelo() == 0
+    assert not off.registrar(12)          # ya confirmado
+    off._flush.detener()
+    with open(ruta, encoding="utf-8") as f:
+        assert json.load(f) == {"offset": 13, "en_vuelo": []}
+    assert OffsetConfirmado(ruta).confirmado == 13
+    assert off.estadisticas()["duplicados"] == 2
+
+
+def test_se_pide_desde_el_mayor_visto_sin_esperar_a_los_en_vuelo(tmp_path):
+    off = OffsetConfirmado(str(tmp_path / "offset.json"))
+    assert off.siguiente() is None
+    for u in (5, 6, 7):
+        off.registrar(u, {"update_id": u, "message": {"text": str(u)}})
+    assert off.siguiente() is None        # sin asegurar, Telegram no debe descartarlos
+    assert off.asegurar()
+    assert off.siguiente() == 8 and off.confirmado is None
+    off.terminar(7)
+    assert off.siguiente() == 8 and off.confirmado == 5
+    off._flush.detener()
+
+
+def test_los_updates_en_vuelo_se_recuperan_tras_una_caida(tmp_path):
+    ruta = str(tmp_path / "offset.json")
+    off = OffsetConfirmado(ruta)
+    for u in (5, 6, 7):
+        off.registrar(u, {"update_id": u, "message": {"text": str(u)}})
+    off.asegurar()
+    off.terminar(5)
+    off._flush.detener()                  # "caída" con 6 y 7 a medio procesar
+
+    nuevo = OffsetConfirmado(ruta)
+    assert nuevo.confirmado == 6 and nuevo.siguiente() == 6
+    recuperados = nuevo.recuperar()
+    assert [u["message"]["text"] for u in recuperados] == ["6", "7"]
+    assert nuevo.recuperar() == [] and nuevo.en_vuelo() == 2
+    nuevo.terminar(6)
+    nuevo.terminar(7)
+    assert nuevo.confirmado == 8
+    nuevo._flush.detener()
@@ -0,0 +1,49 @@
+from entrada_rapida import parece_entrada_rapida, interpretar_lotes
+
+PINES = {"8oz": {"pequeño"}, "28oz": {"grande"}, "4lbs": {"único"}, "doble": {"pequeño", "grande"}}
+CFG = {
+    "M1": {"producto": "FND", "medida": "8oz", "mercado": "RTCA"},
+    "M2": {"producto": "FNA", "medida": "doble", "mercado": "RTCA"},
+    "M3": {"producto": "FRD", "medida": "28oz", "mercado": "FDA"},
+    "Chub": {"producto": "FNDT", "medida": "4lbs", "mercado": "RTCA"},
+}
+
+
+def permitidos(medida):
+    return PINES.get(medida, set())
+
+
+def test_parece_entrada_rapida():
+    assert parece_entrada_rapida("M1 12 p, M2 8 g")
+    assert parece_entrada_rapida("  chub 5")
+    assert not parece_entrada_rapida("12")
+    assert not parece_entrada_rapida("M1")
+    assert not parece_entrada_rapida("Mañana 3")
+
+
+def test_varios_lotes_con_pines_automaticos():
+    lotes, errores = interpretar_lotes("M1 12 p, M2 8 g; M3 20\nChub 5", CFG, permitidos)
+    assert errores == []
+    assert [(l["llenadora"], l["canastas"], l["pin"]) for l in lotes] == [
+        ("M1", 12, "pequeño"), ("M2", 8, "grande"), ("M3", 20, "grande"), ("Chub", 5, "único")]
+    assert lotes[0]["combo"] is CFG["M1"]
+
+
+def test_pin_omitido_solo_si_la_medida_admite_uno():
+    lotes, errores = interpretar_lotes("m1 3", CFG, permitidos)
+    assert lotes[0]["pin"] == "pequeño" and not errores
+    lotes, errores = interpretar_lotes("M2 3", CFG, permitidos)
+    assert lotes == [] and "falta el pin" in errores[0]
+
+
+def test_todo_o_nada_con_todos_los_errores():
+    lotes, errores = interpretar_lotes("M1 12 g, M3 4 p, M1 0, M4 3, M1 2 x, M1 5", CFG, permitidos)
+    assert lotes == []
+    assert len(errores) == 5
+    assert errores[0].startswith("Lote 1") and "no es válido para 8oz" in errores[0]
+    assert "M3 siempre usa pin grande" in errores[1]
+
+
+def test_llenadora_sin_config():
+    lotes, errores = interpretar_lotes("M1 2, M3 4", {"M1": CFG["M1"]}, permitidos)
+    assert lotes == [] and errores == ["Lote 2: no hay registro para M3; usa Cargar para asignarle un producto."]
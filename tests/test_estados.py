@@ -0,0 +1,103 @@
+import threading
+
+import estados
+from estados import (AlmacenEstadosMemoria, AlmacenEstadosSQLite, AlmacenEstadosSocket,
+                     EstadosConversacion, servidor_resp_local)
+
+
+class Reloj:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+def test_memoria_expira_por_ttl(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(estados.time, "monotonic", reloj)
+    m = AlmacenEstadosMemoria(ttl=10)
+    m.escribir("1", {"paso": "t_ll"})
+    reloj.t += 9
+    assert m.leer("1") == {"paso": "t_ll"}
+    reloj.t += 2
+    assert m.leer("1") is None
+    assert m.estadisticas()["expirados"] == 1
+
+
+def test_memoria_desaloja_lo_menos_reciente_por_entradas_y_bytes():
+    m = AlmacenEstadosMemoria(max_entradas=2)
+    for clave in ("1", "2", "3"):
+        m.escribir(clave, {"c": clave})
+    assert m.leer("1") is None
+    assert m.leer("2") and m.leer("3")
+    assert m.estadisticas()["desalojados"] == 1
+
+    grande = AlmacenEstadosMemoria(max_bytes=30)
+    grande.escribir("a", {"x": "y" * 10})
+    grande.escribir("b", {"x": "y" * 10})
+    assert grande.leer("a") is None
+    assert grande.estadisticas()["bytes"] <= 30
+
+
+def test_escribir_renueva_la_posicion_lru():
+    m = AlmacenEstadosMemoria(max_entradas=2)
+    m.escribir("1", {})
+    m.escribir("2", {})
+    m.escribir("1", {"otra": 1})
+    m.escribir("3", {})
+    assert m.leer("1") == {"otra": 1}
+    assert m.leer("2") is None
+
+
+def test_fachada_confirma_al_final_del_update(tmp_path):
+    backend = AlmacenEstadosSQLite(str(tmp_path / "e.db"))
+    estados_usuarios = EstadosConversacion(backend)
+    estados_usuarios[5] = {"paso": "t_ll"}
+    estados_usuarios[5]["totales"] = 3   # mutación en sitio, antes de confirmar
+    assert backend.leer("5") is None
+    estados_usuarios.confirmar()
+    assert backend.leer("5") == {"paso": "t_ll", "totales": 3}
+    estados_usuarios.pop(5)
+    estados_usuarios.confirmar()
+    assert backend.leer("5") is None
+    assert 5 not in estados_usuarios
+
+
+def test_fachada_solo_reescribe_lo_que_cambio(tmp_path):
+    backend = AlmacenEstadosSQLite(str(tmp_path / "e.db"))
+    backend.escribir("1", {"paso": "t_ll"})
+    backend.escribir("2", {"paso": "t_pin", "totales": {}})
+    escritos = []
+    original = backend.escribir
+    backend.escribir = lambda clave, estado: (escritos.append(clave), original(clave, estado))
+    estados_usuarios = EstadosConversacion(backend)
+    assert estados_usuarios.get(1) == {"paso": "t_ll"}       # solo leído
+    estados_usuarios.get(2)["totales"]["M1"] = 5             # mutado en sitio
+    estados_usuarios.confirmar()
+    assert escritos == ["2"]
+    assert backend.leer("2")["totales"] == {"M1": 5}
+    # una asignación siempre se escribe (renueva el TTL aunque el valor sea el mismo)
+    estados_usuarios[1] = {"paso": "t_ll"}
+    estados_usuarios.confirmar()
+    assert escritos == ["2", "1"]
+
+
+def test_socket_cuenta_solo_las_claves_de_su_prefijo(tmp_path):
+    direccion = f"unix:{tmp_path / 'e.sock'}"
+    srv = servidor_resp_local(direccion)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    try:
+        a = AlmacenEstadosSocket(direccion, prefijo="estado:")
+        otro = AlmacenEstadosSocket(direccion, prefijo="otra[app]:")
+        for clave in ("1", "2", "3"):
+            a.escribir(clave, {"c": clave})
+        otro.escribir("1", {})
+        assert a.leer("2") == {"c": "2"}
+        assert len(EstadosConversacion(a)) == 3
+        assert otro.contar() == 1
+        a.borrar("3")
+        assert a.estadisticas()["entradas"] == 2
+    finally:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+from claves_envase import LETRA_LLENADORA, GeneradorClaves, main
+from historial_config import HistorialConfig, interpretar_fecha
+
+FND = {"producto": "FND", "medida": "8oz", "mercado": "RTCA"}
+FRD = {"producto": "FRD", "medida": "28oz", "mercado": "FDA"}
+
+
+def test_interpretar_fecha():
+    esperado = datetime(2026, 10, 13, 3, 40)
+    for texto in ("2026-10-13 03:40", "2026-10-13T03:40", "13/10/2026 03:40", " 13/10/26  03:40 "):
+        assert interpretar_fecha(texto) == esperado
+    assert interpretar_fecha("13/10 03:40", ahora=datetime(2026, 1, 1)) == esperado
+    assert interpretar_fecha("ayer") is None and interpretar_fecha(None) is None
+
+
+def _historial(ruta):
+    h = HistorialConfig(str(ruta))
+    h.registrar(5, "M1", FND, {"sku": "194916", "vida_util_meses": 18}, ts=datetime(2026, 10, 13, 6, 0))
+    h.registrar(5, "M1", FRD, {"sku": "194999", "vida_util_meses": 24}, ts=datetime(2026, 10, 13, 14, 0))
+    # llega fuera de orden (p. ej. sembrado al arrancar): igual queda en su lugar
+    h.registrar(5, "M1", FND, {"sku": "194916", "vida_util_meses": 18}, ts=datetime(2026, 10, 12, 22, 0),
+                origen="siembra")
+    return h
+
+
+def test_vigente_por_bisect(tmp_path):
+    h = _historial(tmp_path / "h.jsonl")
+    assert h.vigente(5, "M1", datetime(2026, 10, 12, 21, 59)) is None
+    assert h.vigente("5", "M1", "2026-10-12T22:00:00")["origen"] == "siembra"
+    assert h.vigente(5, "M1", datetime(2026, 10, 13, 13, 59, 59))["sku"] == "194916"
+    assert h.vigente(5, "M1", datetime(2026, 10, 13, 14, 0))["producto"] == "FRD"
+    assert h.vigente(5, "M2", datetime(2026, 10, 13, 14, 0)) is None
+    assert [r["ts"][11:16] for r in h.historial(5, "M1")] == ["22:00", "06:00", "14:00"]
+
+
+def test_se_recarga_del_archivo_e_ignora_lineas_rotas(tmp_path):
+    ruta = tmp_path / "h.jsonl"
+    _historial(ruta)
+    with open(ruta, "a", encoding="utf-8") as f:
+        f.write('{"ts": "2026-10-14T00:00:00", "chat_id": "5"}\n{"ts": "20')
+    h = HistorialConfig(str(ruta))
+    assert h.tiene(5, "M1") and not h.tiene(5, "M3")
+    assert h.vigente(5, "M1", datetime(2026, 10, 14))["producto"] == "FRD"
+    # la línea cortada del final no se lee (podría estar a medio escribir)...
+    assert h.estadisticas()["entradas"] == 3 and h.estadisticas()["errores"] == 1
+    # ...pero al escribir, con el bloqueo tomado, se cierra y el registro nuevo queda entero
+    h.registrar(5, "M3", FRD, {"sku": "194999", "vida_util_meses": 24}, ts=datetime(2026, 10, 14, 6, 0))
+    assert h.tiene(5, "M3") and h.estadisticas()["errores"] == 2
+    assert HistorialConfig(str(ruta)).historial(5, "M3") == h.historial(5, "M3")
+
+
+def test_se_ve_lo_que_registra_otro_proceso(tmp_path):
+    ruta = str(tmp_path / "h.jsonl")
+    a, b = HistorialConfig(ruta), HistorialConfig(ruta)
+    a.registrar(5, "M1", FND, {"sku": "194916", "vida_util_meses": 18}, ts=datetime(2026, 10, 13, 6, 0))
+    assert b.vigente(5, "M1", datetime(2026, 10, 13, 7, 0))["sku"] == "194916"
+    b.registrar(5, "M1", FRD, {"sku": "194999", "vida_util_meses": 24}, ts=datetime(2026, 10, 13, 8, 0))
+    assert [r["producto"] for r in a.historial(5, "M1")] == ["FND", "FRD"]
+    assert [r["producto"] for r in b.historial(5, "M1")] == ["FND", "FRD"]   # la propia no se indexa dos veces
+    # la siembra al arrancar solo la hace el primero
+    assert a.registrar_si_falta(5, "M2", FND, None, ts=datetime(2026, 10, 13, 9, 0), origen="config_existente")
+    assert b.registrar_si_falta(5, "M2", FND, None, ts=datetime(2026, 10, 13, 9, 0), origen="config_existente") is None
+    assert len(b.historial(5, "M2")) == 1
+
+
+def test_cli_clave_historica_coincide_con_el_generador(tmp_path, capsys):
+    ruta = tmp_path / "h.jsonl"
+    _historial(ruta)
+    assert main(["clave", "5", "M1", "13/10/2026 03:40", "--historial", str(ruta)]) == 0
+    salida = capsys.readouterr().out.strip()
+    esperada = GeneradorClaves(LETRA_LLENADORA).clave("M1", "RTCA", "194916", 18, datetime(2026, 10, 13, 3, 40))
+    assert salida == esperada
+    assert main(["clave", "5", "M2", "2026-10-13T03:40", "--historial", str(ruta)]) == 1
+    assert main(["clave", "5", "M1", "mañana", "--historial", str(ruta)]) == 2
@@ -0,0 +1,41 @@
+import threading
+
+from metricas import Registro
+
+
+def test_contador_suma_los_fragmentos_de_todos_los_hilos():
+    reg = Registro()
+    c = reg.contador("bot_updates_total", "Updates", ("tipo",))
+    hilos = [threading.Thread(target=lambda: [c.inc(("mensaje",)) for _ in range(1000)]) for _ in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    c.inc(("callback",), n=3)
+    texto = reg.exponer()
+    assert 'bot_updates_total{tipo="mensaje"} 8000' in texto
+    assert 'bot_updates_total{tipo="callback"} 3' in texto
+    assert "# TYPE bot_updates_total counter" in texto
+
+
+def test_histograma_con_buckets_acumulados():
+    reg = Registro()
+    h = reg.histograma("bot_lat_seconds", "Latencia", ("ruta",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 3.0):
+        h.observar(v, ("x",))
+    lineas = reg.exponer().splitlines()
+    assert 'bot_lat_seconds_bucket{ruta="x",le="0.1"} 2' in lineas
+    assert 'bot_lat_seconds_bucket{ruta="x",le="1.0"} 3' in lineas
+    assert 'bot_lat_seconds_bucket{ruta="x",le="+Inf"} 4' in lineas
+    assert 'bot_lat_seconds_sum{ruta="x"} 3.65' in lineas
+    assert 'bot_lat_seconds_count{ruta="x"} 4' in lineas
+
+
+def test_medidor_escapa_etiquetas_y_aisla_errores():
+    reg = Registro()
+    reg.medidor("bot_falla", "Siempre falla", lambda: 1 / 0)
+    reg.medidor("bot_colas", "Profundidad", lambda: {('a"b',): 2, ("c",): None}, ("cola",))
+    texto = reg.exponer()
+    assert "bot_falla" not in texto
+    assert 'bot_colas{cola="a\\"b"} 2' in texto
+    assert 'cola="c"' not in texto
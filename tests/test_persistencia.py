@@ -0,0 +1,134 @@
+import sys
+import time
+import threading
+import subprocess
+
+from persistencia import AlmacenJSON, BloqueoArchivo, Contador, DocumentoCache, EscrituraDiferida
+
+
+def test_contador_exacto_entre_hilos():
+    c = Contador()
+
+    def sumar():
+        for _ in range(10000):
+            c.inc()
+
+    hilos = [threading.Thread(target=sumar) for _ in range(8)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    assert c.valor() == 80000
+    c.inc(5)
+    assert c.valor() == 80005
+
+
+def test_documento_cache_cuenta_hits_y_misses():
+    cargas = []
+    doc = DocumentoCache("d", lambda: cargas.append(1) or {"a": 1}, lambda d, claves=None: True)
+    assert doc.leer() == {"a": 1}
+    doc.leer()
+    doc.leer()
+    assert len(cargas) == 1
+    est = doc.estadisticas()
+    assert (est["hits"], est["misses"]) == (2, 1)
+
+
+def test_actualizar_publica_copia_y_no_toca_la_instantanea_vieja():
+    guardados = []
+    doc = DocumentoCache("d", lambda: {"x": {"n": 1}}, lambda d, claves=None: guardados.append(claves) or True)
+    viejo = doc.leer()
+
+    def _aplicar(d):
+        d["y"] = {"n": 2}
+        return d
+
+    doc.actualizar(_aplicar, claves={"y"})
+    assert "y" not in viejo
+    assert doc.leer()["y"] == {"n": 2}
+    assert guardados == [{"y"}]
+
+
+def _esperar(cond, tope=3.0):
+    fin = time.monotonic() + tope
+    while not cond() and time.monotonic() < fin:
+        time.sleep(0.01)
+    return cond()
+
+
+def _documento_compartido(almacen, ruta, bloqueo):
+    return DocumentoCache("config", lambda: almacen.cargar(ruta, {}),
+                          lambda data, claves=None: almacen.guardar(ruta, data),
+                          firma=lambda: almacen.firma(ruta), intervalo=0, bloqueo=bloqueo)
+
+
+def test_documento_compartido_recarga_lo_que_escribio_otro_proceso(tmp_path):
+    # Dos cachés sobre el mismo archivo, como las de dos workers
+    ruta = str(tmp_path / "config.json")
+    almacen = AlmacenJSON(threading.Lock())
+    a = _documento_compartido(almacen, ruta, BloqueoArchivo(f"{ruta}.lock"))
+    b = _documento_compartido(almacen, ruta, BloqueoArchivo(f"{ruta}.lock"))
+    assert a.leer() == {} and b.leer() == {}
+    a.actualizar(lambda d: dict(d, **{"5": {"M1": "FND"}}))
+    assert b.leer() == {"5": {"M1": "FND"}}
+    # actualizar revalida antes de aplicar: no pisa lo que el otro acaba de escribir
+    b.actualizar(lambda d: dict(d, **{"7": {"M2": "FNA"}}))
+    a.actualizar(lambda d: dict(d, **{"9": {"M3": "FRD"}}))
+    assert b.leer() == a.leer() == {"5": {"M1": "FND"}, "7": {"M2": "FNA"}, "9": {"M3": "FRD"}}
+    # la escritura propia no cuenta como recarga
+    assert a.estadisticas()["recargas"] == 1 and b.estadisticas()["recargas"] == 2
+
+
+def test_bloqueo_de_archivo_excluye_a_otro_proceso(tmp_path):
+    ruta = str(tmp_path / "doc.lock")
+    sonda = ("import fcntl, os, sys; fd = os.open(sys.argv[1], os.O_RDWR)\n"
+             "try:\n    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB); print('libre')\n"
+             "except OSError:\n    print('tomado')")
+
+    def probar():
+        return subprocess.run([sys.executable, "-c", sonda, ruta], capture_output=True, text=True).stdout.strip()
+
+    bloqueo = BloqueoArchivo(ruta)
+    with bloqueo:
+        with bloqueo:                 # reentrante en el mismo hilo
+            assert probar() == "tomado"
+        assert probar() == "tomado"   # sigue tomado hasta salir del primer with
+    assert probar() == "libre"
+
+
+def test_escritura_diferida_agrupa_cambios_seguidos():
+    escritos = []
+    e = EscrituraDiferida("d", lambda doc, claves: escritos.append((doc, claves)) or True, retardo=0.05, max_retardo=1)
+    for i in range(20):
+        e.marcar({"v": i}, claves={f"c{i % 3}"})
+    assert _esperar(lambda: escritos)
+    e.detener()
+    assert escritos == [({"v": 19}, {"c0", "c1", "c2"})]
+    assert e.estadisticas()["marcas"] == 20
+
+
+def test_escritura_diferida_no_espera_mas_que_max_retardo():
+    escritos = []
+    e = EscrituraDiferida("d", lambda doc, claves: escritos.append(doc) or True, retardo=0.2, max_retardo=0.3)
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < 0.6:   # cambios cada 20 ms: el debounce solo nunca escribiría
+        e.marcar({"t": time.monotonic()})
+        time.sleep(0.02)
+    assert len(escritos) >= 1
+    e.detener()
+
+
+def test_escritura_diferida_reintenta_si_falla_y_vacia_al_detener():
+    intentos = []
+
+    def guardar(doc, claves):
+        intentos.append(doc)
+        return len(intentos) > 1
+
+    e = EscrituraDiferida("d", guardar, retardo=10, max_retardo=10)
+    e.marcar({"v": 1}, claves={"a"})
+    assert e.vaciar() is False
+    assert e.estadisticas()["pendiente"] is True
+    assert e.detener() is True
+    assert intentos == [{"v": 1}, {"v": 1}]
+    assert e.estadisticas()["errores"] == 1
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+from ritmo import RitmoLlenadoras, VentanaCircular, texto_ritmo
+
+
+def test_ventana_reutiliza_cubetas_al_dar_la_vuelta():
+    v = VentanaCircular(60, 6)          # cubetas de 10 s
+    assert v.agregar(0, 1, 10.0)
+    assert v.agregar(55, 2, 20.0)
+    assert v.totales(59) == (3, 30.0, 2)
+    # t=65 cae en la misma cubeta que t=5 (otra vuelta): la pisa y el lote de t=0 sale de la ventana
+    assert v.agregar(65, 4, 40.0)
+    assert v.totales(65) == (6, 60.0, 2)
+    assert v.totales(200) == (0, 0.0, 0)
+    # más viejo que lo que cubre esa cubeta: se descarta
+    assert not v.agregar(5, 1, 1.0)
+
+
+def test_ritmos_por_ventana_y_primer_lote_reciente():
+    r = RitmoLlenadoras(turno_horas=8)
+    base = datetime(2026, 10, 18, 6, 0)
+    for i in range(12):   # un lote cada 10 min durante 2 h
+        r.registrar(base + timedelta(minutes=10 * i), 1, "M1", 10, 935.0)
+    r.registrar("2026-10-18T07:55:00", 1, "M2", 5, 120.0)
+    ahora = base + timedelta(hours=2)
+    res = r.ritmos(ahora, 1)
+    m1 = res["M1"]
+    # la última hora es (07:00, 08:00]: el lote de las 07:00 ya quedó fuera
+    assert m1["hora"]["lotes"] == 5 and m1["hora"]["canastas_h"] == 50
+    # turno y día: el primer lote fue hace 2 h, se divide por 2 h y no por 8 o 24
+    assert m1["turno"]["horas"] == 2.0 and m1["turno"]["canastas_h"] == 60
+    assert m1["día"]["cajas"] == 12 * 935.0
+    # un solo lote reciente: mínimo 1 h para no inflar el ritmo
+    assert res["M2"]["hora"]["canastas_h"] == 5
+    texto = texto_ritmo(res, r.ventanas)
+    assert "*M1*" in texto and "• 8 h: 🧺 60 | 📦 5 610" in texto
+    assert "*M3*: sin lotes en las últimas 24 h" in texto
+
+
+def test_cargar_desde_la_bitacora_ignora_registros_incompletos():
+    r = RitmoLlenadoras()
+    n = r.cargar([{"ts": "2026-10-18T06:00:00", "chat_id": "7", "llenadora": "M1", "canastas": 3, "cajas": 280.5},
+                  {"ts": "2026-10-18T06:05:00", "chat_id": "7", "llenadora": "M1"},
+                  {"ts": "2026-10-18T06:06:00", "llenadora": "M1", "canastas": 2, "cajas": 1},
+                  {"ts": "no-es-fecha", "chat_id": "7", "llenadora": "M1", "canastas": 1, "cajas": 1}])
+    assert n == 1
+    assert r.estadisticas()["llenadoras"] == 1
+    assert r.ritmos(datetime(2026, 10, 18, 6, 30), 7)["M1"]["hora"]["canastas"] == 3
+
+
+def test_cada_chat_ve_solo_su_ritmo():
+    r = RitmoLlenadoras()
+    base = datetime(2026, 10, 18, 6, 0)
+    r.registrar(base, "10", "M1", 4, 374.0)
+    r.registrar(base + timedelta(minutes=20), 20, "M1", 6, 561.0)
+    r.registrar(base + timedelta(minutes=30), 20, "M2", 1, 93.5)
+    ahora = base + timedelta(minutes=40)
+    assert r.ritmos(ahora, 10) == {"M1": r.ritmos(ahora, "10")["M1"]}
+    assert r.ritmos(ahora, 10)["M1"]["hora"]["canastas"] == 4
+    assert r.ritmos(ahora, 20)["M1"]["hora"]["canastas"] == 6
+    assert r.ritmos(ahora, 30) == {}
+    # sin chat: suma de todos, con el primer lote de cualquiera
+    todos = r.ritmos(ahora)["M1"]["hora"]
+    assert todos["canastas"] == 10 and todos["lotes"] == 2
+    assert r.estadisticas()["series"] == 3 and r.estadisticas()["chats"] == 2
@@ -0,0 +1,59 @@
+import pytest
+
+from rutas import Enrutador
+
+
+def _enrutador(llamadas):
+    r = Enrutador()
+    for patron in ("carga_menu", "c_n_m_{m}", "c_n_me_{me}", "c_n_ll_{ll}", "t_cant_{ll}_{n:int}"):
+        r.ruta(patron)(lambda chat_id, estado, _p=patron, **args: llamadas.append((_p, args)))
+    return r
+
+
+def test_el_prefijo_mas_largo_gana():
+    llamadas = []
+    r = _enrutador(llamadas)
+    assert r.despachar("c_n_me_RTCA", 1, {})
+    assert r.despachar("c_n_m_Mercado_X", 1, {})
+    assert r.despachar("c_n_m_e", 1, {})
+    assert llamadas == [("c_n_me_{me}", {"me": "RTCA"}),
+                        ("c_n_m_{m}", {"m": "Mercado_X"}),   # el último argumento se queda con el resto
+                        ("c_n_m_{m}", {"m": "e"})]
+
+
+def test_exactas_tipos_y_datos_invalidos():
+    llamadas = []
+    r = _enrutador(llamadas)
+    assert r.despachar("carga_menu", 1, {})
+    assert r.despachar("t_cant_M1_12", 1, {})
+    assert llamadas[-1] == ("t_cant_{ll}_{n:int}", {"ll": "M1", "n": 12})
+    assert not r.despachar("t_cant_M1_doce", 1, {})
+    assert not r.despachar("c_n_m_", 1, {})
+    assert not r.despachar("desconocido", 1, {})
+    st = r.estadisticas()
+    assert st["invalidos"] == 1 and st["sin_ruta"] == 2
+    assert st["rutas"]["carga_menu"]["llamadas"] == 1
+
+
+def test_errores_del_handler_se_cuentan_y_propagan():
+    r = Enrutador()
+    vistos = []
+    r.observadores.append(lambda patron, seg, ok: vistos.append((patron, ok)))
+
+    @r.ruta("falla_{x}")
+    def falla(chat_id, estado, x):
+        raise RuntimeError(x)
+
+    with pytest.raises(RuntimeError):
+        r.despachar("falla_a", 1, {})
+    assert r.estadisticas()["rutas"]["falla_{x}"]["errores"] == 1
+    assert vistos == [("falla_{x}", False)]
+
+
+def test_patrones_invalidos_o_duplicados():
+    r = Enrutador()
+    r.ruta("a_{x}")(print)
+    with pytest.raises(ValueError):
+        r.ruta("a_{y}")(print)
+    with pytest.raises(ValueError):
+        r.ruta("b_{x}_fijo")(print)
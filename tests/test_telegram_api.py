@@ -0,0 +1,170 @@
+import time
+import threading
+
+from telegram_api import ClienteTelegram, LatenciasMetodo, MensajesActivos, ProgramadorEnvios
+
+
+def test_cliente_usa_la_sesion_y_registra_latencias(servidor):
+    tg = ClienteTelegram(servidor.url_api())
+    vistos = []
+    tg.observadores.append(lambda metodo, seg, ok: vistos.append((metodo, ok)))
+    assert tg.llamar("sendMessage", {"chat_id": 5, "text": "hola"})["ok"]
+    assert tg.enviar("sendMessage", {"chat_id": 5, "text": "otra"}).result()["ok"]
+    assert not tg.llamar("sendMessage", {"chat_id": 5})["ok"]   # 400: texto vacío
+    st = tg.estadisticas()["metodos"]["sendMessage"]
+    assert st["llamadas"] == 3 and st["errores"] == 1
+    assert st["p50_ms"] <= st["p95_ms"] <= st["max_ms"]
+    assert vistos == [("sendMessage", True), ("sendMessage", True), ("sendMessage", False)]
+
+
+def test_error_de_red_devuelve_none_y_cuenta_como_error():
+    tg = ClienteTelegram("http://127.0.0.1:9/botX", timeout_conexion=0.2)
+    assert tg.llamar("getMe") is None
+    assert tg.estadisticas()["metodos"]["getMe"]["errores"] == 1
+
+
+def test_percentiles_sobre_la_ventana():
+    lat = LatenciasMetodo(ventana=100)
+    for ms in range(1, 201):
+        lat.registrar(float(ms), ok=True)
+    r = lat.resumen()
+    # la ventana guarda las últimas 100 muestras (101..200); los acumulados cubren todo
+    assert r["llamadas"] == 200 and r["max_ms"] == 200.0
+    assert r["p50_ms"] == 151.0 and r["p99_ms"] == 200.0
+    assert r["prom_ms"] == 100.5
+
+
+def test_respuesta_en_linea_reserva_un_solo_mensaje(servidor):
+    tg = ClienteTelegram(servidor.url_api())
+    with tg.respuesta_en_linea() as resp:
+        f = tg.enviar("sendMessage", {"chat_id": 5, "text": "hola"}, chat_id=5, diferible=True)
+        assert f.result()["en_respuesta"]
+    assert resp.cuerpo() == {"method": "sendMessage", "chat_id": 5, "text": "hola"}
+    assert servidor.llamadas_de("sendMessage") == []
+    assert tg.estadisticas()["en_respuesta_webhook"] == 1
+
+
+def test_respuesta_en_linea_con_varios_mensajes_sale_todo_por_la_red_en_orden(servidor):
+    tg = ClienteTelegram(servidor.url_api())
+    with tg.respuesta_en_linea() as resp:
+        tg.enviar("answerCallbackQuery", {"callback_query_id": "cq1"}, diferible=True)
+        tg.enviar("sendMessage", {"chat_id": 5, "text": "uno"}, chat_id=5, diferible=True)
+        tg.enviar("sendMessage", {"chat_id": 5, "text": "dos"}, chat_id=5, diferible=True)
+    # la respuesta del callback sigue en el cuerpo; los mensajes, por la red y en orden
+    assert resp.cuerpo()["method"] == "answerCallbackQuery"
+    assert [p["text"] for _, p, _ in servidor.llamadas_de("sendMessage")] == ["uno", "dos"]
+
+
+def test_envio_no_diferible_no_es_adelantado_por_el_reservado(servidor):
+    tg = ClienteTelegram(servidor.url_api())
+    with tg.respuesta_en_linea() as resp:
+        tg.enviar("sendMessage", {"chat_id": 5, "text": "primero"}, chat_id=5, diferible=True)
+        tg.enviar("editMessageText", {"chat_id": 5, "message_id": 1, "text": "x"}, chat_id=5)
+    assert resp.cuerpo() is None
+    assert [m for m, _, _ in servidor.llamadas_de(chat_id=5)] == ["sendMessage", "editMessageText"]
+
+
+def test_programador_reintenta_tras_retry_after_sin_romper_el_orden():
+    llamadas = []
+    lock = threading.Lock()
+
+    def llamar(metodo, payload):
+        with lock:
+            llamadas.append((payload["text"], time.monotonic()))
+            if len(llamadas) == 1:
+                return {"ok": False, "error_code": 429, "parameters": {"retry_after": 0.3}}
+        return {"ok": True, "result": {"message_id": len(llamadas)}}
+
+    prog = ProgramadorEnvios(llamar, tasa_chat=100.0, rafaga_chat=10, hilos=2)
+    futuros = [prog.encolar("sendMessage", {"chat_id": 7, "text": t}, 7) for t in ("a", "b", "c")]
+    assert all(f.result(5)["ok"] for f in futuros)
+    textos = [t for t, _ in llamadas]
+    assert textos == ["a", "a", "b", "c"]
+    assert llamadas[1][1] - llamadas[0][1] >= 0.29
+    st = prog.estadisticas()
+    assert st["limitados_429"] == 1 and st["enviados"] == 3 and st["en_cola"] == 0
+    prog.detener()
+
+
+def test_programador_descarta_tras_max_reintentos(servidor):
+    servidor.configurar(tasa_429=1.0, retry_after=0)
+    tg = ClienteTelegram(servidor.url_api())
+    prog = ProgramadorEnvios(tg.llamar, max_reintentos=2)
+    data = prog.encolar("sendMessage", {"chat_id": 7, "text": "x"}, 7).result(5)
+    assert data["error_code"] == 429
+    assert servidor.estadisticas()["fallas"]["429"] == 2
+    assert prog.estadisticas()["descartados"] == 1
+    prog.detener()
+
+
+def _pantalla(servidor):
+    return MensajesActivos(ClienteTelegram(servidor.url_api()))
+
+
+def _teclado(data):
+    return {"inline_keyboard": [[{"text": data, "callback_data": data}]]}
+
+
+def test_mensaje_activo_se_edita_en_lugar_de_enviar_otro(servidor):
+    pantalla = _pantalla(servidor)
+    pantalla.mostrar(5, {"chat_id": 5, "text": "paso 1", "reply_markup": _teclado("a")}).result()
+    mid = pantalla.activo(5)
+    assert mid is not None
+    pantalla.mostrar(5, {"chat_id": 5, "text": "paso 2", "reply_markup": _teclado("b")}).result()
+    pantalla.mostrar(5, {"chat_id": 5, "text": "paso 2", "reply_markup": _teclado("b")}).result()  # sin cambios
+    assert [m for m, _, _ in servidor.llamadas_de(chat_id=5)] == ["sendMessage", "editMessageText", "editMessageText"]
+    assert pantalla.activo(5) == mid
+    assert pantalla.estadisticas()["reenviados"] == 0
+
+
+def test_si_la_edicion_falla_se_envia_uno_nuevo(servidor):
+    pantalla = _pantalla(servidor)
+    pantalla.fijar(5, 999)   # p. ej. un botón de un mensaje que ya no existe
+    pantalla.mostrar(5, {"chat_id": 5, "text": "menú", "reply_markup": _teclado("a")}).result()
+    assert [m for m, _, _ in servidor.llamadas_de(chat_id=5)] == ["editMessageText", "sendMessage"]
+    assert pantalla.activo(5) not in (None, 999)
+    assert pantalla.estadisticas()["reenviados"] == 1
+
+
+def test_cerrar_quita_el_teclado_y_olvida_el_activo(servidor):
+    pantalla = _pantalla(servidor)
+    assert pantalla.cerrar(5) is None
+    pantalla.mostrar(5, {"chat_id": 5, "text": "menú", "reply_markup": _teclado("a")}).result()
+    mid = pantalla.activo(5)
+    assert pantalla.cerrar(5).result()["ok"]
+    _, payload, _ = servidor.llamadas_de("editMessageReplyMarkup")[0]
+    assert payload["message_id"] == mid and payload["reply_markup"] == {"inline_keyboard": []}
+    assert pantalla.activo(5) is None
+    pantalla.mostrar(5, {"chat_id": 5, "text": "resumen"}).result()
+    assert servidor.llamadas_de("sendMessage")[-1][1]["text"] == "resumen"
+
+
+def test_una_excepcion_al_enviar_no_bloquea_el_chat():
+    llamadas = []
+
+    def llamar(metodo, payload):
+        llamadas.append(payload["text"])
+        if payload["text"] == "a" and llamadas.count("a") == 1:
+            raise ValueError("respuesta inesperada")
+        return {"ok": True, "result": {"message_id": len(llamadas)}}
+
+    prog = ProgramadorEnvios(llamar, tasa_chat=100.0, rafaga_chat=10, hilos=1)
+    fa = prog.encolar("sendMessage", {"chat_id": 7, "text": "a"}, 7)
+    fb = prog.encolar("sendMessage", {"chat_id": 7, "text": "b"}, 7)
+    # se trata como error de red: se reintenta y el siguiente del chat sale después
+    assert fa.result(5)["ok"] and fb.result(5)["ok"]
+    assert llamadas == ["a", "a", "b"]
+    prog.detener()
+
+
+def test_los_cubos_de_chats_inactivos_se_descartan():
+    prog = ProgramadorEnvios(lambda metodo, payload: {"ok": True, "result": True},
+                             tasa_chat=100.0, rafaga_chat=1, intervalo_poda=0.05)
+    for chat in range(20):
+        prog.encolar("sendMessage", {"chat_id": chat, "text": "x"}, chat).result(5)
+    assert prog.estadisticas()["cubos_chat"] > 0
+    time.sleep(0.1)
+    # la poda corre en el bucle del programador: otro envío lo despierta
+    prog.encolar("sendMessage", {"chat_id": 99, "text": "x"}, 99).result(5)
+    assert prog.estadisticas()["cubos_chat"] <= 1
+    prog.detener()
@@ -0,0 +1,56 @@
+import requests
+
+
+def _post(srv, metodo, payload=None):
+    return requests.post(f"{srv.url_api()}/{metodo}", json=payload or {}, timeout=5).json()
+
+
+def test_mensajes_y_ediciones(servidor):
+    r = _post(servidor, "sendMessage", {"chat_id": 5, "text": "hola",
+                                        "reply_markup": '{"inline_keyboard":[[{"text":"a","callback_data":"a"}]]}'})
+    mid = r["result"]["message_id"]
+    # el reply_markup serializado se guarda decodificado
+    assert servidor.llamadas_de("sendMessage")[0][1]["reply_markup"]["inline_keyboard"][0][0]["text"] == "a"
+    assert _post(servidor, "editMessageText", {"chat_id": 5, "message_id": mid, "text": "chau"})["ok"]
+    r = _post(servidor, "editMessageText", {"chat_id": 5, "message_id": mid, "text": "chau"})
+    assert r["error_code"] == 400 and "not modified" in r["description"]
+    r = _post(servidor, "editMessageText", {"chat_id": 5, "message_id": 999, "text": "x"})
+    assert "not found" in r["description"]
+    assert _post(servidor, "sendMessage", {"chat_id": 5})["error_code"] == 400
+    assert _post(servidor, "noExiste")["error_code"] == 404
+
+
+def test_get_updates_con_offset_y_filtro(servidor):
+    servidor.encolar_update(servidor.update_mensaje(5, "/start"))
+    cb = servidor.update_callback(5, "carga_menu")
+    servidor.encolar_update(cb)
+    r = _post(servidor, "getUpdates", {"allowed_updates": '["callback_query"]'})
+    assert [u["callback_query"]["data"] for u in r["result"]] == ["carga_menu"]
+    r = _post(servidor, "getUpdates", {"offset": 2})
+    assert [u["update_id"] for u in r["result"]] == [2]
+    # el offset descartó el update 1 para siempre
+    assert _post(servidor, "getUpdates", {"offset": 3, "timeout": 0.05})["result"] == []
+
+
+def test_callback_apunta_al_ultimo_teclado(servidor):
+    _post(servidor, "sendMessage", {"chat_id": 5, "text": "menú", "reply_markup": {"inline_keyboard": []}})
+    _post(servidor, "sendMessage", {"chat_id": 5, "text": "sin teclado"})
+    cb = servidor.update_callback(5, "x")
+    assert cb["callback_query"]["message"]["message_id"] == 1
+
+
+def test_fallas_configurables_y_control_http(servidor):
+    servidor.configurar(tasa_429=1.0, retry_after=7)
+    r = _post(servidor, "sendMessage", {"chat_id": 5, "text": "x"})
+    assert r["error_code"] == 429 and r["parameters"]["retry_after"] == 7
+    # getMe no está entre los métodos con fallas
+    assert _post(servidor, "getMe")["ok"]
+    base = f"{servidor.url}/_falso"
+    assert requests.post(f"{base}/config", json={"tasa_429": 0}, timeout=5).json()["tasa_429"] == 0
+    assert requests.post(f"{base}/config", json={"otra": 1}, timeout=5).status_code == 400
+    ids = requests.post(f"{base}/updates", json={"updates": [servidor.update_mensaje(5, "hola")]}, timeout=5).json()
+    assert ids == {"update_ids": [1]}
+    est = requests.get(f"{base}/estadisticas", timeout=5).json()
+    assert est["fallas"] == {"429": 1} and est["updates_pendientes"] == 1
+    requests.post(f"{base}/reiniciar", timeout=5)
+    assert servidor.estadisticas()["llamadas"] == {}
@@ -0,0 +1,39 @@
+import json
+
+from totales import acumular_lote, fmt_num, nuevos_totales, texto_parcial, texto_resumen
+
+FND = {"producto": "FND", "medida": "8oz", "mercado": "RTCA"}
+FRD = {"producto": "FRD", "medida": "28oz", "mercado": "FDA"}
+
+
+def _totales():
+    t = nuevos_totales()
+    acumular_lote(t, "M1", FND, 12, "pequeño", 93.5)
+    acumular_lote(t, "M3", FRD, "4", "grande", 24)
+    acumular_lote(t, "M1", FND, 2, "grande", 93.5)
+    return t
+
+
+def test_acumulados_por_grupo():
+    t = _totales()
+    assert t["canastas"] == 18 and t["cajas"] == 12 * 93.5 + 96 + 187.0
+    assert t["por_llenadora"]["M1"] == {"canastas": 14, "cajas": 1309.0, "lotes": 2}
+    assert t["por_pin"]["grande"]["lotes"] == 2
+    assert t["por_medida"]["28oz"]["cajas"] == 96.0
+    # viaja en el estado de la conversación: debe sobrevivir a JSON
+    assert json.loads(json.dumps(t)) == t
+
+
+def test_textos():
+    t = _totales()
+    t["lotes"][0]["ts"] = "2026-10-18T06:40:12"
+    resumen = texto_resumen(t)
+    assert "*Lote 1* (06:40)" in resumen and "*Lote 2*\n" in resumen
+    assert "📦 Cajas: *1405*" in resumen
+    parcial = texto_parcial(t, esc=lambda s: str(s).replace("_", "\\_"))
+    assert parcial.startswith("📊 *Parcial del turno* (3 lotes)")
+    assert "• grande → 🧺 6 | 📦 283" in parcial
+
+
+def test_fmt_num():
+    assert fmt_num(12.0) == 12 and fmt_num(93.5) == "93.5" and fmt_num("—") == "—"
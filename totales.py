@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Totales acumulados de una sesión de tránsito
+- Cada lote cerrado suma una vez a los acumulados (canastas y cajas por llenadora,
+  por pin y por medida, y generales); consultarlos no recorre los lotes
+- Los lotes guardan el combo y las cajas ya resueltos al cerrar: el resumen final
+  no vuelve a leer config_turno ni CAJAS_POR_CANASTA
+- registrar_lote agrega a cada lote su "ts" (texto ISO) al registrarlo
+- Todo es dict/list/número/texto: viaja en el estado de la conversación con cualquier backend
+"""
+
+
+def nuevos_totales():
+    return {"lotes": [], "canastas": 0, "cajas": 0.0,
+            "por_llenadora": {}, "por_pin": {}, "por_medida": {}}
+
+
+def _sumar(grupo, clave, canastas, cajas):
+    d = grupo.get(clave)
+    if d is None:
+        d = grupo[clave] = {"canastas": 0, "cajas": 0.0, "lotes": 0}
+    d["canastas"] += canastas
+    d["cajas"] += cajas
+    d["lotes"] += 1
+
+
+def acumular_lote(totales, llenadora, combo, canastas, pin, cajas_por_canasta):
+    """Agrega un lote cerrado; devuelve el lote (con cajas calculadas)."""
+    canastas = int(canastas)
+    medida = combo.get("medida", "—")
+    cajas = float(canastas * cajas_por_canasta)
+    lote = {
+        "llenadora": llenadora,
+        "producto": combo.get("producto", "—"),
+        "medida": medida,
+        "mercado": combo.get("mercado", "—"),
+        "canastas": canastas,
+        "pin": pin,
+        "por_canasta": cajas_por_canasta,
+        "cajas": cajas,
+    }
+    totales["lotes"].append(lote)
+    totales["canastas"] += canastas
+    totales["cajas"] += cajas
+    _sumar(totales["por_llenadora"], llenadora, canastas, cajas)
+    _sumar(totales["por_pin"], pin, canastas, cajas)
+    _sumar(totales["por_medida"], medida, canastas, cajas)
+    return lote
+
+
+def fmt_num(v):
+    # 12.0 -> 12, 93.5 -> "93.5"
+    if isinstance(v, (int, float)) and float(v).is_integer():
+        return int(v)
+    return f"{v:.1f}" if isinstance(v, float) else v
+
+
+def _lineas_totales(totales, esc):
+    lineas = ["*Totales por llenadora*:"]
+    for ll, d in totales["por_llenadora"].items():
+        lineas.append(f"• {esc(ll)} → 🧺 {d['canastas']} | 📦 {fmt_num(d['cajas'])}")
+    lineas.append("\n*Totales generales:*")
+    lineas.append(f"🧺 Canastas: *{totales['canastas']}*")
+    lineas.append(f"📦 Cajas: *{fmt_num(totales['cajas'])}*")
+    return lineas
+
+
+def texto_parcial(totales, esc=str):
+    """Totales vigentes (sin el detalle por lote). `esc` escapa texto dinámico para Markdown."""
+    lineas = [f"📊 *Parcial del turno* ({len(totales['lotes'])} lotes)", ""]
+    lineas += _lineas_totales(totales, esc)
+    lineas.append("\n*Por pin:*")
+    for pin, d in totales["por_pin"].items():
+        lineas.append(f"• {esc(pin)} → 🧺 {d['canastas']} | 📦 {fmt_num(d['cajas'])}")
+    lineas.append("\n*Por medida:*")
+    for medida, d in totales["por_medida"].items():
+        lineas.append(f"• {esc(medida)} → 🧺 {d['canastas']} | 📦 {fmt_num(d['cajas'])}")
+    return "\n".join(lineas)
+
+
+def texto_resumen(totales, esc=str):
+    """Resumen final: detalle de cada lote y los mismos totales acumulados."""
+    lineas = ["✅ *Resumen del turno:*"]
+    for idx, r in enumerate(totales["lotes"], 1):
+        hora = f" ({r['ts'][11:16]})" if r.get("ts") else ""
+        lineas.append(
+            f"\n📦 *Lote {idx}*{hora}\n"
+            f"🔹 Llenadora: {esc(r['llenadora'])}\n"
+            f"📏 Medida: {esc(r['medida'])}\n"
+            f"🍲 Producto: {esc(r['producto'])}\n"
+            f"🌎 Mercado: {esc(r['mercado'])}\n"
+            f"🧺 Canastas: {r['canastas']} | 🔩 Pin: {esc(r['pin'])}\n"
+            f"📦 Cajas: *{fmt_num(r['cajas'])}* (≈ {fmt_num(r['por_canasta'])} x canasta)"
+        )
+    lineas.append("\n— — —")
+    lineas += _lineas_totales(totales, esc)
+    return "\n".join(lineas)
@@ -2,27 +2,64 @@
 # -*- coding: utf-8 -*-
 """
 Bot de Tránsito - Modo Webhook (Flask) [FIXED]
-- Arreglos: parsing de callbacks con .split("_")[-1] y md_escape() en textos dinámicos con Markdown
-- Pensado para Render Web Service: endpoint /webhook, health /health
+- Arreglos: callbacks resueltos por tabla de rutas (rutas.Enrutador) y md_escape() en textos dinámicos con Markdown
+- Pensado para Render Web Service: endpoint /webhook, health /health, métricas /metrics (Prometheus)
 
 ENV:
 - BOT_TOKEN
 - PORT
 - (opcional) SECRET_TOKEN_WEBHOOK
+- (opcional) CONFIG_TURNO_DEBOUNCE_SEG, CONFIG_TURNO_MAX_STALE_SEG (escritura diferida de config_turno.json)
+- (opcional) ALMACEN_BACKEND=json|sqlite, SQLITE_PATH
+- (opcional) CATALOGO_RECARGA_SEG (revisión de cambios en catalogo_skus.json)
+- (opcional) BITACORA_DIR (bitácora de lotes)
+- (opcional) HISTORIAL_CONFIG_PATH (historial de asignaciones, para /clave a una hora pasada)
+- (opcional) AVANCE_VENTANA_HORAS, ORDENES_RECARGA_SEG (avance semanal vs. ordenes_semana.json)
+- (opcional) TURNO_HORAS (ventana "turno" del ritmo por llenadora)
+- (opcional) TELEGRAM_API_BASE (otra Bot API, p. ej. el servidor local de telegram_falso.py)
+- (opcional) TELEGRAM_POOL_SIZE, TELEGRAM_TIMEOUT_CONEXION, TELEGRAM_TIMEOUT_LECTURA
+- (opcional) TELEGRAM_TASA_GLOBAL, TELEGRAM_TASA_CHAT, TELEGRAM_RAFAGA_CHAT, TELEGRAM_EMISORES
+- (opcional) WEBHOOK_MODO=cola|inline, WEBHOOK_COLA_MAX, CARRILES_CHAT
+- (opcional) WEBHOOK_RESPUESTA_EN_LINEA=1|0 (answerCallbackQuery/sendMessage en la respuesta del webhook)
+- (opcional) ESTADOS_BACKEND=memoria|sqlite|socket, ESTADOS_TTL_SEG, ESTADOS_MAX_BYTES, ESTADOS_MAX_ENTRADAS,
+  ESTADOS_SQLITE_PATH, ESTADOS_SOCKET (estado conversacional por chat)
+- (opcional) MULTIPROCESO=1|0, MULTIPROCESO_REVISION_SEG, MULTIPROCESO_DIR (varios workers sobre los mismos archivos)
+
+Varios workers (MULTIPROCESO=1, con ESTADOS_BACKEND=sqlite o socket): config_turno y
+progreso_semana se recargan cuando otro proceso los cambia, el historial de config y la
+bitácora se leen desde lo último visto (el ritmo suma los lotes de los demás), el mensaje
+activo dura un update y un chat se procesa en un solo proceso a la vez (lock por carril).
 """
 
 import os
-import json
+import sys
+import signal
+import time
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import Flask, request, jsonify
-import requests
+
+from persistencia import BloqueoArchivo, DocumentoCache, EscrituraDiferida, crear_almacen
+from catalogo import CatalogoRecargable, CacheTeclados, serializar_teclado
+from claves_envase import GeneradorClaves, LETRA_LLENADORA, LLENADORAS
+from historial_config import HistorialConfig, interpretar_fecha
+from bitacora import BitacoraLotes, ts_texto
+from avance_semana import AvanceSemanal, texto_avance
+from totales import nuevos_totales, acumular_lote, texto_parcial, texto_resumen
+from entrada_rapida import parece_entrada_rapida, interpretar_lotes
+from ritmo import RitmoLlenadoras, texto_ritmo
+from telegram_api import ClienteTelegram, ProgramadorEnvios, MensajesActivos, INTERACTIVO, MASIVO
+from despacho import DespachadorPorChat
+from estados import EstadosConversacion, crear_almacen_estados
+from rutas import Enrutador
+from metricas import Registro
 
 # =========================
 # Configuración
 # =========================
 TOKEN_TELEGRAM = os.getenv("BOT_TOKEN", "REEMPLAZA_AQUI_EL_TOKEN_EN_DESARROLLO")
-API_URL = f"https://api.telegram.org/bot{TOKEN_TELEGRAM}"
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")  # p. ej. telegram_falso.py en pruebas
+API_URL = f"{TELEGRAM_API_BASE.rstrip('/')}/bot{TOKEN_TELEGRAM}"
 SECRET_TOKEN = os.getenv("SECRET_TOKEN_WEBHOOK", None)
 
 # Persistencia
@@ -31,10 +68,83 @@ CONFIG_TURNO_PATH     = "config_turno.json"
 ORDENES_SEMANA_PATH   = "ordenes_semana.json"
 PROGRESO_SEMANA_PATH  = "progreso_semana.json"
 
+# Escritura diferida de config_turno.json (segundos)
+CONFIG_TURNO_DEBOUNCE_SEG  = float(os.getenv("CONFIG_TURNO_DEBOUNCE_SEG", "0.5"))
+CONFIG_TURNO_MAX_STALE_SEG = float(os.getenv("CONFIG_TURNO_MAX_STALE_SEG", "5"))
+
+# Backend de almacenamiento: "json" (por defecto) o "sqlite"
+ALMACEN_BACKEND = os.getenv("ALMACEN_BACKEND", "json")
+SQLITE_PATH     = os.getenv("SQLITE_PATH", "bot.sqlite3")
+
+# Cada cuánto (segundos) se revisa si catalogo_skus.json cambió en disco para recargarlo
+CATALOGO_RECARGA_SEG = float(os.getenv("CATALOGO_RECARGA_SEG", "2"))
+
+# Bitácora append-only de lotes cerrados (segmentos .jsonl + índice)
+BITACORA_DIR = os.getenv("BITACORA_DIR", "bitacora_lotes")
+HISTORIAL_CONFIG_PATH = os.getenv("HISTORIAL_CONFIG_PATH", "historial_config.jsonl")
+
+# Avance semanal: horas recientes para el ritmo de producción y relectura de ordenes_semana.json
+AVANCE_VENTANA_HORAS = float(os.getenv("AVANCE_VENTANA_HORAS", "8"))
+ORDENES_RECARGA_SEG  = float(os.getenv("ORDENES_RECARGA_SEG", "60"))
+
+# Ritmo por llenadora: la ventana "turno" (además de última hora y día)
+TURNO_HORAS = float(os.getenv("TURNO_HORAS", "8"))
+
+# Cliente HTTP de la Bot API: pool keep-alive y timeouts (segundos)
+TELEGRAM_POOL_SIZE        = int(os.getenv("TELEGRAM_POOL_SIZE", "10"))
+TELEGRAM_TIMEOUT_CONEXION = float(os.getenv("TELEGRAM_TIMEOUT_CONEXION", "3.05"))
+TELEGRAM_TIMEOUT_LECTURA  = float(os.getenv("TELEGRAM_TIMEOUT_LECTURA", "10"))
+
+# Límites de envío (Telegram: ~30 msg/s global, ~1 msg/s por chat con ráfagas cortas)
+TELEGRAM_TASA_GLOBAL = float(os.getenv("TELEGRAM_TASA_GLOBAL", "30"))
+TELEGRAM_TASA_CHAT   = float(os.getenv("TELEGRAM_TASA_CHAT", "1"))
+TELEGRAM_RAFAGA_CHAT = int(os.getenv("TELEGRAM_RAFAGA_CHAT", "3"))
+TELEGRAM_EMISORES    = int(os.getenv("TELEGRAM_EMISORES", "4"))
+
+# Webhook: "cola" responde 200 de inmediato y procesa en workers; "inline" procesa dentro del request
+WEBHOOK_MODO     = os.getenv("WEBHOOK_MODO", "cola")
+WEBHOOK_COLA_MAX = int(os.getenv("WEBHOOK_COLA_MAX", "1000"))
+# Carriles de procesamiento por chat (orden estricto por chat, paralelo entre chats)
+CARRILES_CHAT    = int(os.getenv("CARRILES_CHAT", str(max(4, (os.cpu_count() or 1) * 2))))
+# Devolver una llamada de la Bot API en el cuerpo de la respuesta del webhook (1/0)
+WEBHOOK_RESPUESTA_EN_LINEA = os.getenv("WEBHOOK_RESPUESTA_EN_LINEA", "1") == "1"
+
+# Estado conversacional: "memoria" (LRU + TTL), "sqlite" o "socket" (Redis o `python estados.py servidor`)
+ESTADOS_BACKEND      = os.getenv("ESTADOS_BACKEND", "memoria")
+ESTADOS_TTL_SEG      = float(os.getenv("ESTADOS_TTL_SEG", "43200"))
+ESTADOS_MAX_BYTES    = int(os.getenv("ESTADOS_MAX_BYTES", str(16 * 1024 * 1024)))
+ESTADOS_MAX_ENTRADAS = int(os.getenv("ESTADOS_MAX_ENTRADAS", "10000"))
+ESTADOS_SQLITE_PATH  = os.getenv("ESTADOS_SQLITE_PATH", "estados.sqlite3")
+ESTADOS_SOCKET       = os.getenv("ESTADOS_SOCKET", "unix:/tmp/estados.sock")
+
+# Varios procesos sobre los mismos archivos (p. ej. workers de gunicorn): config_turno y
+# progreso_semana se escriben al momento bajo un bloqueo de archivo y cada proceso recarga
+# (como mucho cada MULTIPROCESO_REVISION_SEG) lo que cambiaron los demás.
+# Por defecto activo si el estado conversacional es compartido (sqlite o socket).
+MULTIPROCESO = os.getenv("MULTIPROCESO", "0" if ESTADOS_BACKEND == "memoria" else "1") == "1"
+MULTIPROCESO_REVISION_SEG = float(os.getenv("MULTIPROCESO_REVISION_SEG", "1"))
+MULTIPROCESO_DIR = os.getenv("MULTIPROCESO_DIR", "bloqueos")  # locks de los carriles por chat
+
 _json_lock = threading.Lock()
 
-# Estados
-estados_usuarios = {}
+# Estados por chat_id (ver estados.EstadosConversacion); procesar_update confirma al terminar cada update
+estados_usuarios = EstadosConversacion(crear_almacen_estados(
+    ESTADOS_BACKEND, ESTADOS_TTL_SEG, ESTADOS_MAX_BYTES, ESTADOS_MAX_ENTRADAS,
+    ESTADOS_SQLITE_PATH, ESTADOS_SOCKET,
+))
+if MULTIPROCESO and ESTADOS_BACKEND == "memoria":
+    print("⚠️ MULTIPROCESO=1 con ESTADOS_BACKEND=memoria: el estado de cada chat no se comparte entre procesos.")
+
+# =========================
+# Métricas (GET /metrics, formato Prometheus)
+# =========================
+METRICAS    = Registro()
+M_WEBHOOK   = METRICAS.histograma("bot_webhook_segundos", "Tiempo de atención del POST /webhook", ("modo",))
+M_UPDATES   = METRICAS.histograma("bot_update_segundos", "Procesamiento de un update por tipo", ("tipo",))
+M_CALLBACKS = METRICAS.histograma("bot_callback_segundos", "Procesamiento por ruta de callback", ("ruta",))
+M_TELEGRAM  = METRICAS.histograma("bot_telegram_segundos", "Llamadas HTTP a la Bot API por método", ("metodo", "ok"))
+M_ALMACEN   = METRICAS.histograma("bot_almacen_segundos", "Lecturas/escrituras de documentos", ("operacion", "documento"))
+M_ERRORES   = METRICAS.contador("bot_errores_total", "Excepciones capturadas por origen", ("origen",))
 
 # =========================
 # Conversión de cajas / canasta
@@ -85,63 +195,126 @@ def pin_es_valido(medida, pin):
 # =========================
 # Utilidades JSON y tiempo
 # =========================
+# ALMACEN_BACKEND=json (por defecto, un archivo por documento) o sqlite (SQLITE_PATH).
+# Con sqlite, la primera vez se importan los JSON existentes.
+ALMACEN = crear_almacen(
+    ALMACEN_BACKEND, _json_lock, SQLITE_PATH,
+    CATALOGO_SKUS_PATH, CONFIG_TURNO_PATH,
+    [CATALOGO_SKUS_PATH, CONFIG_TURNO_PATH, ORDENES_SEMANA_PATH, PROGRESO_SEMANA_PATH],
+)
+
 def _load_json(path, default):
+    t0 = time.perf_counter()
     try:
-        with _json_lock:
-            if not os.path.exists(path):
-                return default
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+        return ALMACEN.cargar(path, default)
     except Exception:
+        M_ERRORES.inc(("almacen",))
         return default
+    finally:
+        M_ALMACEN.observar(time.perf_counter() - t0, ("cargar", path))
 
-def _save_json(path, data):
+def _save_json(path, data, indent=2, claves=None):
+    # claves: claves de primer nivel que cambiaron (SQLite solo reescribe esas filas)
+    t0 = time.perf_counter()
     try:
-        with _json_lock:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
+        return ALMACEN.guardar(path, data, claves=claves, indent=indent)
     except Exception:
+        M_ERRORES.inc(("almacen",))
         return False
+    finally:
+        M_ALMACEN.observar(time.perf_counter() - t0, ("guardar", path))
 
 def tz_now_gt():
     return datetime.now()
 
-def dia_juliano(dt):
-    return dt.timetuple().tm_yday
-
-MESES_ES = ["ENE","FEB","MAR","ABR","MAY","JUN","JUL","AGO","SEP","OCT","NOV","DIC"]
-MESES_EN = ["JAN","FEB","MAR","APR","MAY","JUN","JUL","AUG","SEP","OCT","NOV","DEC"]
-
-def mes_es(idx):  # 1..12
-    return MESES_ES[idx-1]
-
-def mes_en(idx):  # 1..12
-    return MESES_EN[idx-1]
-
-def sumar_meses(dt, meses):
-    y = dt.year + (dt.month - 1 + meses) // 12
-    m = (dt.month - 1 + meses) % 12 + 1
-    # día 15 fijo
-    return datetime(y, m, 15, dt.hour, dt.minute)
-
-def calcular_vencimiento(fecha_prod, vida_util_meses):
-    return sumar_meses(fecha_prod, vida_util_meses)
-
 # =========================
 # Catálogo y configuración
 # =========================
+# Documentos en memoria: se leen de disco una vez y las escrituras pasan por la caché.
+# Lo que devuelven get_catalogo()/get_config_turno() es una instantánea compartida: no mutar.
+def _cargar_catalogo():
+    # Sin el try de _load_json: un JSON roto (archivo a medio editar) debe rechazar la
+    # recarga en lugar de publicar un catálogo vacío
+    return ALMACEN.cargar(CATALOGO_SKUS_PATH, {})
+
+# Catálogo indexado (ver catalogo.CatalogoRecargable): consultas en memoria y recarga
+# validada si el archivo cambia. Con SQLite no hay archivo que vigilar.
+CATALOGO = CatalogoRecargable(
+    _cargar_catalogo,
+    lambda data: _save_json(CATALOGO_SKUS_PATH, data),
+    ruta_vigilada=CATALOGO_SKUS_PATH if ALMACEN_BACKEND == "json" else None,
+    intervalo=CATALOGO_RECARGA_SEG,
+    firma=(lambda: ALMACEN.firma(CATALOGO_SKUS_PATH)) if ALMACEN_BACKEND == "sqlite" else None,
+)
+# config_turno no se escribe dentro del request: se marca sucio y un hilo lo vuelca
+# (agrupando ráfagas) a lo sumo CONFIG_TURNO_MAX_STALE_SEG después del primer cambio.
+# Con MULTIPROCESO se escribe al momento (ver _documento).
+_flush_config_turno = EscrituraDiferida(
+    "config_turno",
+    lambda data, claves=None: _save_json(CONFIG_TURNO_PATH, data, indent=None, claves=claves),
+    retardo=CONFIG_TURNO_DEBOUNCE_SEG,
+    max_retardo=CONFIG_TURNO_MAX_STALE_SEG,
+)
+def _documento(nombre, path, flush):
+    # Un proceso: escritura diferida. MULTIPROCESO: escritura al momento bajo bloqueo de
+    # archivo y recarga cuando cambia la firma (mtime del JSON o versión en SQLite)
+    if not MULTIPROCESO:
+        return DocumentoCache(nombre, lambda: _load_json(path, {}), flush.marcar)
+    return DocumentoCache(
+        nombre,
+        lambda: _load_json(path, {}),
+        lambda data, claves=None: _save_json(path, data, indent=None, claves=claves),
+        firma=lambda: ALMACEN.firma(path),
+        intervalo=MULTIPROCESO_REVISION_SEG,
+        bloqueo=BloqueoArchivo(f"{path}.lock"),
+    )
+
+_cache_config_turno = _documento("config_turno", CONFIG_TURNO_PATH, _flush_config_turno)
+
 def get_catalogo():
-    return _load_json(CATALOGO_SKUS_PATH, {})
+    return CATALOGO.indice().datos
 
 def set_catalogo(data):
-    return _save_json(CATALOGO_SKUS_PATH, data)
+    return CATALOGO.escribir(data)
 
 def get_config_turno():
-    return _load_json(CONFIG_TURNO_PATH, {})
+    return _cache_config_turno.leer()
 
 def set_config_turno(data):
-    return _save_json(CONFIG_TURNO_PATH, data)
+    return _cache_config_turno.escribir(data)
+
+def set_config_llenadora(chat_id, llenadora, combo):
+    # Actualiza una sola llenadora de un chat sin pisar cambios concurrentes de otros chats
+    def _aplicar(cfg):
+        por_chat = dict(cfg.get(str(chat_id), {}))
+        por_chat[llenadora] = combo
+        cfg[str(chat_id)] = por_chat
+        return cfg
+    return _cache_config_turno.actualizar(_aplicar, claves={str(chat_id)})
+
+# Cada asignación guardada queda en el historial (append-only) con su sku y vida útil:
+# permite regenerar la clave que se imprimía a cualquier hora pasada
+HISTORIAL = HistorialConfig(HISTORIAL_CONFIG_PATH)
+
+def _sembrar_historial():
+    # Asignaciones previas al historial: vigentes desde el arranque (no se sabe desde cuándo)
+    idx, ahora = CATALOGO.indice(), tz_now_gt()
+    for chat, por_ll in get_config_turno().items():
+        for ll, combo in (por_ll or {}).items():
+            if combo and not HISTORIAL.tiene(chat, ll):
+                # Con varios procesos arrancando a la vez, solo uno la registra
+                cat = idx.combo(combo.get("producto", ""), combo.get("medida", ""), combo.get("mercado", ""))
+                HISTORIAL.registrar_si_falta(chat, ll, combo, cat, ts=ahora, origen="config_existente")
+
+try:
+    _sembrar_historial()
+except Exception as e:
+    print("❗ Error sembrando el historial de config:", e)
+
+def estadisticas_cache():
+    return [CATALOGO.estadisticas(), _cache_config_turno.estadisticas(), _flush_config_turno.estadisticas(),
+            dict(CLAVES.estadisticas(), documento="claves_envase"), AVANCE.estadisticas(),
+            HISTORIAL.estadisticas()]
 
 def combo_key(producto, medida, mercado):
     return f"{producto}|{medida}|{mercado}"
@@ -149,36 +322,16 @@ def combo_key(producto, medida, mercado):
 # =========================
 # Clave de envase
 # =========================
-LETRA_LLENADORA = {"M1":"B", "M2":"C", "M3":"D"}  # Chub pendiente
-
-def generar_clave_envase(llenadora, mercado, sku, vida_util_meses, fecha_ref=None, letra_chub=None):
-    ahora = fecha_ref or tz_now_gt()
-    yy = ahora.year % 100
-    hhmm = ahora.strftime("%H:%M")
-    ddd = dia_juliano(ahora)
-
-    # línea 1 (incluye hora)
-    if llenadora == "Chub":
-        letra = letra_chub if letra_chub else "—"  # pendiente
-    else:
-        letra = LETRA_LLENADORA.get(llenadora, "—")
-    linea1 = f"{letra} {hhmm} {yy:02d} L {ddd}"
-
-    # vencimiento
-    venc = calcular_vencimiento(ahora, vida_util_meses)
-    yy_v = venc.year % 100
-    if mercado == "FDA":
-        mes_txt = mes_en(venc.month)
-        pref = "BEST BY"
-    else:
-        mes_txt = mes_es(venc.month)
-        pref = "EXP"
-    linea2 = f"{pref} 15 {mes_txt} {yy_v:02d}"
 
-    # SKU final
-    linea3 = f"6173 {sku}"
+# Claves memorizadas por minuto, con calendario de juliano/vencimientos precalculado por
+# año para las vidas útiles del catálogo (ver claves_envase.GeneradorClaves)
+CLAVES = GeneradorClaves(
+    LETRA_LLENADORA,
+    vidas=lambda: {v["vida_util_meses"] for v in get_catalogo().values() if isinstance(v.get("vida_util_meses"), int)},
+)
 
-    return f"{linea1}\n{linea2}\n{linea3}"
+def generar_clave_envase(llenadora, mercado, sku, vida_util_meses, fecha_ref=None, letra_chub=None):
+    return CLAVES.clave(llenadora, mercado, sku, vida_util_meses, fecha_ref or tz_now_gt(), letra_chub)
 
 # =========================
 # Telegram helpers
@@ -191,16 +344,44 @@ def md_escape(texto: str) -> str:
             .replace('[', r'\[')
             .replace('`', r'\`'))
 
-def send_msg(chat_id, text, reply_markup=None, parse_mode="Markdown"):
+TELEGRAM = ClienteTelegram(
+    API_URL,
+    pool=TELEGRAM_POOL_SIZE,
+    timeout_conexion=TELEGRAM_TIMEOUT_CONEXION,
+    timeout_lectura=TELEGRAM_TIMEOUT_LECTURA,
+)
+# sendMessage pasa por la cola con límites de tasa; los resúmenes van con prioridad MASIVO
+TELEGRAM.programador = ProgramadorEnvios(
+    TELEGRAM.llamar,
+    tasa_global=TELEGRAM_TASA_GLOBAL,
+    tasa_chat=TELEGRAM_TASA_CHAT,
+    rafaga_chat=TELEGRAM_RAFAGA_CHAT,
+    hilos=TELEGRAM_EMISORES,
+)
+TELEGRAM.observadores.append(lambda metodo, seg, ok: M_TELEGRAM.observar(seg, (metodo, "true" if ok else "false")))
+
+def send_msg(chat_id, text, reply_markup=None, parse_mode="Markdown", prioridad=INTERACTIVO):
+    payload = {"chat_id": chat_id, "text": text}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    return TELEGRAM.enviar("sendMessage", payload, chat_id=chat_id, prioridad=prioridad, diferible=True)
+
+# Pasos de los flujos: editan el mensaje activo del chat en lugar de enviar uno nuevo
+# (ver telegram_api.MensajesActivos). Resúmenes y claves siguen saliendo con send_msg.
+PANTALLA = MensajesActivos(TELEGRAM)
+
+def mostrar(chat_id, text, reply_markup=None, parse_mode="Markdown"):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup:
         payload["reply_markup"] = reply_markup
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    requests.post(f"{API_URL}/sendMessage", json=payload)
+    return PANTALLA.mostrar(chat_id, payload)
 
 def answer_callback(callback_query_id):
-    requests.post(f"{API_URL}/answerCallbackQuery", json={"callback_query_id": callback_query_id})
+    return TELEGRAM.enviar("answerCallbackQuery", {"callback_query_id": callback_query_id}, diferible=True)
 
 def teclado_inline(filas):
     return {"inline_keyboard": filas}
@@ -231,8 +412,10 @@ def mostrar_menu(chat_id):
     filas = [
         [{"text": "📦 Carga de datos",    "callback_data": "carga_menu"}],
         [{"text": "🚚 Reportar tránsito", "callback_data": "transito"}],
+        [{"text": "📈 Avance semanal",    "callback_data": "avance_semana"},
+         {"text": "⏱ Ritmo",              "callback_data": "ritmo"}],
     ]
-    send_msg(chat_id, f"{banner_estado_llenadoras(chat_id)}\n\n🛠️ Selecciona una herramienta:", teclado_inline(filas))
+    mostrar(chat_id, f"{banner_estado_llenadoras(chat_id)}\n\n🛠️ Selecciona una herramienta:", teclado_inline(filas))
 
 def mostrar_menu_carga(chat_id):
     filas = [
@@ -240,50 +423,60 @@ def mostrar_menu_carga(chat_id):
          {"text": "👁 Ver",   "callback_data": "carga_ver"}],
         [{"text": "⬅️ Volver", "callback_data": "volver_menu"}]
     ]
-    send_msg(chat_id, "📦 Carga de datos — elige una opción:", teclado_inline(filas))
+    mostrar(chat_id, "📦 Carga de datos — elige una opción:", teclado_inline(filas))
+
+# Teclados del flujo de carga: salen del catálogo (solo combos existentes) y se serializan
+# una vez por versión del catálogo
+TECLADOS = CacheTeclados(CATALOGO)
+ORDEN_PRODUCTOS = ["FND","FRD","FRS","FNA","FNP","FRP","FNE","FRE","FNDT"]
+ORDEN_MEDIDAS   = ["4oz","8oz","14oz","16oz","28oz","35oz","40oz","80oz","4lbs"]
+ETIQUETA_MERCADO = {"RTCA": "RTCA 🇬🇹", "FDA": "FDA 🇺🇸"}
+
+def _ordenar(valores, orden):
+    return sorted(valores, key=lambda v: (orden.index(v) if v in orden else len(orden), v))
+
+def _teclado_llenadoras(prefijo, extra=()):
+    return serializar_teclado([
+        [{"text": "M1", "callback_data": f"{prefijo}M1"},
+         {"text": "M2", "callback_data": f"{prefijo}M2"}],
+        [{"text": "M3", "callback_data": f"{prefijo}M3"},
+         {"text": "Chub", "callback_data": f"{prefijo}Chub"}],
+        *extra,
+    ])
+
+TECLADO_LLENADORAS_CARGA    = _teclado_llenadoras("c_n_ll_")
+TECLADO_LLENADORAS_TRANSITO = _teclado_llenadoras("t_ll_")
+# Tras cerrar un lote (otro_si): mismas llenadoras + parcial del turno
+TECLADO_LLENADORAS_TRANSITO_PARCIAL = _teclado_llenadoras(
+    "t_ll_", [[{"text": "📊 Ver parcial", "callback_data": "ver_parcial"}]])
 
 def iniciar_carga(chat_id):
     # Paso 1: Llenadora
-    filas = [
-        [{"text": "M1", "callback_data": "c_n_ll_M1"},
-         {"text": "M2", "callback_data": "c_n_ll_M2"}],
-        [{"text": "M3", "callback_data": "c_n_ll_M3"},
-         {"text": "Chub", "callback_data": "c_n_ll_Chub"}],
-    ]
     estados_usuarios[chat_id] = {"paso":"carga_ll", "tmp":{}}
-    send_msg(chat_id, "Selecciona la *llenadora* para este registro:", teclado_inline(filas), parse_mode="Markdown")
+    mostrar(chat_id, "Selecciona la *llenadora* para este registro:", TECLADO_LLENADORAS_CARGA, parse_mode="Markdown")
 
 def teclado_productos():
-    base = [
-        {"text": "FND", "callback_data": "c_n_p_FND"},
-        {"text": "FRD", "callback_data": "c_n_p_FRD"},
-        {"text": "FRS", "callback_data": "c_n_p_FRS"},
-        {"text": "FNA", "callback_data": "c_n_p_FNA"},
-        {"text": "FNP", "callback_data": "c_n_p_FNP"},
-        {"text": "FRP", "callback_data": "c_n_p_FRP"},
-        {"text": "FNE", "callback_data": "c_n_p_FNE"},
-        {"text": "FRE", "callback_data": "c_n_p_FRE"},
-        {"text": "FNDT", "callback_data": "c_n_p_FNDT"},
-    ]
-    filas = [base[i:i+2] for i in range(0, len(base), 2)]
-    return teclado_inline(filas)
-
-def teclado_medidas():
-    medidas = ["4oz","8oz","14oz","16oz","28oz","35oz","40oz","80oz","4lbs"]
-    filas = [[{"text": m, "callback_data": f"c_n_m_{m}"} for m in medidas[i:i+3]] for i in range(0, len(medidas), 3)]
-    return teclado_inline(filas)
-
-def teclado_mercados():
-    filas = [[
-        {"text":"RTCA 🇬🇹", "callback_data":"c_n_me_RTCA"},
-        {"text":"FDA 🇺🇸",  "callback_data":"c_n_me_FDA"},
-    ]]
-    return teclado_inline(filas)
+    def construir(idx):
+        base = [{"text": p, "callback_data": f"c_n_p_{p}"} for p in _ordenar(idx.productos(), ORDEN_PRODUCTOS)]
+        return [base[i:i+2] for i in range(0, len(base), 2)]
+    return TECLADOS.obtener(("productos",), construir)
+
+def teclado_medidas(producto):
+    def construir(idx):
+        medidas = _ordenar(idx.medidas(producto), ORDEN_MEDIDAS)
+        return [[{"text": m, "callback_data": f"c_n_m_{m}"} for m in medidas[i:i+3]] for i in range(0, len(medidas), 3)]
+    return TECLADOS.obtener(("medidas", producto), construir)
+
+def teclado_mercados(producto, medida):
+    def construir(idx):
+        mercados = _ordenar(idx.mercados(producto, medida), list(ETIQUETA_MERCADO))
+        return [[{"text": ETIQUETA_MERCADO.get(me, me), "callback_data": f"c_n_me_{me}"} for me in mercados]]
+    return TECLADOS.obtener(("mercados", producto, medida), construir)
 
 def carga_ver(chat_id):
     cfg = get_config_turno()
     estado_ll = cfg.get(str(chat_id), {})
-    catalogo = get_catalogo()
+    catalogo = CATALOGO.indice()
 
     llenadoras = ["M1","M2","M3","Chub"]
     lineas = ["👁 *Registros cargados (por llenadora):*"]
@@ -294,8 +487,7 @@ def carga_ver(chat_id):
         if combo:
             hay_algo = True
             p, m, me = combo["producto"], combo["medida"], combo["mercado"]
-            k = combo_key(p,m,me)
-            cat = catalogo.get(k, {})
+            cat = catalogo.combo(p, m, me) or {}
             sku = cat.get("sku")
             vida = cat.get("vida_util_meses")
             if sku and vida:
@@ -319,23 +511,18 @@ def carga_ver(chat_id):
     if not hay_algo:
         filas = [[{"text":"➕ Cargar ahora","callback_data":"carga_nuevo"}],
                  [{"text":"⬅️ Volver","callback_data":"carga_menu"}]]
-        send_msg(chat_id, "👁 No hay registros cargados.\nUsa *Cargar* para crear el primero.", teclado_inline(filas), parse_mode="Markdown")
+        mostrar(chat_id, "👁 No hay registros cargados.\nUsa *Cargar* para crear el primero.", teclado_inline(filas), parse_mode="Markdown")
     else:
         send_msg(chat_id, "\n".join(lineas), parse_mode="Markdown")
 
 # =========================
 # Reportar tránsito
 # =========================
-def mostrar_llenadoras_transito(chat_id):
-    filas = [
-        [{"text": "M1", "callback_data": "t_ll_M1"},
-         {"text": "M2", "callback_data": "t_ll_M2"}],
-        [{"text": "M3", "callback_data": "t_ll_M3"},
-         {"text": "Chub", "callback_data": "t_ll_Chub"}],
-    ]
-    send_msg(chat_id, "Selecciona llenadora:", teclado_inline(filas))
+def mostrar_llenadoras_transito(chat_id, con_parcial=False):
+    teclado = TECLADO_LLENADORAS_TRANSITO_PARCIAL if con_parcial else TECLADO_LLENADORAS_TRANSITO
+    mostrar(chat_id, "Selecciona llenadora:\n\n💡 O escribe todos los lotes en un mensaje:\n`M1 12 p, M2 8 g, M3 20, Chub 5`", teclado)
 
-def mostrar_teclado_pin(chat_id, cantidad, medida):
+def mostrar_teclado_pin(chat_id, cantidad, medida, aviso=""):
     sugerido = pin_sugerido_para_medida(medida)
     b_peq = "🔩 Pin Pequeño"
     b_gra = "🔩 Pin Grande"
@@ -347,20 +534,19 @@ def mostrar_teclado_pin(chat_id, cantidad, medida):
         {"text": b_peq, "callback_data": "pin_pequeño"},
         {"text": b_gra, "callback_data": "pin_grande"},
     ]]
-    texto = f"✅ Canastas: {cantidad}\n📏 Medida: {md_escape(medida)}\n\n"
+    texto = aviso + f"✅ Canastas: {cantidad}\n📏 Medida: {md_escape(medida)}\n\n"
     if sugerido:
         texto += f"💡 Sugerido: *{md_escape(sugerido)}* (puedes cambiarlo)\n\n"
     texto += "🔧 Selecciona el tamaño del pin:"
-    send_msg(chat_id, texto, teclado_inline(filas), parse_mode="Markdown")
+    mostrar(chat_id, texto, teclado_inline(filas), parse_mode="Markdown")
 
 def mostrar_teclado_otro_lote_con_clave(chat_id, estado, prefijo_texto=""):
     txt = prefijo_texto.strip()
     cfg = get_config_turno().get(str(chat_id), {})
     ll = estado.get("llenadora")
     combo = cfg.get(ll, {})
-    catalogo = get_catalogo()
-    k = combo_key(combo.get("producto",""), combo.get("medida",""), combo.get("mercado",""))
-    cat = catalogo.get(k, {})
+    catalogo = CATALOGO.indice()
+    cat = catalogo.combo(combo.get("producto",""), combo.get("medida",""), combo.get("mercado","")) or {}
     sku, vida = cat.get("sku"), cat.get("vida_util_meses")
 
     if sku and vida and all(k in estado for k in ("pin",)) and combo.get("mercado"):
@@ -369,67 +555,113 @@ def mostrar_teclado_otro_lote_con_clave(chat_id, estado, prefijo_texto=""):
             txt += "\n\n"
         txt += f"🔑 Clave sugerida: *\n{md_escape(clave)}\n*"
 
-    filas = [[
-        {"text": "🔑 Ver clave del envase", "callback_data": "ver_clave"},
-    ],[
+    fila_extra = [{"text": "🔑 Ver clave del envase", "callback_data": "ver_clave"}]
+    if estado.get("totales", {}).get("lotes"):
+        fila_extra.append({"text": "📊 Ver parcial", "callback_data": "ver_parcial"})
+    filas = [fila_extra, [
         {"text": "✅ Sí", "callback_data": "otro_si"},
         {"text": "❌ No", "callback_data": "otro_no"},
     ]]
-    send_msg(chat_id, (txt + "\n\n➕ ¿Deseas agregar otro lote?").strip(), teclado_inline(filas), parse_mode=None)
-
-def construir_resumen_elegante(reportes, chat_id):
-    por_llenadora = {}
-    total_cajas = 0.0
-    total_canastas = 0
-    lineas = ["✅ *Resumen del turno:*"]
-    for idx, r in enumerate(reportes, 1):
-        llenadora = r["llenadora"]
-        canastas  = int(r["canastas"])
-        pin       = r["pin"]
-
-        cfg = get_config_turno().get(str(chat_id), {})
-        combo = cfg.get(llenadora, {})
-        producto = combo.get("producto","—")
-        medida   = combo.get("medida","—")
-        mercado  = combo.get("mercado","—")
-
-        por_pin = CAJAS_POR_CANASTA.get(medida, {}).get(pin, 0)
-        cajas = canastas * por_pin
-
-        d = por_llenadora.setdefault(llenadora, {"cajas": 0.0, "canastas": 0})
-        d["cajas"] += cajas
-        d["canastas"] += canastas
-        total_cajas += cajas
-        total_canastas += canastas
-
-        lineas.append(
-            f"\n📦 *Lote {idx}*\n"
-            f"🔹 Llenadora: {md_escape(llenadora)}\n"
-            f"📏 Medida: {md_escape(medida)}\n"
-            f"🍲 Producto: {md_escape(producto)}\n"
-            f"🌎 Mercado: {md_escape(mercado)}\n"
-            f"🧺 Canastas: {canastas} | 🔩 Pin: {md_escape(pin)}\n"
-            f"📦 Cajas: *{int(cajas) if cajas.is_integer() else f'{cajas:.1f}'}* (≈ {int(por_pin) if isinstance(por_pin,(int,float)) and float(por_pin).is_integer() else por_pin} x canasta)"
-        )
-
-    lineas.append("\n— — —")
-    lineas.append("*Totales por llenadora*:")
-    for ll, d in por_llenadora.items():
-        cajas_fmt = int(d["cajas"]) if d["cajas"].is_integer() else f"{d['cajas']:.1f}"
-        lineas.append(f"• {md_escape(ll)} → 🧺 {d['canastas']} | 📦 {cajas_fmt}")
-
-    total_fmt = int(total_cajas) if total_cajas.is_integer() else f"{total_cajas:.1f}"
-    lineas.append("\n*Totales generales:*")
-    lineas.append(f"🧺 Canastas: *{total_canastas}*")
-    lineas.append(f"📦 Cajas: *{total_fmt}*")
-
-    return "\n".join(lineas)
+    mostrar(chat_id, (txt + "\n\n➕ ¿Deseas agregar otro lote?").strip(), teclado_inline(filas), parse_mode=None)
+
+# Cada lote cerrado queda en la bitácora (sobrevive reinicios, permite agregar por turno/semana)
+BITACORA = BitacoraLotes(BITACORA_DIR)
+
+# Progreso por semana y combo: cada lote suma a sus contadores (escritura diferida, solo la
+# semana tocada); el avance se lee de ahí, nunca recorriendo la bitácora
+_flush_progreso_semana = EscrituraDiferida(
+    "progreso_semana",
+    lambda data, claves=None: _save_json(PROGRESO_SEMANA_PATH, data, indent=None, claves=claves),
+    retardo=CONFIG_TURNO_DEBOUNCE_SEG,
+    max_retardo=CONFIG_TURNO_MAX_STALE_SEG,
+)
+AVANCE = AvanceSemanal(
+    _documento("progreso_semana", PROGRESO_SEMANA_PATH, _flush_progreso_semana),
+    lambda: _load_json(ORDENES_SEMANA_PATH, {}),
+    ventana_horas=AVANCE_VENTANA_HORAS,
+    recarga_ordenes=ORDENES_RECARGA_SEG,
+)
+
+# Canastas/h y cajas/h por chat y llenadora en ventanas deslizantes (memoria fija por serie);
+# al arrancar se rellenan con los lotes de las últimas 24 h de la bitácora
+RITMO = RitmoLlenadoras(TURNO_HORAS)
+try:
+    RITMO.cargar(BITACORA.consultar(desde=tz_now_gt() - timedelta(hours=24)))
+except Exception as e:
+    print("❗ Error recargando el ritmo desde la bitácora:", e)
+# Lotes que cierran otros procesos: entran al ritmo cuando esta bitácora los lee
+BITACORA.observadores.append(lambda r: RITMO.cargar([r]))
+
+def registrar_lote(chat_id, lote):
+    # `lote` viene de totales.acumular_lote: combo y cajas ya resueltos
+    producto, medida, mercado = lote["producto"], lote["medida"], lote["mercado"]
+    ts = tz_now_gt()
+    lote["ts"] = ts_texto(ts)
+    AVANCE.registrar(ts, combo_key(producto, medida, mercado), lote["cajas"], lote["canastas"])
+    RITMO.registrar(ts, chat_id, lote["llenadora"], lote["canastas"], lote["cajas"])
+    return BITACORA.registrar({
+        "ts": ts,
+        "chat_id": chat_id,
+        "llenadora": lote["llenadora"],
+        "producto": producto,
+        "medida": medida,
+        "mercado": mercado,
+        "combo": combo_key(producto, medida, mercado),
+        "canastas": lote["canastas"],
+        "pin": lote["pin"],
+        "cajas": lote["cajas"],
+        "sku": (CATALOGO.indice().combo(producto, medida, mercado) or {}).get("sku"),
+    })
+
+def construir_resumen_elegante(totales):
+    # Se arma con los acumulados de la sesión (ver totales.py): sin releer config ni recalcular
+    return texto_resumen(totales, md_escape)
+
+PASOS_TRANSITO = ("t_ll", "t_cantidad", "t_pin", "t_otro")
+
+USO_CLAVE = "Uso: `/clave M1 2026-10-13 03:40` (también `13/10 03:40`)"
+
+def clave_historica(chat_id, texto):
+    # Asignación vigente a esa hora según el historial (bisect) + la misma generación de clave
+    partes = texto.split(maxsplit=2)
+    ll = next((x for x in LLENADORAS if len(partes) > 1 and x.lower() == partes[1].lower()), None)
+    cuando = interpretar_fecha(partes[2], tz_now_gt()) if len(partes) > 2 else None
+    if not ll or not cuando:
+        send_msg(chat_id, f"⚠️ {USO_CLAVE}", parse_mode="Markdown")
+        return
+    r = HISTORIAL.vigente(chat_id, ll, cuando)
+    if not (r and r.get("sku") and r.get("vida_util_meses")):
+        send_msg(chat_id, f"⚠️ {md_escape(ll)} no tenía una asignación registrada el {cuando:%d/%m/%Y %H:%M}.", parse_mode="Markdown")
+        return
+    clave = generar_clave_envase(ll, r["mercado"], r["sku"], r["vida_util_meses"], fecha_ref=cuando)
+    desde = r["ts"].replace("T", " ")[:16]
+    send_msg(chat_id, f"🔑 Clave de {md_escape(ll)} el {cuando:%d/%m/%Y %H:%M}:\n```\n{clave}\n```\n"
+                      f"{md_escape(r['producto'])} {md_escape(r['medida'])} {md_escape(r['mercado'])} (asignado {desde})",
+             parse_mode="Markdown")
+
+def registrar_entrada_rapida(chat_id, estado, texto):
+    # Todos los lotes de un mensaje se validan antes de registrar el primero (ver entrada_rapida.py)
+    cfg = get_config_turno().get(str(chat_id), {})
+    lotes, errores = interpretar_lotes(texto, cfg, lambda medida: PIN_PERMITIDO_POR_MEDIDA.get(medida, set()))
+    if errores:
+        detalle = "\n".join(f"• {md_escape(e)}" for e in errores)
+        send_msg(chat_id, f"⚠️ No se registró ningún lote:\n{detalle}\n\nFormato: `M1 12 p, M2 8 g, M3 20, Chub 5`", parse_mode="Markdown")
+        return
+    # Se suman a los lotes ya cerrados en la sesión de tránsito en curso, si la hay
+    totales = (estado or {}).get("totales") or nuevos_totales()
+    for l in lotes:
+        por_canasta = CAJAS_POR_CANASTA.get(l["combo"].get("medida",""), {}).get(l["pin"], 0)
+        registrar_lote(chat_id, acumular_lote(totales, l["llenadora"], l["combo"], l["canastas"], l["pin"], por_canasta))
+    estados_usuarios.pop(chat_id, None)
+    send_msg(chat_id, construir_resumen_elegante(totales), parse_mode="Markdown", prioridad=MASIVO)
 
 # =========================
 # Handlers de updates
 # =========================
 def handle_message(message):
     chat_id = message["chat"]["id"]
+    # El operador escribió: la respuesta va debajo de su mensaje, no editando uno anterior
+    PANTALLA.olvidar(chat_id)
     texto = (message.get("text") or "").strip()
     estado = estados_usuarios.get(chat_id)
 
@@ -437,6 +669,17 @@ def handle_message(message):
         mostrar_menu(chat_id)
         return
 
+    # /clave M1 2026-10-13 03:40 -> la clave que se imprimía a esa hora
+    if texto.split(maxsplit=1)[:1] == ["/clave"]:
+        clave_historica(chat_id, texto)
+        return
+
+    # Entrada rápida: "M1 12 p, M2 8 g, M3 20, Chub 5" registra todos los lotes y devuelve el resumen.
+    # Solo sin flujo abierto o dentro de tránsito: un flujo de carga a medias no se pisa
+    if parece_entrada_rapida(texto) and (not estado or estado.get("paso") in PASOS_TRANSITO):
+        registrar_entrada_rapida(chat_id, estado, texto)
+        return
+
     # Paso cantidad (tránsito)
     if estado and estado.get("paso") == "t_cantidad":
         try:
@@ -483,138 +726,277 @@ def handle_message(message):
             send_msg(chat_id, "❗ Ingresa un número válido de canastas (entero positivo).", parse_mode=None)
 
 
-def handle_callback(cq):
-    chat_id = cq["message"]["chat"]["id"]
-    data = cq["data"]
-    answer_callback(cq["id"])
-    estado = estados_usuarios.get(chat_id)
-
-    if data == "transito":
-        estados_usuarios[chat_id] = {"paso": "t_ll"}
-        mostrar_llenadoras_transito(chat_id)
-
-    elif data == "carga_menu":
-        mostrar_menu_carga(chat_id)
-
-    elif data == "volver_menu":
+# Callbacks de botones: cada ruta recibe (chat_id, estado, **args) ya parseados
+ROUTER = Enrutador("callbacks")
+ROUTER.observadores.append(lambda ruta, seg, ok: M_CALLBACKS.observar(seg, (ruta,)))
+
+@ROUTER.ruta("transito")
+def cb_transito(chat_id, estado):
+    estados_usuarios[chat_id] = {"paso": "t_ll"}
+    mostrar_llenadoras_transito(chat_id)
+
+@ROUTER.ruta("carga_menu")
+def cb_carga_menu(chat_id, estado):
+    mostrar_menu_carga(chat_id)
+
+@ROUTER.ruta("volver_menu")
+def cb_volver_menu(chat_id, estado):
+    mostrar_menu(chat_id)
+
+@ROUTER.ruta("carga_nuevo")
+def cb_carga_nuevo(chat_id, estado):
+    iniciar_carga(chat_id)
+
+@ROUTER.ruta("carga_ver")
+def cb_carga_ver(chat_id, estado):
+    carga_ver(chat_id)
+
+@ROUTER.ruta("c_n_ll_{ll}")
+def cb_carga_llenadora(chat_id, estado, ll):
+    estados_usuarios[chat_id] = {"paso":"carga_producto", "tmp":{"llenadora": ll}}
+    mostrar(chat_id, f"✅ Llenadora: {md_escape(ll)}\n\nElige *producto*:", teclado_productos(), parse_mode="Markdown")
+
+@ROUTER.ruta("c_n_p_{p}")
+def cb_carga_producto(chat_id, estado, p):
+    if estado and estado.get("paso") == "carga_producto":
+        estado["tmp"]["producto"] = p
+        avanzar_carga(chat_id, estado, f"✅ Producto: {md_escape(p)}")
+
+@ROUTER.ruta("c_n_m_{m}")
+def cb_carga_medida(chat_id, estado, m):
+    if estado and estado.get("paso") == "carga_medida":
+        estado["tmp"]["medida"] = m
+        avanzar_carga(chat_id, estado, f"✅ Medida: {md_escape(m)}")
+
+@ROUTER.ruta("c_n_me_{me}")
+def cb_carga_mercado(chat_id, estado, me):
+    if estado and estado.get("paso") == "carga_mercado":
+        estado["tmp"]["mercado"] = me
+        guardar_carga(chat_id, estado)
+
+def avanzar_carga(chat_id, estado, texto):
+    # Pide el siguiente dato que falte; si el catálogo deja una sola opción, se elige sola
+    idx = CATALOGO.indice()
+    tmp = estado["tmp"]
+    for campo, opciones, paso, teclado in (
+        ("medida", lambda: idx.medidas(tmp["producto"]), "carga_medida",
+         lambda: teclado_medidas(tmp["producto"])),
+        ("mercado", lambda: idx.mercados(tmp["producto"], tmp["medida"]), "carga_mercado",
+         lambda: teclado_mercados(tmp["producto"], tmp["medida"])),
+    ):
+        if campo in tmp:
+            continue
+        valores = opciones()
+        if not valores:
+            send_msg(chat_id, f"⚠️ {md_escape(' '.join(tmp.get(c, '') for c in ('producto', 'medida')).strip())} ya no está en el catálogo. Vuelve a *Cargar*.", parse_mode="Markdown")
+            estados_usuarios.pop(chat_id, None)
+            return
+        if len(valores) == 1:
+            tmp[campo] = valores[0]
+            texto += f"\n✅ {campo.capitalize()}: {md_escape(valores[0])} (única opción en catálogo)"
+            continue
+        estado["paso"] = paso
+        mostrar(chat_id, f"{texto}\n\nElige *{campo}*:", teclado(), parse_mode="Markdown")
+        return
+    guardar_carga(chat_id, estado, texto)
+
+def guardar_carga(chat_id, estado, texto=""):
+    tmp = estado["tmp"]
+    p, m, me_val = tmp["producto"], tmp["medida"], tmp["mercado"]
+    k = combo_key(p,m,me_val)
+    catalogo = CATALOGO.indice()
+    cat = catalogo.combo(p, m, me_val)
+    if not cat or "sku" not in cat or "vida_util_meses" not in cat:
+        send_msg(chat_id, f"⚠️ Este combo no existe en catálogo o está incompleto:\n{md_escape(k)}\nAgrega *sku* y *vida_util_meses* en {md_escape(CATALOGO_SKUS_PATH)} y vuelve a intentar.", parse_mode="Markdown")
+        estados_usuarios.pop(chat_id, None)
+    else:
+        ts = tz_now_gt()
+        set_config_llenadora(chat_id, tmp["llenadora"], {"producto": p, "medida": m, "mercado": me_val})
+        HISTORIAL.registrar(chat_id, tmp["llenadora"], {"producto": p, "medida": m, "mercado": me_val}, cat, ts=ts)
+
+        clave = generar_clave_envase(tmp["llenadora"], me_val, cat["sku"], cat["vida_util_meses"], fecha_ref=ts)
+        previo = f"{texto}\n\n" if texto else ""
+        PANTALLA.cerrar(chat_id)
+        send_msg(chat_id, f"{previo}✅ Configuración guardada para *{md_escape(tmp['llenadora'])}* → {md_escape(p)} {md_escape(m)} {md_escape(me_val)}\n\n🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode="Markdown")
+        estados_usuarios.pop(chat_id, None)
         mostrar_menu(chat_id)
 
-    elif data == "carga_nuevo":
-        iniciar_carga(chat_id)
-
-    elif data == "carga_ver":
-        carga_ver(chat_id)
-
-    elif data.startswith("c_n_ll_"):
-        ll = data.split("_")[-1]  # M1/M2/M3/Chub
-        estados_usuarios[chat_id] = {"paso":"carga_producto", "tmp":{"llenadora": ll}}
-        send_msg(chat_id, f"✅ Llenadora: {md_escape(ll)}\n\nElige *producto*:", teclado_productos(), parse_mode="Markdown")
-
-    elif data.startswith("c_n_p_"):
-        p = data.split("_")[-1]
-        if estado and estado.get("paso") == "carga_producto":
-            estado["tmp"]["producto"] = p
-            estado["paso"] = "carga_medida"
-            send_msg(chat_id, f"✅ Producto: {md_escape(p)}\n\nElige *medida*:", teclado_medidas(), parse_mode="Markdown")
-
-    elif data.startswith("c_n_m_"):
-        m = data.split("_")[-1]
-        if estado and estado.get("paso") == "carga_medida":
-            estado["tmp"]["medida"] = m
-            estado["paso"] = "carga_mercado"
-            send_msg(chat_id, f"✅ Medida: {md_escape(m)}\n\nElige *mercado*:", teclado_mercados(), parse_mode="Markdown")
-
-    elif data.startswith("c_n_me_"):
-        me = data.split("_")[-1]
-        if estado and estado.get("paso") == "carga_mercado":
-            tmp = estado["tmp"]
-            tmp["mercado"] = me
-            p, m, me_val = tmp["producto"], tmp["medida"], tmp["mercado"]
-            k = combo_key(p,m,me_val)
-            catalogo = get_catalogo()
-            cat = catalogo.get(k)
-            if not cat or "sku" not in cat or "vida_util_meses" not in cat:
-                send_msg(chat_id, f"⚠️ Este combo no existe en catálogo o está incompleto:\n{md_escape(k)}\nAgrega *sku* y *vida_util_meses* en {md_escape(CATALOGO_SKUS_PATH)} y vuelve a intentar.", parse_mode="Markdown")
-                estados_usuarios.pop(chat_id, None)
-            else:
-                cfg = get_config_turno()
-                por_chat = cfg.get(str(chat_id), {})
-                por_chat[tmp["llenadora"]] = {"producto": p, "medida": m, "mercado": me_val}
-                cfg[str(chat_id)] = por_chat
-                set_config_turno(cfg)
-
-                clave = generar_clave_envase(tmp["llenadora"], me_val, cat["sku"], cat["vida_util_meses"])
-                send_msg(chat_id, f"✅ Configuración guardada para *{md_escape(tmp['llenadora'])}* → {md_escape(p)} {md_escape(m)} {md_escape(me_val)}\n\n🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode="Markdown")
-                estados_usuarios.pop(chat_id, None)
-                mostrar_menu(chat_id)
-
-    elif data.startswith("t_ll_"):
-        ll = data.split("_")[-1]
-        cfg = get_config_turno().get(str(chat_id), {})
-        combo = cfg.get(ll)
-        if not combo:
-            filas = [[{"text":"➕ Crear registro ahora","callback_data":"carga_nuevo"}],
-                     [{"text":"⬅️ Volver","callback_data":"volver_menu"}]]
-            send_msg(chat_id, f"⚠️ No hay registro para {md_escape(ll)}.\nUsa *Cargar* para asignar un producto/medida/mercado.", teclado_inline(filas), parse_mode="Markdown")
-        else:
-            estados_usuarios[chat_id] = {"paso":"t_cantidad", "llenadora": ll, "reportes": []}
-            send_msg(chat_id, f"✅ {md_escape(ll)}: {md_escape(combo['producto'])} {md_escape(combo['medida'])} {md_escape(combo['mercado'])}\n\n🔢 ¿Cuántas canastas se reportaron?", parse_mode="Markdown")
-
-    elif data.startswith("pin_"):
-        pin = data.split("_")[-1]
-        if estado and estado.get("paso") == "t_pin":
-            ll = estado.get("llenadora")
-            cfg = get_config_turno().get(str(chat_id), {})
-            medida = cfg.get(ll, {}).get("medida","—")
-            if not pin_es_valido(medida, pin):
-                send_msg(chat_id, f"⚠️ El pin *{md_escape(pin)}* no es válido para {md_escape(medida)}.", parse_mode="Markdown")
-                mostrar_teclado_pin(chat_id, estado.get("canastas"), medida)
-                return
-            estado["pin"] = pin
-            estado["paso"] = "t_otro"
-            mostrar_teclado_otro_lote_con_clave(chat_id, estado, f"✅ Pin: {md_escape(pin)}")
-
-    elif data == "ver_clave":
+@ROUTER.ruta("t_ll_{ll}")
+def cb_transito_llenadora(chat_id, estado, ll):
+    cfg = get_config_turno().get(str(chat_id), {})
+    combo = cfg.get(ll)
+    if not combo:
+        filas = [[{"text":"➕ Crear registro ahora","callback_data":"carga_nuevo"}],
+                 [{"text":"⬅️ Volver","callback_data":"volver_menu"}]]
+        mostrar(chat_id, f"⚠️ No hay registro para {md_escape(ll)}.\nUsa *Cargar* para asignar un producto/medida/mercado.", teclado_inline(filas), parse_mode="Markdown")
+    else:
+        estados_usuarios[chat_id] = {"paso":"t_cantidad", "llenadora": ll,
+                                  "totales": (estado or {}).get("totales") or nuevos_totales()}
+        mostrar(chat_id, f"✅ {md_escape(ll)}: {md_escape(combo['producto'])} {md_escape(combo['medida'])} {md_escape(combo['mercado'])}\n\n🔢 ¿Cuántas canastas se reportaron?", parse_mode="Markdown")
+
+@ROUTER.ruta("pin_{pin}")
+def cb_pin(chat_id, estado, pin):
+    if estado and estado.get("paso") == "t_pin":
+        ll = estado.get("llenadora")
         cfg = get_config_turno().get(str(chat_id), {})
-        estado_local = estados_usuarios.get(chat_id, {})
-        ll = estado_local.get("llenadora")
+        medida = cfg.get(ll, {}).get("medida","—")
+        if not pin_es_valido(medida, pin):
+            mostrar_teclado_pin(chat_id, estado.get("canastas"), medida, aviso=f"⚠️ El pin *{md_escape(pin)}* no es válido para {md_escape(medida)}.\n\n")
+            return
+        estado["pin"] = pin
+        estado["paso"] = "t_otro"
+        mostrar_teclado_otro_lote_con_clave(chat_id, estado, f"✅ Pin: {md_escape(pin)}")
+
+@ROUTER.ruta("ver_clave")
+def cb_ver_clave(chat_id, estado):
+    cfg = get_config_turno().get(str(chat_id), {})
+    ll = (estado or {}).get("llenadora")
+    combo = cfg.get(ll, {})
+    catalogo = CATALOGO.indice()
+    cat = catalogo.combo(combo.get("producto",""), combo.get("medida",""), combo.get("mercado","")) or {}
+    sku, vida = cat.get("sku"), cat.get("vida_util_meses")
+    if ll and combo and sku and vida:
+        clave = generar_clave_envase(ll, combo["mercado"], sku, vida)
+        send_msg(chat_id, f"🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode=None)
+    else:
+        send_msg(chat_id, "⚠️ Falta información en catálogo o configuración para generar la clave.")
+
+@ROUTER.ruta("otro_{opcion}")
+def cb_otro_lote(chat_id, estado, opcion):
+    if estado and estado.get("paso") in ("t_otro","t_pin","t_cantidad"):
+        ll = estado.get("llenadora")
+        cfg_all = get_config_turno()
+        cfg = cfg_all.get(str(chat_id), {})
         combo = cfg.get(ll, {})
-        catalogo = get_catalogo()
-        k = combo_key(combo.get("producto",""), combo.get("medida",""), combo.get("mercado",""))
-        cat = catalogo.get(k, {})
-        sku, vida = cat.get("sku"), cat.get("vida_util_meses")
-        if ll and combo and sku and vida:
-            clave = generar_clave_envase(ll, combo["mercado"], sku, vida)
-            send_msg(chat_id, f"🔑 Clave (ahora):\n```\n{clave}\n```", parse_mode=None)
+        if not (ll and "canastas" in estado and "pin" in estado and combo):
+            send_msg(chat_id, "⚠️ Faltan datos para cerrar el lote.", parse_mode=None)
+            estados_usuarios.pop(chat_id, None)
+            return
+
+        if "totales" not in estado:
+            estado["totales"] = nuevos_totales()
+        por_canasta = CAJAS_POR_CANASTA.get(combo.get("medida",""), {}).get(estado["pin"], 0)
+        lote = acumular_lote(estado["totales"], ll, combo, estado["canastas"], estado["pin"], por_canasta)
+        registrar_lote(chat_id, lote)
+
+        if opcion == "si":
+            estados_usuarios[chat_id] = {"paso":"t_ll", "totales": estado["totales"]}  # los lotes previos siguen en la sesión
+            mostrar_llenadoras_transito(chat_id, con_parcial=True)
         else:
-            send_msg(chat_id, "⚠️ Falta información en catálogo o configuración para generar la clave.")
+            texto = construir_resumen_elegante(estado["totales"])
+            PANTALLA.cerrar(chat_id)
+            send_msg(chat_id, texto, parse_mode="Markdown", prioridad=MASIVO)
+            estados_usuarios.pop(chat_id, None)
+
+# Menú principal: producción de la semana vs. órdenes
+@ROUTER.ruta("avance_semana")
+def cb_avance_semana(chat_id, estado):
+    filas = [[{"text": "🔄 Actualizar", "callback_data": "avance_semana"}],
+             [{"text": "⬅️ Volver", "callback_data": "volver_menu"}]]
+    mostrar(chat_id, texto_avance(AVANCE.avance(ahora=tz_now_gt()), md_escape), teclado_inline(filas), parse_mode="Markdown")
+
+# Menú principal: canastas/h y cajas/h por llenadora (última hora, turno, día)
+@ROUTER.ruta("ritmo")
+def cb_ritmo(chat_id, estado):
+    filas = [[{"text": "🔄 Actualizar", "callback_data": "ritmo"}],
+             [{"text": "⬅️ Volver", "callback_data": "volver_menu"}]]
+    BITACORA.sincronizar()
+    mostrar(chat_id, texto_ritmo(RITMO.ritmos(tz_now_gt(), chat_id), RITMO.ventanas, md_escape), teclado_inline(filas), parse_mode="Markdown")
+
+# Tránsito: totales acumulados hasta ahora (el lote en curso aún no cuenta)
+@ROUTER.ruta("ver_parcial")
+def cb_ver_parcial(chat_id, estado):
+    totales = (estado or {}).get("totales")
+    if not (totales and totales["lotes"]):
+        send_msg(chat_id, "📊 Aún no hay lotes cerrados en este turno.", parse_mode=None)
+        return
+    send_msg(chat_id, texto_parcial(totales, md_escape), parse_mode="Markdown")
 
-    elif data.startswith("otro_"):
-        if estado and estado.get("paso") in ("t_otro","t_pin","t_cantidad"):
-            ll = estado.get("llenadora")
-            cfg_all = get_config_turno()
-            cfg = cfg_all.get(str(chat_id), {})
-            combo = cfg.get(ll, {})
-            if not (ll and "canastas" in estado and "pin" in estado and combo):
-                send_msg(chat_id, "⚠️ Faltan datos para cerrar el lote.", parse_mode=None)
-                estados_usuarios.pop(chat_id, None)
-                return
-
-            if "reportes" not in estado:
-                estado["reportes"] = []
-            estado["reportes"].append({
-                "llenadora": ll,
-                "canastas": int(estado["canastas"]),
-                "pin": estado["pin"],
-            })
-
-            if data == "otro_si":
-                estados_usuarios[chat_id] = {"paso":"t_ll"}
-                mostrar_llenadoras_transito(chat_id)
-            else:
-                texto = construir_resumen_elegante(estado["reportes"], chat_id)
-                send_msg(chat_id, texto, parse_mode="Markdown")
-                estados_usuarios.pop(chat_id, None)
+def handle_callback(cq, ya_respondido=False):
+    chat_id = cq["message"]["chat"]["id"]
+    # El mensaje del botón tocado pasa a ser el que se edita en el siguiente paso
+    PANTALLA.fijar(chat_id, cq["message"].get("message_id"))
+    if not ya_respondido:
+        answer_callback(cq["id"])
+    ROUTER.despachar(cq.get("data"), chat_id, estados_usuarios.get(chat_id))
+
+def chat_id_de_update(update):
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return None
+
+def procesar_update(update, callback_respondido=False):
+    t0 = time.perf_counter()
+    tipo = "message" if "message" in update else "callback_query" if "callback_query" in update else "otro"
+    try:
+        if tipo == "message":
+            handle_message(update["message"])
+        elif tipo == "callback_query":
+            handle_callback(update["callback_query"], ya_respondido=callback_respondido)
+    except Exception as e:
+        M_ERRORES.inc(("handler",))
+        print("Error en handle_update:", e)
+    finally:
+        # Persiste lo que el update tocó del estado (incluidas mutaciones en sitio)
+        estados_usuarios.confirmar()
+        # El mensaje activo no pasa al update siguiente (un callback fija el suyo, un mensaje
+        # empieza sin activo): da igual qué proceso atienda el próximo
+        chat_id = chat_id_de_update(update)
+        if chat_id is not None:
+            PANTALLA.olvidar(chat_id)
+        M_UPDATES.observar(time.perf_counter() - t0, (tipo,))
+
+# Updates aceptados por el webhook y pendientes de procesar, repartidos en carriles por chat:
+# cada chat se procesa en orden estricto y chats distintos en paralelo.
+# Cada item es (update, callback_respondido).
+DESPACHADOR = DespachadorPorChat(
+    lambda item: procesar_update(*item),
+    carriles=CARRILES_CHAT,
+    capacidad_por_carril=max(1, WEBHOOK_COLA_MAX // CARRILES_CHAT),
+    nombre="webhook",
+    # Entre workers: un chat no se procesa en dos procesos a la vez (mismo CARRILES_CHAT en todos)
+    bloqueo=(lambda i: BloqueoArchivo(os.path.join(MULTIPROCESO_DIR, f"carril-{i}.lock"))) if MULTIPROCESO else None,
+)
+if MULTIPROCESO:
+    os.makedirs(MULTIPROCESO_DIR, exist_ok=True)
+
+# Medidores calculados al exponer /metrics
+def _metricas_colas():
+    return {("webhook",): DESPACHADOR.estadisticas()["profundidad"],
+            ("envios",): TELEGRAM.programador.estadisticas()["en_cola"]}
+
+def _metricas_estados():
+    est = estados_usuarios.estadisticas()
+    return {(evento,): est.get(evento) for evento in ("hits", "misses", "expirados", "desalojados")}
+
+def _metricas_errores_componentes():
+    envios = TELEGRAM.programador.estadisticas()
+    return {
+        ("workers",): DESPACHADOR.estadisticas()["errores"],
+        ("config_turno",): _flush_config_turno.errores.valor(),
+        ("bitacora",): BITACORA.errores.valor(),
+        ("envios_descartados",): envios["descartados"],
+        ("telegram_429",): envios["limitados_429"],
+    }
+
+METRICAS.medidor("bot_cola_profundidad", "Items esperando en cola", _metricas_colas, ("cola",))
+METRICAS.medidor("bot_cola_en_proceso", "Updates en proceso en los carriles", lambda: DESPACHADOR.estadisticas()["en_proceso"])
+METRICAS.medidor("bot_cola_rechazados_total", "Updates rechazados (503) con la cola llena",
+                 lambda: DESPACHADOR.estadisticas()["rechazados"], tipo="counter")
+METRICAS.medidor("bot_estados_entradas", "Chats con estado conversacional vivo", lambda: len(estados_usuarios))
+METRICAS.medidor("bot_estados_eventos_total", "Eventos del almacén de estados", _metricas_estados, ("evento",), tipo="counter")
+METRICAS.medidor("bot_errores_componentes_total", "Errores internos por componente",
+                 _metricas_errores_componentes, ("componente",), tipo="counter")
+def _metricas_cache():
+    return {(d.get("documento", "?"), evento): d[evento]
+            for d in estadisticas_cache() if "hits" in d for evento in ("hits", "misses")}
+
+METRICAS.medidor("bot_cache_lecturas_total", "Lecturas de documentos en caché (hits/misses)",
+                 _metricas_cache, ("documento", "evento"), tipo="counter")
+METRICAS.medidor("bot_pantalla_eventos_total", "Pasos de flujo editados en el mensaje activo vs. mensajes nuevos",
+                 lambda: {(k,): v for k, v in PANTALLA.estadisticas().items() if k != "chats"}, ("evento",), tipo="counter")
 
 # =========================
 # Flask app
@@ -625,21 +1007,49 @@ app = Flask(__name__)
 def health():
     return jsonify({"status": "ok"}), 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return METRICAS.exponer(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    t0 = time.perf_counter()
+    try:
+        return _atender_webhook()
+    finally:
+        M_WEBHOOK.observar(time.perf_counter() - t0, (WEBHOOK_MODO,))
+
+def _atender_webhook():
     if SECRET_TOKEN:
         header_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
         if header_token != SECRET_TOKEN:
             return jsonify({"ok": False, "error": "unauthorized"}), 401
 
     update = request.get_json(force=True, silent=True) or {}
-    try:
-        if "message" in update:
-            handle_message(update["message"])
-        elif "callback_query" in update:
-            handle_callback(update["callback_query"])
-    except Exception as e:
-        print("Error en handle_update:", e)
+    if WEBHOOK_MODO == "cola":
+        # Respuesta inmediata: la latencia hacia Telegram ya no depende de las llamadas salientes.
+        # Con la cola llena se responde 503 para que Telegram reintente (contrapresión).
+        chat_id = chat_id_de_update(update)
+        if chat_id is None:
+            return jsonify({"ok": True}), 200
+        cq = update.get("callback_query")
+        responder_cq = bool(cq and WEBHOOK_RESPUESTA_EN_LINEA)
+        if not DESPACHADOR.encolar(chat_id, (update, responder_cq)):
+            return jsonify({"ok": False, "error": "busy"}), 503
+        if responder_cq:
+            # El answerCallbackQuery viaja en esta misma respuesta: un request saliente menos
+            return jsonify({"method": "answerCallbackQuery", "callback_query_id": cq["id"]}), 200
+    else:
+        # Inline: se procesa en el hilo del request, con la misma exclusión por chat que los carriles
+        with DESPACHADOR.en_orden(chat_id_de_update(update)):
+            if WEBHOOK_RESPUESTA_EN_LINEA:
+                with TELEGRAM.respuesta_en_linea() as resp:
+                    procesar_update(update)
+                cuerpo = resp.cuerpo()
+                if cuerpo:
+                    return jsonify(cuerpo), 200
+            else:
+                procesar_update(update)
     return jsonify({"ok": True}), 200
 
 def ensure_files():
@@ -649,11 +1059,12 @@ def ensure_files():
         (ORDENES_SEMANA_PATH, {}),
         (PROGRESO_SEMANA_PATH, {}),
     ]:
-        if not os.path.exists(path):
-            _save_json(path, default)
+        ALMACEN.asegurar(path, default)
 
 if __name__ == "__main__":
     ensure_files()
+    # SIGTERM (deploy/restart en Render) -> salida normal para que corran los vaciados de atexit
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     port = int(os.getenv("PORT", "10000"))
     print(f"Webhook bot escuchando en puerto {port} 🚀  (usa /webhook)")
     app.run(host="0.0.0.0", port=port, debug=False)